@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+⏱️ Офлайн-бенчмарк Coffee Duty Bot
+Заполняет временную БД синтетическими пользователями, подменяет Telegram
+заглушками и замеряет обработчики, скрипты и суточные циклы.
+
+Пример:
+    python bench.py --users 10,1000,50000 --mix daily=0.6,rare=0.3,waiting=0.1 --json bench.json
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List
+
+# bot.py читает окружение при импорте: токен-заглушка и временная БД
+_TMP_DIR = tempfile.mkdtemp(prefix='coffee_bench_')
+os.environ.setdefault('BOT_TOKEN', '0:bench')
+os.environ['DB_FILE'] = os.path.join(_TMP_DIR, 'bench.db')
+
+import logging
+logging.disable(logging.INFO)
+
+import bot  # noqa: E402
+
+# =========== ЗАГЛУШКИ TELEGRAM ===========
+class FakeBot:
+    """Бот без сети: считает вызовы API, опционально имитирует задержку"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = 0
+
+    def _call(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def send_message(self, chat_id, text, **kwargs):
+        self._call()
+
+    def edit_message_text(self, *args, **kwargs):
+        self._call()
+
+    def answer_callback_query(self, *args, **kwargs):
+        self._call()
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+
+class FakeMessage:
+    def __init__(self, bot_stub: FakeBot, text: str = '', chat_id: int = 0):
+        self.bot = bot_stub
+        self.text = text
+        self.chat_id = chat_id
+        self.message_id = 1
+
+    def reply_text(self, text, **kwargs):
+        self.bot._call()
+
+class FakeCallbackQuery:
+    def __init__(self, bot_stub: FakeBot, data: str, user_id: int = 0):
+        self.bot = bot_stub
+        self.data = data
+        self.message = FakeMessage(bot_stub, chat_id=user_id)
+
+    def answer(self, *args, **kwargs):
+        self.bot._call()
+
+    def edit_message_text(self, *args, **kwargs):
+        self.bot._call()
+
+class FakeUpdate:
+    def __init__(self, bot_stub: FakeBot, user_id: int, data: str = None, text: str = ''):
+        self.effective_user = FakeUser(user_id)
+        self.effective_chat = FakeUser(user_id)
+        self.callback_query = FakeCallbackQuery(bot_stub, data, user_id) if data else None
+        self.message = FakeMessage(bot_stub, text, user_id)
+
+class FakeContext:
+    def __init__(self, bot_stub: FakeBot, args: List[str] = None):
+        self.bot = bot_stub
+        self.args = args or []
+        self.user_data = {}
+
+class FakeUpdater:
+    def __init__(self, bot_stub: FakeBot):
+        self.bot = bot_stub
+
+# =========== ПОДГОТОВКА ДАННЫХ ===========
+def parse_mix(text: str) -> Dict[str, float]:
+    """daily=0.6,rare=0.3,waiting=0.1 -> нормированные доли"""
+    mix = {'daily': 0.0, 'rare': 0.0, 'waiting': 0.0}
+    for part in text.split(','):
+        key, value = part.split('=')
+        mix[key.strip()] = float(value)
+    total = sum(mix.values()) or 1.0
+    return {key: value / total for key, value in mix.items()}
+
+def seed_database(users: int, mix: Dict[str, float], teams: int, seed: int) -> Dict[str, List[int]]:
+    """Пересоздать БД и заполнить ее users пользователями заданного состава"""
+    bot.db.close_all()
+    for suffix in ('', '-wal', '-shm'):
+        path = bot.DB_FILE + suffix
+        if os.path.exists(path):
+            os.remove(path)
+    bot.user_cache.invalidate_all()
+    bot.init_database()
+
+    rng = random.Random(seed)
+    team_ids = [bot.DEFAULT_TEAM_ID] + [bot.get_or_create_team(f'Команда {i}') for i in range(1, teams)]
+    groups = {'daily': [], 'rare': [], 'waiting': []}
+    rows = []
+    for user_id in range(1, users + 1):
+        kind = rng.choices(list(mix), weights=list(mix.values()))[0]
+        groups[kind].append(user_id)
+        freq = bot.FREQ_RARE if kind == 'rare' else bot.FREQ_DAILY
+        rows.append((
+            user_id, f'User {user_id}', freq, rng.randint(0, 20),
+            1 if kind == 'waiting' else 0, rng.choice(team_ids)
+        ))
+
+    with bot.db.transaction() as conn:
+        conn.executemany(
+            '''INSERT INTO users (user_id, name, freq, count_1, wait_1, team_id)
+               VALUES (?, ?, ?, ?, ?, ?)''',
+            rows
+        )
+    bot.user_cache.invalidate_all()
+    bot.script_2()
+    return groups
+
+# =========== ЗАМЕРЫ ===========
+class SQLCounter:
+    """Счетчик SQL-выражений всех соединений: и вызывающего потока, и пулов runtime"""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, statement):
+        with self._lock:
+            self.count += 1
+
+def percentile(samples: List[float], pct: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+def measure(name: str, operation: Callable[[int], None], iterations: int,
+            fake_bot: FakeBot) -> Dict:
+    """Выполнить operation(i) iterations раз и собрать статистику"""
+    counter = SQLCounter()
+    bot.db.set_trace(counter)
+    api_before = fake_bot.calls
+    samples = []
+    started = time.perf_counter()
+    try:
+        for i in range(iterations):
+            t0 = time.perf_counter()
+            operation(i)
+            samples.append(time.perf_counter() - t0)
+    finally:
+        bot.db.set_trace(None)
+    total = time.perf_counter() - started
+    return {
+        'operation': name,
+        'iterations': iterations,
+        'p50_ms': percentile(samples, 50) * 1000,
+        'p99_ms': percentile(samples, 99) * 1000,
+        'mean_ms': statistics.fmean(samples) * 1000,
+        'ops_per_sec': iterations / total if total else 0.0,
+        'sql_per_op': counter.count / iterations,
+        'api_calls_per_op': (fake_bot.calls - api_before) / iterations,
+    }
+
+def build_operations(fake_bot: FakeBot, groups: Dict[str, List[int]]) -> Dict[str, Callable[[int], None]]:
+    """Набор замеряемых операций; i - номер итерации для выбора пользователя"""
+    daily = groups['daily'] or [1]
+    rare = groups['rare'] or [1]
+    everyone = daily + rare + groups['waiting']
+
+    def pick(users: List[int], i: int) -> int:
+        return users[i % len(users)]
+
+    def drain_outbox():
+        while bot.runtime.run(bot.outbox_drainer.drain_once()):
+            pass
+
+    def handler(func, users, data):
+        return lambda i: func(FakeUpdate(fake_bot, pick(users, i), data), FakeContext(fake_bot))
+
+    return {
+        'poll_handler:daily': handler(bot.poll_handler, daily, 'daily'),
+        'poll_handler:rarely': handler(bot.poll_handler, rare, 'rarely'),
+        'main_coffee_handler:temp_no_coffee': handler(bot.main_coffee_handler, daily, 'temp_no_coffee'),
+        'main_coffee_handler:returned': handler(bot.main_coffee_handler, daily, 'returned'),
+        'main_coffee_handler:cant_duty': handler(bot.main_coffee_handler, daily, 'cant_duty'),
+        'rare_coffee_handler:today_coffee': handler(bot.rare_coffee_handler, rare, 'today_coffee'),
+        'rare_coffee_handler:cant_duty_rare': handler(bot.rare_coffee_handler, rare, 'cant_duty_rare'),
+        'status': lambda i: bot.status(FakeUpdate(fake_bot, pick(everyone, i)), FakeContext(fake_bot)),
+        'script_1': lambda i: bot.script_1(),
+        'script_2': lambda i: bot.script_2(),
+        'script_3': lambda i: bot.script_3(),
+        'script_4': lambda i: bot.script_4(),
+        'script_5': lambda i: bot.script_5(),
+        'script_6': lambda i: bot.script_6(),
+        'script_6+outbox': lambda i: (bot.script_6(), drain_outbox()),
+        'run_13_00_scripts': lambda i: bot.run_13_00_scripts(),
+        'run_20_00_scripts': lambda i: bot.run_20_00_scripts(),
+    }
+
+# Скрипты и циклы меняют всю таблицу - для них меньше итераций
+HEAVY_PREFIXES = ('script_', 'run_')
+
+def run_population(users: int, args) -> List[Dict]:
+    fake_bot = FakeBot(latency=args.api_latency / 1000)
+    bot.updater_instance = FakeUpdater(fake_bot)
+    bot.SCRIPTS_ENABLED = True
+    if not args.real_limits:
+        bot.broadcaster = bot.Broadcaster(global_rate=1e9, chat_interval=0.0)
+        # Иначе на малых популяциях повторные отказы отбрасываются без работы
+        bot.decline_debouncer = bot.DeclineDebouncer(0.0)
+
+    results = []
+    names = list(build_operations(fake_bot, {'daily': [], 'rare': [], 'waiting': []}))
+    for name in names:
+        if args.only and not any(name.startswith(prefix) for prefix in args.only):
+            continue
+        # Каждая операция - на свежей популяции, чтобы замеры не влияли друг на друга
+        groups = seed_database(users, args.mix, args.teams, args.seed)
+        # Разборщик outbox работает только у лидера: бенчмарк - единственная реплика,
+        # аренда берется заново в свежей БД
+        bot.leader.heartbeat()
+        operation = build_operations(fake_bot, groups)[name]
+        iterations = args.heavy_iterations if name.startswith(HEAVY_PREFIXES) else args.iterations
+        result = measure(name, operation, iterations, fake_bot)
+        result['users'] = users
+        results.append(result)
+        print(
+            f"{users:>7} {name:<38} p50 {result['p50_ms']:9.3f} ms  p99 {result['p99_ms']:9.3f} ms  "
+            f"{result['ops_per_sec']:10.1f} op/s  sql/op {result['sql_per_op']:8.1f}  "
+            f"api/op {result['api_calls_per_op']:8.1f}"
+        )
+    return results
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return 'unknown'
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк обработчиков и скриптов Coffee Duty Bot')
+    parser.add_argument('--users', default='10,1000', help='размеры популяций через запятую')
+    parser.add_argument('--mix', default='daily=0.6,rare=0.3,waiting=0.1', type=parse_mix,
+                        help='состав: доли daily/rare/waiting')
+    parser.add_argument('--teams', type=int, default=1, help='число команд')
+    parser.add_argument('--iterations', type=int, default=200, help='итераций для обработчиков')
+    parser.add_argument('--heavy-iterations', type=int, default=5, help='итераций для скриптов и циклов')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='имитация задержки Bot API, мс')
+    parser.add_argument('--real-limits', action='store_true', help='не отключать лимиты рассылки')
+    parser.add_argument('--only', nargs='*', help='замерять только операции с этими префиксами')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', help='записать результаты в JSON-файл')
+    args = parser.parse_args()
+
+    try:
+        results = []
+        for users in (int(n) for n in args.users.split(',')):
+            results.extend(run_population(users, args))
+
+        if args.json:
+            report = {
+                'revision': git_revision(),
+                'python': sys.version.split()[0],
+                'timestamp': time.time(),
+                'params': {
+                    'mix': args.mix, 'teams': args.teams, 'iterations': args.iterations,
+                    'heavy_iterations': args.heavy_iterations, 'api_latency_ms': args.api_latency,
+                },
+                'results': results,
+            }
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            print(f"📄 Результаты записаны в {args.json}")
+    finally:
+        bot.db.close_all()
+        shutil.rmtree(_TMP_DIR, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
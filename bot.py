@@ -7,22 +7,42 @@
 Использует собственный планировщик вместо JobQueue
 """
 
+import time
+# Точка отсчета для отчета о холодном старте
+_PROCESS_START = time.perf_counter()
+
+import asyncio
+import atexit
+import copy
 import os
 import sys
+import hashlib
+import hmac
+import importlib.util
+import io
+import json
 import logging
+import logging.handlers
+import queue
+import signal
+import socket
+import functools
+import heapq
 import random
+import re
 import sqlite3
 import threading
-import time
-from datetime import datetime, time as dt_time
-from typing import Dict, List, Optional, Tuple
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta, timezone, time as dt_time
+from typing import Callable, Dict, FrozenSet, List, Optional, Sequence, Tuple, Union
 
 # =========== ПАТЧ ДЛЯ ПРОБЛЕМ С IMGHDR В PYTHON 3.13 ===========
-try:
-    import imghdr
-except ImportError:
-    import io
-    
+# Модуль ищется без импорта: на версиях, где он есть, его загрузит сам telegram
+if importlib.util.find_spec('imghdr') is None:
     class ImghdrCompat:
         @staticmethod
         def what(file, h=None):
@@ -49,7 +69,6 @@ except ImportError:
             return None
     
     sys.modules['imghdr'] = ImghdrCompat()
-    import imghdr
 # ===========================================
 
 # =========== ПАТЧ ДЛЯ ПРОБЛЕМ С URLLIB3 В PYTHON 3.13 ===========
@@ -62,18 +81,139 @@ except ImportError:
 # ===========================================
 
 # Импорты для python-telegram-bot 13.x
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Bot, ChatMember, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.utils.request import Request
 from telegram.ext import (
     Updater, CommandHandler, CallbackQueryHandler,
-    MessageHandler, Filters, ConversationHandler
+    MessageHandler, Filters, ConversationHandler, BasePersistence, Dispatcher, JobQueue
+)
+from telegram.error import (
+    BadRequest, ChatMigrated, NetworkError, RetryAfter, TelegramError, Unauthorized
 )
 
 # =========== НАСТРОЙКА ЛОГИРОВАНИЯ ===========
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    handlers=[logging.StreamHandler(sys.stdout)]
-)
+# Потоки бота только кладут запись в очередь; форматирование и запись в stdout -
+# в потоке слушателя, так что медленный приемник логов не задерживает ни
+# нажатия кнопок, ни рассылки. Одинаковые предупреждения и ошибки ограничены
+# по частоте.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')  # text | json
+LOG_QUEUE_SIZE = 10000
+LOG_REPEAT_WINDOW = float(os.environ.get('LOG_REPEAT_WINDOW', '60'))
+LOG_REPEAT_BURST = int(os.environ.get('LOG_REPEAT_BURST', '5'))
+# Поля из extra=..., которые попадают в структурированную запись
+LOG_FIELDS = ('user_id', 'chat_id', 'team_id', 'teams', 'handler', 'job', 'duration_ms', 'suppressed')
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        for field in LOG_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class TextFormatter(logging.Formatter):
+    """Прежний текстовый формат плюс число подавленных повторов"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        suppressed = getattr(record, 'suppressed', None)
+        return f"{text} (подавлено повторов: {suppressed})" if suppressed else text
+
+class RepeatFilter(logging.Filter):
+    """Не больше burst одинаковых предупреждений и ошибок за window секунд.
+
+    Одинаковые - с тем же шаблоном сообщения, поэтому частые записи
+    логируются в %-стиле, а не f-строкой.
+    """
+
+    def __init__(self, window: float = LOG_REPEAT_WINDOW, burst: int = LOG_REPEAT_BURST):
+        super().__init__()
+        self.window = window
+        self.burst = burst
+        self.suppressed_total = 0
+        self._seen: Dict[Tuple, List] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING:
+            return True
+        key = (record.name, record.levelno, str(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            state = self._seen.get(key)
+            if state is None or now - state[0] >= self.window:
+                # Новое окно: первая запись сообщает, сколько было подавлено в прошлом
+                if state is not None and state[1] > self.burst:
+                    record.suppressed = state[1] - self.burst
+                self._seen[key] = [now, 1]
+                if len(self._seen) > 1000:
+                    self._seen = {k: v for k, v in self._seen.items() if now - v[0] < self.window}
+                return True
+            state[1] += 1
+            if state[1] <= self.burst:
+                return True
+            self.suppressed_total += 1
+            return False
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который никогда не ждет: при переполнении запись отбрасывается"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Здесь только подстановка аргументов; форматирование - в потоке слушателя
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = record.exc_text or logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def setup_logging() -> Tuple[LogQueueHandler, RepeatFilter]:
+    """Корневой логгер -> очередь -> поток слушателя -> stdout"""
+    sink = logging.StreamHandler(sys.stdout)
+    sink.setFormatter(
+        JsonFormatter() if LOG_FORMAT == 'json'
+        else TextFormatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    )
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    handler = LogQueueHandler(log_queue)
+    repeat_filter = RepeatFilter()
+    handler.addFilter(repeat_filter)
+    
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    level = logging.getLevelName(LOG_LEVEL)
+    root.setLevel(level if isinstance(level, int) else logging.INFO)
+    
+    listener = logging.handlers.QueueListener(log_queue, sink)
+    listener.start()
+    # Дописать очередь при выходе
+    atexit.register(listener.stop)
+    return handler, repeat_filter
+
+log_handler, log_repeat_filter = setup_logging()
 logger = logging.getLogger(__name__)
 
 # =========== КОНСТАНТЫ ===========
@@ -85,69 +225,791 @@ if not BOT_TOKEN:
     logger.error("❌ BOT_TOKEN не установлен! Добавьте его в Environment Variables на Render.")
     sys.exit(1)
 
+# Режим получения обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.environ.get('BOT_MODE', 'polling').lower()
+# Порт HTTP-сервера (Render передает его в PORT)
+PORT = int(os.environ.get('PORT', '10000'))
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL') or os.environ.get('RENDER_EXTERNAL_URL')
+WEBHOOK_PATH = '/webhook'
+# Секрет для заголовка X-Telegram-Bot-Api-Secret-Token (по умолчанию - из токена).
+# Telegram допускает только [A-Za-z0-9_-]: иной секрет (например, base64 от
+# generateValue Render) заменяется его sha256
+def webhook_secret(configured: str) -> str:
+    if re.fullmatch(r'[A-Za-z0-9_-]{1,256}', configured):
+        return configured
+    return hashlib.sha256((configured or BOT_TOKEN).encode()).hexdigest()[:32]
+
+WEBHOOK_SECRET = webhook_secret(os.environ.get('WEBHOOK_SECRET', ''))
+
+# Быстрый старт для бесплатного плана: меньше потоков, без прогрева кэша
+FAST_START = os.environ.get('FAST_START', '0') == '1'
+# Несколько реплик на одной БД: кэши сверяются с коммитами других процессов
+MULTI_REPLICA = os.environ.get('MULTI_REPLICA', '0') == '1'
+
 # Глобальные флаги
 SCRIPTS_ENABLED = True
 SCHEDULER_RUNNING = False
 updater_instance = None
 
 # База данных SQLite
-DB_FILE = 'coffee_bot.db'
+DB_FILE = os.environ.get('DB_FILE', 'coffee_bot.db')
+
+# Команда (офис) по умолчанию для пользователей без явного выбора
+DEFAULT_TEAM_ID = 0
+DEFAULT_TEAM_NAME = 'Общая кофемашина'
+
+# =========== МЕТРИКИ (ФОРМАТ PROMETHEUS) ===========
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SQL_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+def _format_labels(labelnames: Tuple[str, ...], values: Tuple, extra: str = '') -> str:
+    parts = []
+    for name, value in zip(labelnames, values):
+        escaped = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{name}="{escaped}"')
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+class Counter:
+    """Монотонный счетчик с метками"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def inc(self, *labels, amount: float = 1.0):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def value(self, *labels) -> float:
+        with self._lock:
+            return self._values.get(labels, 0.0)
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for labels, value in self._values.items():
+                lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {value}')
+        return lines
+
+class Histogram:
+    """Гистограмма длительностей с метками"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series: Dict[Tuple, List] = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def observe(self, value: float, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # [счетчики по корзинам..., сумма, количество]
+                series = self._series[labels] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for labels, series in self._series.items():
+                for bound, count in zip(self.buckets, series):
+                    le = 'le="%s"' % bound
+                    lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {count}')
+                le = 'le="+Inf"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {series[-1]}')
+                lines.append(f'{self.name}_sum{_format_labels(self.labelnames, labels)} {series[-2]}')
+                lines.append(f'{self.name}_count{_format_labels(self.labelnames, labels)} {series[-1]}')
+        return lines
+
+class Gauge:
+    """Показатель, вычисляемый в момент сбора: callback() -> {метки: значение}"""
+
+    def __init__(self, name: str, documentation: str, callback, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.callback = callback
+        METRICS.append(self)
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge']
+        try:
+            values = self.callback()
+        except Exception as e:
+            logger.warning("⚠️ Не удалось вычислить %s: %s", self.name, e)
+            return lines
+        for labels, value in values.items():
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {value}')
+        return lines
+
+METRICS: List = []
+
+HANDLER_SECONDS = Histogram('coffee_handler_seconds', 'Время обработчиков Telegram', ('handler',))
+HANDLER_ERRORS = Counter('coffee_handler_errors_total', 'Исключения в обработчиках', ('handler',))
+SQL_SECONDS = Histogram('coffee_sql_seconds', 'Время SQL-выражений', ('statement',), SQL_BUCKETS)
+SQL_ERRORS = Counter('coffee_sql_errors_total', 'Ошибки SQL-выражений', ('statement',))
+SCRIPT_SECONDS = Histogram('coffee_script_seconds', 'Время скриптов и циклов по расписанию', ('script',))
+TELEGRAM_CALLS = Counter('coffee_telegram_calls_total', 'Вызовы Bot API', ('method',))
+TELEGRAM_FAILURES = Counter('coffee_telegram_failures_total', 'Неудачные вызовы Bot API', ('method',))
+TELEGRAM_SECONDS = Histogram('coffee_telegram_seconds', 'Время вызовов Bot API', ('method',))
+
+def render_metrics() -> str:
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+# Списки параметров IN (?, ?, ...) растут с числом команд - в метке любой такой список один
+SQL_PLACEHOLDER_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+
+@functools.lru_cache(maxsize=512)
+def statement_label(query: str) -> str:
+    """Короткая метка SQL-выражения: схлопнутые пробелы и списки (?, ...), не длиннее 80 символов.
+
+    Длинные выражения обрезаются и помечаются хешем, чтобы не сливаться.
+    """
+    label = SQL_PLACEHOLDER_LIST.sub('(?...)', ' '.join(query.split()))
+    if len(label) <= 80:
+        return label
+    return f"{label[:68]}...#{hashlib.sha1(label.encode()).hexdigest()[:8]}"
+
+def timed(histogram: Histogram, label: str, errors: Optional[Counter] = None):
+    """Декоратор: время выполнения функции в histogram с меткой label"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with histogram.time(label):
+                try:
+                    return func(*args, **kwargs)
+                except Exception:
+                    if errors is not None:
+                        errors.inc(label)
+                    raise
+        return wrapper
+    return decorator
+
+# Обработчики дольше этого порога попадают в лог на уровне INFO, остальные - DEBUG
+HANDLER_SLOW_MS = float(os.environ.get('HANDLER_SLOW_MS', '500'))
+
+def instrument_handler(func):
+    """Обертка обработчика Telegram с замером времени и ошибок"""
+    label = func.__name__
+    measured = timed(HANDLER_SECONDS, label, HANDLER_ERRORS)(func)
+
+    @functools.wraps(func)
+    def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return measured(update, context)
+        finally:
+            # Время каждого вызова уже в гистограмме; в лог на уровне INFO - только медленные
+            duration_ms = round((time.perf_counter() - started) * 1000, 3)
+            level = logging.INFO if duration_ms >= HANDLER_SLOW_MS else logging.DEBUG
+            if logger.isEnabledFor(level):
+                user = getattr(update, 'effective_user', None)
+                logger.log(level, "📨 Обработчик %s: %.1f мс", label, duration_ms, extra={
+                    'handler': label,
+                    'user_id': user.id if user else None,
+                    'duration_ms': duration_ms,
+                })
+    return wrapper
+
+class InstrumentedBot(Bot):
+    """Bot, считающий вызовы, ошибки и время каждого метода Bot API"""
+
+    def _post(self, endpoint: str, data=None, timeout=None, api_kwargs=None):
+        TELEGRAM_CALLS.inc(endpoint)
+        started = time.perf_counter()
+        try:
+            return super()._post(endpoint, data, timeout=timeout, api_kwargs=api_kwargs)
+        except Exception:
+            TELEGRAM_FAILURES.inc(endpoint)
+            raise
+        finally:
+            TELEGRAM_SECONDS.observe(time.perf_counter() - started, endpoint)
+
+# =========== ПУЛ СОЕДИНЕНИЙ SQLITE ===========
+# Прагмы применяются один раз на каждое новое соединение
+DB_PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA cache_size = -8000',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA busy_timeout = 5000',
+)
+# Размер кэша подготовленных выражений sqlite3 на соединение
+DB_STATEMENT_CACHE = 128
+
+class ConnectionManager:
+    """Постоянные соединения SQLite: одно на поток, WAL-режим, кэш выражений"""
+
+    def __init__(self, db_file: str):
+        self.db_file = db_file
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections: List[sqlite3.Connection] = []
+        self._trace: Optional[Callable[[str], None]] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.db_file,
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE
+        )
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        with self._lock:
+            self._connections.append(conn)
+            if self._trace is not None:
+                conn.set_trace_callback(self._trace)
+        return conn
+
+    def set_trace(self, callback: Optional[Callable[[str], None]]):
+        """Трассировка SQL на всех соединениях, в том числе открытых позже (None - выключить)"""
+        with self._lock:
+            self._trace = callback
+            for conn in self._connections:
+                conn.set_trace_callback(callback)
+
+    def get(self) -> sqlite3.Connection:
+        """Соединение текущего потока (создается при первом обращении)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+        return conn
+
+    def release(self):
+        """Закрыть соединение текущего потока.
+
+        Для короткоживущих потоков вне пулов (запросы HTTP, запуск): иначе
+        соединение и его дескрипторы остаются открытыми до close_all().
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            return
+        self._local.conn = None
+        self._local.data_version = None
+        with self._lock:
+            if conn in self._connections:
+                self._connections.remove(conn)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def in_transaction(self) -> bool:
+        """Открыта ли явная транзакция в текущем потоке"""
+        return getattr(self._local, 'depth', 0) > 0
+
+    def after_transaction(self, callback):
+        """Вызвать callback по завершении текущей транзакции (COMMIT или ROLLBACK)"""
+        if not self.in_transaction():
+            callback()
+            return
+        if not hasattr(self._local, 'callbacks'):
+            self._local.callbacks = []
+        self._local.callbacks.append(callback)
+
+    def after_commit(self, callback):
+        """Вызвать callback только после COMMIT текущей транзакции; при ROLLBACK - забыть"""
+        if not self.in_transaction():
+            callback()
+            return
+        if not hasattr(self._local, 'commit_callbacks'):
+            self._local.commit_callbacks = []
+        self._local.commit_callbacks.append(callback)
+
+    def _run_callbacks(self, committed: bool):
+        commit_callbacks = getattr(self._local, 'commit_callbacks', None)
+        if commit_callbacks:
+            self._local.commit_callbacks = []
+            if committed:
+                for callback in commit_callbacks:
+                    callback()
+        callbacks = getattr(self._local, 'callbacks', None)
+        if callbacks:
+            self._local.callbacks = []
+            for callback in callbacks:
+                callback()
+
+    @contextmanager
+    def transaction(self):
+        """Единица работы: все запросы внутри блока фиксируются одним COMMIT.
+
+        Вложенные блоки присоединяются к внешней транзакции.
+        """
+        conn = self.get()
+        depth = getattr(self._local, 'depth', 0)
+        if depth == 0:
+            conn.execute('BEGIN IMMEDIATE')
+        self._local.depth = depth + 1
+        try:
+            yield conn
+        except Exception:
+            self._local.depth = depth
+            if depth == 0:
+                conn.rollback()
+                self._run_callbacks(committed=False)
+            raise
+        else:
+            self._local.depth = depth
+            if depth == 0:
+                conn.commit()
+                self._run_callbacks(committed=True)
+
+    def changed_elsewhere(self) -> bool:
+        """Были ли коммиты других соединений (и процессов) с прошлой проверки в этом потоке"""
+        version = self.get().execute('PRAGMA data_version').fetchone()[0]
+        previous = getattr(self._local, 'data_version', None)
+        self._local.data_version = version
+        return version != previous
+
+    def close_all(self):
+        """Закрыть все открытые соединения (при остановке бота)"""
+        with self._lock:
+            for conn in self._connections:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            self._connections.clear()
+        self._local = threading.local()
+
+db = ConnectionManager(DB_FILE)
+
+# =========== АСИНХРОННОЕ ЯДРО ===========
+# python-telegram-bot 13.x синхронный, поэтому обработчики остаются в его
+# диспетчере, а планировщик, фоновые задачи и исходящие рассылки живут
+# в одном цикле asyncio. Блокирующая работа уходит в небольшие пулы.
+RUNTIME_READERS = int(os.environ.get('RUNTIME_READERS', '2'))
+RUNTIME_IO_WORKERS = int(os.environ.get('RUNTIME_IO_WORKERS', '4' if FAST_START else '8'))
+
+class AsyncRuntime:
+    """Цикл asyncio в фоновом потоке.
+
+    writer  - единственный поток фоновых записей в БД,
+    readers - потоки для чтений,
+    io      - блокирующие вызовы Bot API.
+    """
+
+    def __init__(self, readers: int = RUNTIME_READERS, io_workers: int = RUNTIME_IO_WORKERS):
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self.readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='db-reader')
+        self.io = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix='api-io')
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """Цикл событий; поток запускается при первом обращении"""
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(
+                    target=self._loop.run_forever, name='asyncio', daemon=True
+                )
+                self._thread.start()
+            return self._loop
+
+    def submit(self, coro) -> Future:
+        """Запустить корутину в цикле; результат - concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout: Optional[float] = None):
+        """Выполнить корутину и дождаться результата из обычного потока"""
+        if threading.current_thread() is self._thread:
+            coro.close()
+            raise RuntimeError("run() нельзя вызывать из потока цикла событий")
+        return self.submit(coro).result(timeout)
+
+    def every(self, interval: float, func) -> Future:
+        """Периодически выполнять func в потоке записи; отмена - future.cancel()"""
+        return self.submit(self._periodic(interval, func))
+
+    async def _periodic(self, interval: float, func):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await db_write(func)
+            except Exception as e:
+                logger.error("❌ Ошибка фоновой задачи %s: %s", getattr(func, '__qualname__', func), e)
+
+    def stop(self):
+        """Отменить задачи, остановить цикл и пулы"""
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = self._thread = None
+        if loop is not None:
+            async def _cancel_all():
+                tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+            try:
+                asyncio.run_coroutine_threadsafe(_cancel_all(), loop).result(10)
+            except Exception as e:
+                logger.warning("⚠️ Не все задачи завершились: %s", e)
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join(timeout=10)
+            loop.close()
+        for executor in (self.writer, self.readers, self.io):
+            executor.shutdown(wait=False)
+
+runtime = AsyncRuntime()
+
+async def db_read(func, *args, **kwargs):
+    """Выполнить чтение из БД в пуле читателей"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(runtime.readers, functools.partial(func, *args, **kwargs))
+
+async def db_write(func, *args, **kwargs):
+    """Выполнить запись в БД в единственном потоке записи"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(runtime.writer, functools.partial(func, *args, **kwargs))
 
 # =========== БАЗА ДАННЫХ ===========
+# Частота посещения (users.freq): в БД хранится код, пользователю показывается подпись
+FREQ_UNSET = 0
+FREQ_DAILY = 1
+FREQ_RARE = 2
+FREQ_LABELS = {FREQ_DAILY: 'Каждый день', FREQ_RARE: 'Я тут не каждый день'}
+# Вид сообщения в outbox: личное или объявление в групповом чате команды
+OUTBOX_DM = 'dm'
+OUTBOX_TEAM = 'team'
+
+# Миграции схемы: (версия, описание, функция(conn)). Применяются по возрастанию,
+# каждая в своей транзакции; номер последней примененной хранится в settings.
+# Уже выпущенные миграции не редактируются - только добавляются новые.
+# Миграции не онлайн: выполняются при запуске и на всю транзакцию держат
+# блокировку записи (миграция 2 пересобирает users целиком). Реплики прежней
+# версии с новой схемой не работают - обновлять все реплики вместе.
+MIGRATIONS: List[Tuple[int, str, Callable]] = []
+
+def migration(version: int, description: str):
+    """Регистрация миграции схемы"""
+    def register(func: Callable):
+        MIGRATIONS.append((version, description, func))
+        return func
+    return register
+
+@migration(1, 'базовая схема')
+def _migrate_base_schema(conn: sqlite3.Connection):
+    """Таблицы в том виде, в каком они были до появления миграций.
+
+    Все выражения идемпотентны: для старых баз это досоздание недостающего.
+    """
+    cursor = conn.cursor()
+    
+    # Таблица пользователей (точно по ТЗ)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            name TEXT,
+            chastota TEXT,
+            count_1 INTEGER DEFAULT 0,
+            count_2 INTEGER DEFAULT 0,
+            wait_1 INTEGER DEFAULT 0,
+            wait_2 INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            team_id INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    
+    # Старые базы: добавляем колонку команды
+    columns = {row[1] for row in cursor.execute('PRAGMA table_info(users)')}
+    if 'team_id' not in columns:
+        cursor.execute('ALTER TABLE users ADD COLUMN team_id INTEGER NOT NULL DEFAULT 0')
+    
+    # Таблица команд (офисов со своей кофемашиной)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS teams (
+            team_id INTEGER PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute(
+        'INSERT OR IGNORE INTO teams (team_id, name) VALUES (?, ?)',
+        (DEFAULT_TEAM_ID, DEFAULT_TEAM_NAME)
+    )
+    
+    # Таблица настроек для хранения состояния скриптов
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+    
+    # Состояния диалогов и user_data для теплых рестартов
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversations (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state TEXT NOT NULL,
+            PRIMARY KEY (name, key)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_data (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL
+        )
+    ''')
+    
+    # Журнал дежурств (только добавление) и накопленная статистика
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS duty_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            team_id INTEGER NOT NULL,
+            event TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_duty_events_created
+        ON duty_events (created_at)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_duty_events_user
+        ON duty_events (user_id)
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_stats (
+            user_id INTEGER PRIMARY KEY,
+            team_id INTEGER NOT NULL DEFAULT 0,
+            assigned INTEGER NOT NULL DEFAULT 0,
+            declined INTEGER NOT NULL DEFAULT 0,
+            completed INTEGER NOT NULL DEFAULT 0,
+            attended INTEGER NOT NULL DEFAULT 0,
+            last_duty_at TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_user_stats_leaderboard
+        ON user_stats (team_id, completed DESC, declined)
+    ''')
+    
+    # Расписания команд; команда без строки живет по расписанию по умолчанию
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS team_schedules (
+            team_id INTEGER PRIMARY KEY,
+            timezone TEXT NOT NULL DEFAULT 'UTC',
+            weekdays TEXT NOT NULL DEFAULT 'mon-fri',
+            morning TEXT NOT NULL DEFAULT '13:00',
+            evening TEXT NOT NULL DEFAULT '20:00'
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS team_holidays (
+            team_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            PRIMARY KEY (team_id, day)
+        ) WITHOUT ROWID
+    ''')
+    
+    # Аренды (выбор лидера среди реплик)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            token INTEGER NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+    
+    # Очередь исходящих сообщений
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            sent_at TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_outbox_due
+        ON outbox (status, next_attempt_at)
+    ''')
+    
+    # Инициализация настроек
+    cursor.execute('''
+        INSERT OR IGNORE INTO settings (key, value) 
+        VALUES ('scripts_enabled', '1')
+    ''')
+
+@migration(2, 'частота кодом, CHECK на флагах, частичные индексы users')
+def _migrate_compact_users(conn: sqlite3.Connection):
+    """Пересборка users: chastota TEXT -> freq INTEGER и ограничения на флаги.
+
+    SQLite не умеет добавлять CHECK к существующей таблице, поэтому строки
+    копируются в новую таблицу (значения флагов приводятся к 0/1) и она
+    занимает место старой. Индексы users создаются заново.
+    """
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        CREATE TABLE users_new (
+            user_id INTEGER PRIMARY KEY,
+            name TEXT,
+            freq INTEGER NOT NULL DEFAULT {FREQ_UNSET}
+                CHECK (freq IN ({FREQ_UNSET}, {FREQ_DAILY}, {FREQ_RARE})),
+            count_1 INTEGER NOT NULL DEFAULT 0 CHECK (count_1 >= 0),
+            count_2 INTEGER NOT NULL DEFAULT 0 CHECK (count_2 IN (0, 1)),
+            wait_1 INTEGER NOT NULL DEFAULT 0 CHECK (wait_1 IN (0, 1)),
+            wait_2 INTEGER NOT NULL DEFAULT 0 CHECK (wait_2 IN (0, 1)),
+            team_id INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute(
+        f'''INSERT INTO users_new
+                (user_id, name, freq, count_1, count_2, wait_1, wait_2, team_id, created_at)
+            SELECT user_id, name,
+                   CASE chastota WHEN ? THEN {FREQ_DAILY} WHEN ? THEN {FREQ_RARE}
+                                 ELSE {FREQ_UNSET} END,
+                   MAX(COALESCE(count_1, 0), 0),
+                   COALESCE(count_2, 0) != 0,
+                   COALESCE(wait_1, 0) != 0,
+                   COALESCE(wait_2, 0) != 0,
+                   team_id, created_at
+            FROM users''',
+        (FREQ_LABELS[FREQ_DAILY], FREQ_LABELS[FREQ_RARE])
+    )
+    logger.info("🔧 Перенесено пользователей: %d", cursor.rowcount)
+    cursor.execute('DROP TABLE users')
+    cursor.execute('ALTER TABLE users_new RENAME TO users')
+    
+    # Поиск и снятие дежурных, перевыбор с OR по user_id
+    cursor.execute('CREATE INDEX idx_users_team_duty ON users (team_id, count_2)')
+    # Частичные индексы под условия скриптов: в них только подходящие строки.
+    # Условия в запросах должны совпадать с WHERE индекса буквально (без параметров).
+    # script_2: MAX(count_1) среди активных команды
+    cursor.execute('''
+        CREATE INDEX idx_users_duty_pick ON users (team_id, count_1)
+        WHERE wait_1 = 0 AND wait_2 = 0
+    ''')
+    # script_1: ежедневные на месте
+    cursor.execute(f'''
+        CREATE INDEX idx_users_daily_present ON users (team_id)
+        WHERE freq = {FREQ_DAILY} AND wait_1 = 0
+    ''')
+    # script_5: редкие, которые отметились
+    cursor.execute(f'''
+        CREATE INDEX idx_users_rare_present ON users (team_id)
+        WHERE freq = {FREQ_RARE} AND wait_1 = 0
+    ''')
+    # script_3: отказавшиеся сегодня
+    cursor.execute('''
+        CREATE INDEX idx_users_declined ON users (team_id)
+        WHERE wait_2 = 1
+    ''')
+
+@migration(3, 'групповые чаты команд и личные уведомления по выбору')
+def _migrate_team_chats(conn: sqlite3.Connection):
+    """Групповой чат команды и сегодняшнее закрепленное объявление в нем"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE team_chats (
+            team_id INTEGER PRIMARY KEY,
+            chat_id INTEGER NOT NULL UNIQUE,
+            message_id INTEGER,
+            posted_on TEXT,
+            text TEXT
+        )
+    ''')
+    # Участник команды с группой все равно хочет объявление в личку
+    cursor.execute(
+        'ALTER TABLE users ADD COLUMN prefers_dm INTEGER NOT NULL DEFAULT 0 CHECK (prefers_dm IN (0, 1))'
+    )
+    cursor.execute(f"ALTER TABLE outbox ADD COLUMN kind TEXT NOT NULL DEFAULT '{OUTBOX_DM}'")
+
+SCHEMA_VERSION = max(version for version, _, _ in MIGRATIONS)
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    """Номер последней примененной миграции (0 - новая база или база до миграций)"""
+    try:
+        row = conn.execute("SELECT value FROM settings WHERE key = 'schema_version'").fetchone()
+    except sqlite3.OperationalError:
+        # Таблицы settings еще нет
+        return 0
+    return int(row[0]) if row else 0
+
 def init_database():
-    """Инициализация базы данных SQLite"""
+    """Инициализация базы данных SQLite: применение недостающих миграций"""
     try:
-        conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-        cursor = conn.cursor()
+        current = get_schema_version(db.get())
+        if current >= SCHEMA_VERSION:
+            if current > SCHEMA_VERSION:
+                logger.warning("⚠️ Схема БД новее кода: %s > %s", current, SCHEMA_VERSION)
+            logger.info("✅ Схема БД актуальна (версия %s)", current)
+            return
         
-        # Таблица пользователей (точно по ТЗ)
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                name TEXT,
-                chastota TEXT,
-                count_1 INTEGER DEFAULT 0,
-                count_2 INTEGER DEFAULT 0,
-                wait_1 INTEGER DEFAULT 0,
-                wait_2 INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        for version, description, migrate in sorted(MIGRATIONS, key=lambda m: m[0]):
+            if version <= current:
+                continue
+            started = time.perf_counter()
+            with db.transaction() as conn:
+                # Другая реплика могла применить миграцию, пока мы ждали блокировку
+                if get_schema_version(conn) >= version:
+                    continue
+                migrate(conn)
+                conn.execute(
+                    '''INSERT INTO settings (key, value) VALUES ('schema_version', ?)
+                       ON CONFLICT(key) DO UPDATE SET value = excluded.value''',
+                    (str(version),)
+                )
+            logger.info(
+                "🔧 Миграция %s (%s) применена за %.0f мс",
+                version, description, (time.perf_counter() - started) * 1000
             )
-        ''')
-        
-        # Таблица настроек для хранения состояния скриптов
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS settings (
-                key TEXT PRIMARY KEY,
-                value TEXT
-            )
-        ''')
-        
-        # Инициализация настроек
-        cursor.execute('''
-            INSERT OR IGNORE INTO settings (key, value) 
-            VALUES ('scripts_enabled', '1')
-        ''')
-        
-        conn.commit()
-        conn.close()
-        logger.info("✅ База данных инициализирована")
+        logger.info("✅ База данных инициализирована (версия схемы %s)", SCHEMA_VERSION)
         
     except Exception as e:
-        logger.error(f"❌ Ошибка инициализации БД: {e}")
+        logger.error("❌ Ошибка инициализации БД: %s", e)
         sys.exit(1)
 
 def execute_query(query: str, params: Tuple = (), 
                   fetchone: bool = False, fetchall: bool = False, 
                   commit: bool = False):
-    """Универсальная функция выполнения SQL-запросов"""
+    """Универсальная функция выполнения SQL-запросов.
+
+    Внутри db.transaction() фиксация откладывается до конца блока,
+    а ошибка пробрасывается наружу, чтобы откатить всю транзакцию.
+    """
+    conn = db.get()
+    started = time.perf_counter()
     try:
-        conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-        cursor = conn.cursor()
-        
-        cursor.execute(query, params)
-        
-        if commit:
-            conn.commit()
+        cursor = conn.execute(query, params)
         
         if fetchone:
             result = cursor.fetchone()
@@ -156,49 +1018,216 @@ def execute_query(query: str, params: Tuple = (),
         else:
             result = None
         
-        conn.close()
+        if commit and not db.in_transaction():
+            conn.commit()
+        
         return result
         
     except Exception as e:
-        logger.error(f"❌ Ошибка SQL-запроса: {e}")
+        SQL_ERRORS.inc(statement_label(query))
+        logger.error("❌ Ошибка SQL-запроса: %s", e)
+        if db.in_transaction():
+            raise
+        if conn.in_transaction:
+            conn.rollback()
         return None
+    
+    finally:
+        SQL_SECONDS.observe(time.perf_counter() - started, statement_label(query))
 
 # =========== ФУНКЦИИ ДЛЯ РАБОТЫ С БД (по ТЗ) ===========
+USER_FIELDS = ('user_id', 'name', 'freq', 'count_1', 'count_2', 'wait_1', 'wait_2', 'team_id', 'prefers_dm')
+USER_SELECT = f'SELECT {", ".join(USER_FIELDS)} FROM users'
+
+# Команды, в которых выполняется скрипт: None - все, число - одна, список - несколько
+# (планировщик передает сразу все команды с общим временем запуска)
+Teams = Optional[Union[int, Sequence[int]]]
+
+# =========== КЭШ ПОЛЬЗОВАТЕЛЕЙ ===========
+# Таблица users маленькая, поэтому интерактивные чтения обслуживаются из памяти.
+# Свои записи сбрасывают затронутые ключи сразу. Записи других реплик
+# (MULTI_REPLICA=1) видны по PRAGMA data_version: если db.changed_elsewhere(),
+# кэш сбрасывается целиком перед следующим чтением вне транзакции.
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', '10000'))
+_MISSING = object()
+
+class UserRecord:
+    """Компактная запись пользователя в кэше"""
+    __slots__ = USER_FIELDS
+
+    def __init__(self, row: Tuple):
+        for field, value in zip(USER_FIELDS, row):
+            setattr(self, field, value)
+
+    def as_dict(self) -> Dict:
+        return {field: getattr(self, field) for field in USER_FIELDS}
+
+class UserCache:
+    """LRU-кэш записей пользователей, дежурных по командам и флага скриптов.
+
+    Любая запись в БД сбрасывает затронутые ключи (сразу и повторно после
+    завершения транзакции). Счетчик поколений не дает читателю положить
+    в кэш строку, прочитанную до конкурентной записи.
+    """
+
+    def __init__(self, max_size: int = USER_CACHE_SIZE):
+        self.max_size = max_size
+        self._users: 'OrderedDict[int, Optional[UserRecord]]' = OrderedDict()
+        self._duty: Dict[int, Optional[Tuple[int, str]]] = {}
+        self._scripts_enabled: Optional[bool] = None
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def _sync(self):
+        """С несколькими репликами сбросить все, если БД меняли другие соединения"""
+        if MULTI_REPLICA and not db.in_transaction() and db.changed_elsewhere():
+            self._drop(None, True)
+            with self._lock:
+                self._scripts_enabled = None
+
+    def _lookup(self, table: Dict, key):
+        self._sync()
+        with self._lock:
+            value = table.get(key, _MISSING)
+            if value is _MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+                if table is self._users:
+                    self._users.move_to_end(key)
+            return value
+
+    def _store(self, table: Dict, key, value, generation: int):
+        # Внутри транзакции читаются незафиксированные данные - не кэшируем
+        if db.in_transaction():
+            return
+        with self._lock:
+            if generation != self._generation:
+                return
+            table[key] = value
+            if table is self._users and len(self._users) > self.max_size:
+                self._users.popitem(last=False)
+                self.evictions += 1
+
+    def get_user(self, user_id: int):
+        return self._lookup(self._users, user_id)
+
+    def put_user(self, user_id: int, record: Optional[UserRecord], generation: int):
+        self._store(self._users, user_id, record, generation)
+
+    def get_duty(self, team_id: int):
+        return self._lookup(self._duty, team_id)
+
+    def put_duty(self, team_id: int, duty: Optional[Tuple[int, str]], generation: int):
+        self._store(self._duty, team_id, duty, generation)
+
+    def get_scripts_enabled(self):
+        self._sync()
+        with self._lock:
+            return _MISSING if self._scripts_enabled is None else self._scripts_enabled
+
+    def set_scripts_enabled(self, enabled: Optional[bool]):
+        with self._lock:
+            self._scripts_enabled = enabled
+
+    def _drop(self, user_id: Optional[int], duty: bool):
+        with self._lock:
+            self._generation += 1
+            if user_id is None:
+                self._users.clear()
+            else:
+                self._users.pop(user_id, None)
+            if duty:
+                self._duty.clear()
+
+    def invalidate_user(self, user_id: int, duty: bool = False):
+        """Сбросить запись пользователя (и дежурных, если менялось дежурство)"""
+        self._drop(user_id, duty)
+        db.after_transaction(lambda: self._drop(user_id, duty))
+
+    def invalidate_all(self):
+        """Сбросить все записи (массовые UPDATE скриптов)"""
+        self._drop(None, True)
+        db.after_transaction(lambda: self._drop(None, True))
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'size': len(self._users),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+user_cache = UserCache()
+
 def get_user_data(user_id: int):
     """Получить данные пользователя по user_id"""
-    result = execute_query(
-        'SELECT * FROM users WHERE user_id = ?',
-        (user_id,),
-        fetchone=True
-    )
-    if result:
-        return {
-            'user_id': result[0],
-            'name': result[1],
-            'chastota': result[2],
-            'count_1': result[3],
-            'count_2': result[4],
-            'wait_1': result[5],
-            'wait_2': result[6]
-        }
-    return None
+    record = user_cache.get_user(user_id)
+    if record is _MISSING:
+        generation = user_cache.generation
+        result = execute_query(
+            f'{USER_SELECT} WHERE user_id = ?',
+            (user_id,),
+            fetchone=True
+        )
+        record = UserRecord(result) if result else None
+        user_cache.put_user(user_id, record, generation)
+    return record.as_dict() if record else None
+
+# Колонки, которые разрешено менять через update_user
+USER_COLUMNS = frozenset({'name', 'freq', 'count_1', 'count_2', 'wait_1', 'wait_2', 'team_id', 'prefers_dm'})
+
+class Increment:
+    """Атомарный прирост колонки: update_user(uid, count_1=Increment(1))"""
+    __slots__ = ('delta',)
+
+    def __init__(self, delta: int = 1):
+        self.delta = delta
 
 def update_user(user_id: int, **kwargs):
-    """Обновить данные пользователя"""
+    """Обновить данные пользователя одним UPDATE"""
+    if not kwargs:
+        return
+    
+    assignments = []
+    params = []
     for key, value in kwargs.items():
-        execute_query(
-            f'UPDATE users SET {key} = ? WHERE user_id = ?',
-            (value, user_id),
-            commit=True
-        )
-
-def delete_user(user_id: int):
-    """Удалить пользователя из базы"""
+        if key not in USER_COLUMNS:
+            raise ValueError(f"Недопустимая колонка users: {key}")
+        if isinstance(value, Increment):
+            assignments.append(f'{key} = {key} + ?')
+            params.append(value.delta)
+        else:
+            assignments.append(f'{key} = ?')
+            params.append(value)
+    params.append(user_id)
+    
     execute_query(
-        'DELETE FROM users WHERE user_id = ?',
-        (user_id,),
+        f'UPDATE users SET {", ".join(assignments)} WHERE user_id = ?',
+        tuple(params),
         commit=True
     )
+    user_cache.invalidate_user(user_id, duty=not kwargs.keys().isdisjoint({'count_2', 'name', 'team_id'}))
+
+def delete_user(user_id: int):
+    """Удалить пользователя из базы вместе с историей"""
+    with db.transaction():
+        execute_query(
+            'DELETE FROM users WHERE user_id = ?',
+            (user_id,),
+            commit=True
+        )
+        execute_query('DELETE FROM duty_events WHERE user_id = ?', (user_id,), commit=True)
+        execute_query('DELETE FROM user_stats WHERE user_id = ?', (user_id,), commit=True)
+    user_cache.invalidate_user(user_id, duty=True)
 
 def create_user(user_id: int):
     """Создать новую запись пользователя"""
@@ -209,47 +1238,136 @@ def create_user(user_id: int):
             (user_id,),
             commit=True
         )
+        user_cache.invalidate_user(user_id)
 
 def get_all_users():
     """Получить всех пользователей"""
-    results = execute_query('SELECT * FROM users', fetchall=True)
-    users = []
-    for row in results or []:
-        users.append({
-            'user_id': row[0],
-            'name': row[1],
-            'chastota': row[2],
-            'count_1': row[3],
-            'count_2': row[4],
-            'wait_1': row[5],
-            'wait_2': row[6]
-        })
-    return users
-
-def get_active_users():
-    """Получить активных пользователей (wait_1 = 0 AND wait_2 = 0)"""
+    results = execute_query(USER_SELECT, fetchall=True)
+    return [dict(zip(USER_FIELDS, row)) for row in results or []]
+
+def get_announcement_recipients(teams: Teams = None):
+    """Активные пользователи для объявления дежурного: (user_id, team_id, prefers_dm)"""
+    where, params = team_filter(teams)
     results = execute_query(
-        'SELECT user_id, name FROM users WHERE wait_1 = 0 AND wait_2 = 0',
+        f'SELECT user_id, team_id, prefers_dm FROM users WHERE wait_1 = 0 AND wait_2 = 0{where}',
+        params,
         fetchall=True
     )
     return results or []
 
-def get_duty_user():
-    """Получить текущего дежурного (count_2 = 1)"""
+def get_duty_user(team_id: int = DEFAULT_TEAM_ID):
+    """Получить текущего дежурного команды (count_2 = 1)"""
+    result = user_cache.get_duty(team_id)
+    if result is _MISSING:
+        generation = user_cache.generation
+        result = execute_query(
+            'SELECT user_id, name FROM users WHERE team_id = ? AND count_2 = 1',
+            (team_id,),
+            fetchone=True
+        )
+        user_cache.put_duty(team_id, result, generation)
+    return result
+
+def get_duty_users() -> Dict[int, Tuple[int, str]]:
+    """Дежурные всех команд одним запросом: {team_id: (user_id, name)}"""
+    results = execute_query(
+        'SELECT team_id, user_id, name FROM users WHERE count_2 = 1',
+        fetchall=True
+    )
+    return {team_id: (user_id, name) for team_id, user_id, name in results or []}
+
+# =========== КОМАНДЫ (ОФИСЫ) ===========
+def get_team_name(team_id: int) -> Optional[str]:
+    """Название команды по team_id"""
     result = execute_query(
-        'SELECT user_id, name FROM users WHERE count_2 = 1',
+        'SELECT name FROM teams WHERE team_id = ?',
+        (team_id,),
         fetchone=True
     )
-    return result
+    return result[0] if result else None
 
-def get_scripts_enabled():
-    """Получить статус включения скриптов"""
+def get_or_create_team(name: str) -> int:
+    """Найти команду по названию или создать новую"""
+    with db.transaction():
+        execute_query(
+            'INSERT OR IGNORE INTO teams (name) VALUES (?)',
+            (name,),
+            commit=True
+        )
+        result = execute_query(
+            'SELECT team_id FROM teams WHERE name = ?',
+            (name,),
+            fetchone=True
+        )
+    # Новой команде нужны записи в индексе расписаний
+    db.after_transaction(lambda: schedule_index.mark_dirty(result[0]))
+    return result[0]
+
+def set_user_team(user_id: int, team_id: int):
+    """Перевести пользователя в другую команду (дежурство в старой снимается)"""
+    with db.transaction():
+        update_user(user_id, team_id=team_id, count_2=0)
+        execute_query(
+            'UPDATE user_stats SET team_id = ? WHERE user_id = ?',
+            (team_id, user_id),
+            commit=True
+        )
+
+def get_team_chats() -> Dict[int, int]:
+    """Групповые чаты команд: {team_id: chat_id}"""
+    rows = execute_query('SELECT team_id, chat_id FROM team_chats', fetchall=True)
+    return dict(rows or [])
+
+def get_team_chat(chat_id: int) -> Optional[Tuple[int, Optional[int], Optional[str], Optional[str]]]:
+    """Команда чата и последнее объявление в нем: (team_id, message_id, posted_on, text)"""
+    return execute_query(
+        'SELECT team_id, message_id, posted_on, text FROM team_chats WHERE chat_id = ?',
+        (chat_id,),
+        fetchone=True
+    )
+
+def set_team_chat(team_id: int, chat_id: int):
+    """Назначить групповой чат команды (чат может принадлежать только одной команде)"""
+    with db.transaction():
+        execute_query('DELETE FROM team_chats WHERE chat_id = ? OR team_id = ?', (chat_id, team_id), commit=True)
+        execute_query(
+            'INSERT INTO team_chats (team_id, chat_id) VALUES (?, ?)',
+            (team_id, chat_id),
+            commit=True
+        )
+
+def remove_team_chat(chat_id: int) -> bool:
+    """Отвязать групповой чат; False - чат не был привязан"""
+    with db.transaction():
+        if not get_team_chat(chat_id):
+            return False
+        execute_query('DELETE FROM team_chats WHERE chat_id = ?', (chat_id,), commit=True)
+    return True
+
+def save_team_chat_post(chat_id: int, message_id: int, posted_on: str, text: str):
+    """Запомнить сегодняшнее объявление чата, чтобы перевыбор правил его на месте"""
+    execute_query(
+        'UPDATE team_chats SET message_id = ?, posted_on = ?, text = ? WHERE chat_id = ?',
+        (message_id, posted_on, text, chat_id),
+        commit=True
+    )
+
+def read_scripts_enabled() -> bool:
+    """Статус включения скриптов прямо из settings, мимо кэша"""
     result = execute_query(
         'SELECT value FROM settings WHERE key = ?',
         ('scripts_enabled',),
         fetchone=True
     )
-    return result and result[0] == '1'
+    return bool(result and result[0] == '1')
+
+def get_scripts_enabled():
+    """Получить статус включения скриптов"""
+    enabled = user_cache.get_scripts_enabled()
+    if enabled is _MISSING:
+        enabled = read_scripts_enabled()
+        user_cache.set_scripts_enabled(enabled)
+    return enabled
 
 def set_scripts_enabled(enabled: bool):
     """Установить статус включения скриптов"""
@@ -259,171 +1377,1445 @@ def set_scripts_enabled(enabled: bool):
         (value, 'scripts_enabled'),
         commit=True
     )
+    user_cache.set_scripts_enabled(enabled)
     global SCRIPTS_ENABLED
     SCRIPTS_ENABLED = enabled
-    logger.info(f"✅ Скрипты {'включены' if enabled else 'отключены'}")
+    logger.info("✅ Скрипты %s", 'включены' if enabled else 'отключены')
 
-# =========== СКРИПТЫ (ТОЧНО ПО ТЗ) ===========
-def script_1():
-    """Скрипт_1 (прирост кофе)"""
+def get_setting(key: str) -> Optional[str]:
+    """Прочитать значение из таблицы settings"""
+    result = execute_query(
+        'SELECT value FROM settings WHERE key = ?',
+        (key,),
+        fetchone=True
+    )
+    return result[0] if result else None
+
+# =========== ЖУРНАЛ ДЕЖУРСТВ И СТАТИСТИКА ===========
+# Событие -> колонка счетчика в user_stats
+DUTY_EVENTS = {
+    'assigned': 'assigned',
+    'declined': 'declined',
+    'completed': 'completed',
+    'attended': 'attended',
+}
+# Сколько дней хранить подробный журнал (сводка в user_stats хранится всегда)
+EVENT_RETENTION_DAYS = int(os.environ.get('EVENT_RETENTION_DAYS', '90'))
+
+def record_events(event: str, source_sql: str, params: Tuple = ()):
+    """Записать событие для каждой строки source_sql (SELECT user_id, team_id ...)
+    и тут же увеличить счетчик в user_stats.
+
+    Вызывается внутри транзакции изменения состояния - до самого UPDATE,
+    пока выборка еще видит прежнее состояние.
+    """
+    column = DUTY_EVENTS[event]
+    last_duty = ', last_duty_at = CURRENT_TIMESTAMP' if event == 'completed' else ''
     execute_query(
-        '''UPDATE users 
-           SET count_1 = count_1 + 1 
-           WHERE chastota = 'Каждый день' AND wait_1 = 0''',
+        f'''INSERT INTO duty_events (user_id, team_id, event)
+            SELECT user_id, team_id, ? FROM ({source_sql})''',
+        (event, *params),
         commit=True
     )
-    logger.info("✅ Скрипт_1: Прирост кофе выполнен")
+    execute_query(
+        f'''INSERT INTO user_stats (user_id, team_id, {column})
+            SELECT user_id, team_id, 1 FROM ({source_sql}) WHERE true
+            ON CONFLICT (user_id) DO UPDATE SET
+                {column} = {column} + 1, team_id = excluded.team_id{last_duty}''',
+        params,
+        commit=True
+    )
+
+def record_user_event(event: str, user_id: int):
+    """Событие одного пользователя"""
+    record_events(event, 'SELECT user_id, team_id FROM users WHERE user_id = ?', (user_id,))
 
-def script_2():
-    """Скрипт_2 (поиск дежурного)"""
-    # Найти максимальное значение count_1 среди активных пользователей
+def get_user_stats(user_id: int) -> Dict[str, int]:
+    """Накопленная статистика пользователя (поиск по первичному ключу)"""
     result = execute_query(
-        '''SELECT MAX(count_1) FROM users 
-           WHERE wait_1 = 0 AND wait_2 = 0''',
+        'SELECT assigned, declined, completed, attended FROM user_stats WHERE user_id = ?',
+        (user_id,),
         fetchone=True
+    ) or (0, 0, 0, 0)
+    return dict(zip(('assigned', 'declined', 'completed', 'attended'), result))
+
+def get_leaderboard(team_id: int, limit: int = 10) -> List[Tuple]:
+    """Лучшие дежурные команды по индексу idx_user_stats_leaderboard"""
+    return execute_query(
+        '''SELECT s.user_id, u.name, s.completed, s.declined, s.assigned
+           FROM user_stats s JOIN users u ON u.user_id = s.user_id
+           WHERE s.team_id = ?
+           ORDER BY s.completed DESC, s.declined
+           LIMIT ?''',
+        (team_id, limit),
+        fetchall=True
+    ) or []
+
+def compact_events(retention_days: int = EVENT_RETENTION_DAYS):
+    """Удалить из журнала события старше срока хранения"""
+    execute_query(
+        "DELETE FROM duty_events WHERE created_at < datetime('now', ?)",
+        (f'-{retention_days} days',),
+        commit=True
     )
+    logger.info("✅ Журнал дежурств сжат: события старше %s дн. удалены", retention_days)
+
+# =========== СКРИПТЫ (ТОЧНО ПО ТЗ) ===========
+def team_filter(teams: Teams) -> Tuple[str, Tuple]:
+    """Условие по команде (' AND team_id = ?' или ' AND team_id IN (...)') и его параметры"""
+    if teams is None:
+        return '', ()
+    if isinstance(teams, int):
+        return ' AND team_id = ?', (teams,)
+    teams = tuple(teams)
+    return f' AND team_id IN ({", ".join("?" * len(teams))})', teams
+
+@timed(SCRIPT_SECONDS, 'script_1')
+def script_1(teams: Teams = None):
+    """Скрипт_1 (прирост кофе)"""
+    where, params = team_filter(teams)
+    with db.transaction():
+        record_events(
+            'attended',
+            f'''SELECT user_id, team_id FROM users
+                WHERE freq = {FREQ_DAILY} AND wait_1 = 0{where}''',
+            params
+        )
+        execute_query(
+            f'''UPDATE users 
+                SET count_1 = count_1 + 1 
+                WHERE freq = {FREQ_DAILY} AND wait_1 = 0{where}''',
+            params,
+            commit=True
+        )
+    user_cache.invalidate_all()
+    logger.info("✅ Скрипт_1: Прирост кофе выполнен")
+
+@timed(SCRIPT_SECONDS, 'script_2')
+def script_2(teams: Teams = None):
+    """Скрипт_2 (поиск дежурного)
+
+    Дежурным становится случайный из активных с максимальным count_1;
+    прежний дежурный команды снимается тем же UPDATE, так что дежурный
+    всегда один. Для списка команд (или всех) выбор идет одним набором запросов.
+    """
+    if isinstance(teams, int):
+        return _pick_team_duty(teams)
     
-    max_count = result[0] if result and result[0] is not None else 0
+    where, params = team_filter(teams)
+    with db.transaction():
+        execute_query(
+            '''CREATE TEMP TABLE IF NOT EXISTS duty_pick (
+                   team_id INTEGER PRIMARY KEY,
+                   user_id INTEGER
+               )'''
+        )
+        execute_query('DELETE FROM duty_pick')
+        # Найти максимальный count_1 по командам и случайного кандидата с ним
+        execute_query(
+            f'''INSERT INTO duty_pick (team_id, user_id)
+                SELECT t.team_id,
+                       (SELECT u.user_id FROM users u
+                        WHERE u.team_id = t.team_id AND u.wait_1 = 0 AND u.wait_2 = 0
+                          AND u.count_1 = t.max_count
+                        ORDER BY random() LIMIT 1)
+                FROM (SELECT team_id, MAX(count_1) AS max_count FROM users
+                      WHERE wait_1 = 0 AND wait_2 = 0{where}
+                      GROUP BY team_id) t
+                WHERE t.max_count > 0''',
+            params
+        )
+        # Назначить дежурными, сняв прежних в тех же командах
+        execute_query(
+            '''UPDATE users SET count_2 = (user_id IN (SELECT user_id FROM duty_pick))
+               WHERE team_id IN (SELECT team_id FROM duty_pick)
+                 AND (count_2 = 1 OR user_id IN (SELECT user_id FROM duty_pick))''',
+            commit=True
+        )
+        chosen = execute_query('SELECT team_id, user_id FROM duty_pick', fetchall=True) or []
+        record_events('assigned', 'SELECT user_id, team_id FROM duty_pick')
+        user_cache.invalidate_all()
     
-    if max_count > 0:
-        # Найти всех пользователей с максимальным count_1
-        candidates = execute_query(
-            '''SELECT user_id FROM users 
-               WHERE count_1 = ? AND wait_1 = 0 AND wait_2 = 0''',
-            (max_count,),
-            fetchall=True
+    for chosen_team, chosen_user in chosen:
+        logger.info("✅ Скрипт_2: Выбран дежурный user_id=%s (команда %s)", chosen_user, chosen_team)
+
+def _pick_team_duty(team_id: int):
+    """Перевыбор дежурного одной команды по индексу idx_users_duty_pick"""
+    with db.transaction():
+        # MAX по индексу - один спуск по дереву, затем случайный среди равных
+        winner = execute_query(
+            '''SELECT user_id FROM users
+               WHERE team_id = ?1 AND wait_1 = 0 AND wait_2 = 0 AND count_1 > 0
+                 AND count_1 = (SELECT MAX(count_1) FROM users
+                                WHERE team_id = ?1 AND wait_1 = 0 AND wait_2 = 0)
+               ORDER BY random() LIMIT 1''',
+            (team_id,),
+            fetchone=True
         )
-        
-        if candidates:
-            # Выбрать случайного из кандидатов
-            chosen_user = random.choice(candidates)[0]
-            # Назначить дежурным
-            execute_query(
-                'UPDATE users SET count_2 = 1 WHERE user_id = ?',
-                (chosen_user,),
-                commit=True
-            )
-            logger.info(f"✅ Скрипт_2: Выбран дежурный user_id={chosen_user}")
+        if not winner:
+            return
+        chosen_user = winner[0]
+        # Назначить дежурным и снять прежнего одним UPDATE
+        execute_query(
+            '''UPDATE users SET count_2 = (user_id = ?1)
+               WHERE team_id = ?2 AND (count_2 = 1 OR user_id = ?1)''',
+            (chosen_user, team_id),
+            commit=True
+        )
+        record_user_event('assigned', chosen_user)
+        user_cache.invalidate_all()
+    
+    logger.info("✅ Скрипт_2: Выбран дежурный user_id=%s (команда %s)", chosen_user, team_id)
 
-def script_3():
+@timed(SCRIPT_SECONDS, 'script_3')
+def script_3(teams: Teams = None):
     """Скрипт_3 (обнуление Печальки)"""
+    where, params = team_filter(teams)
     execute_query(
-        'UPDATE users SET wait_2 = 0 WHERE wait_2 = 1',
+        f'UPDATE users SET wait_2 = 0 WHERE wait_2 = 1{where}',
+        params,
         commit=True
     )
+    user_cache.invalidate_all()
     logger.info("✅ Скрипт_3: Обнуление Печальки")
 
-def script_4():
+@timed(SCRIPT_SECONDS, 'script_4')
+def script_4(teams: Teams = None):
     """Скрипт_4 (погашение дежурства)"""
-    execute_query(
-        'UPDATE users SET count_2 = 0, count_1 = 0 WHERE count_2 = 1',
-        commit=True
-    )
+    where, params = team_filter(teams)
+    with db.transaction():
+        record_events('completed', f'SELECT user_id, team_id FROM users WHERE count_2 = 1{where}', params)
+        execute_query(
+            f'UPDATE users SET count_2 = 0, count_1 = 0 WHERE count_2 = 1{where}',
+            params,
+            commit=True
+        )
+    user_cache.invalidate_all()
     logger.info("✅ Скрипт_4: Погашение дежурства")
 
-def script_5():
+@timed(SCRIPT_SECONDS, 'script_5')
+def script_5(teams: Teams = None):
     """Скрипт_5 (уход домой неполнозанятых)"""
+    where, params = team_filter(teams)
     execute_query(
-        '''UPDATE users SET wait_1 = 1 
-           WHERE chastota = 'Я тут не каждый день' AND wait_1 = 0''',
+        f'''UPDATE users SET wait_1 = 1 
+            WHERE freq = {FREQ_RARE} AND wait_1 = 0{where}''',
+        params,
         commit=True
     )
+    user_cache.invalidate_all()
     logger.info("✅ Скрипт_5: Уход домой неполнозанятых")
 
-def script_6():
-    """Скрипт_6 (информирование)"""
-    duty = get_duty_user()
+def duty_announcements(teams: Teams = None):
+    """Дежурные команд и сообщения о них.
+
+    Возвращает ({team_id: (user_id, name)}, личные [(chat_id, text), ...],
+    групповые [(chat_id, text), ...], число личных сообщений, замененных
+    объявлением в группе). Команда с групповым чатом получает одно объявление
+    в группе, а в личку пишем только тем, кто выбрал /notify dm.
+    """
+    if isinstance(teams, int):
+        duty = get_duty_user(teams)
+        duties = {teams: duty} if duty else {}
+    else:
+        duties = get_duty_users()
+        if teams is not None:
+            duties = {duty_team: duty for duty_team, duty in duties.items() if duty_team in set(teams)}
     
-    if duty:
-        duty_user_id, duty_name = duty
-        active_users = get_active_users()
-        
-        # Получаем глобальный объект бота для отправки сообщений
-        global updater_instance
-        if updater_instance and updater_instance.bot:
-            bot = updater_instance.bot
-            for user_id, user_name in active_users:
-                try:
-                    bot.send_message(
-                        chat_id=user_id,
-                        text=f"☕ Сегодня дежурный: {duty_name if duty_name else f'Пользователь {duty_user_id}'}"
-                    )
-                except Exception as e:
-                    logger.error(f"❌ Не удалось отправить сообщение {user_id}: {e}")
+    texts = {
+        duty_team: f"☕ Сегодня дежурный: {duty_name if duty_name else f'Пользователь {duty_user_id}'}"
+        for duty_team, (duty_user_id, duty_name) in duties.items()
+    }
+    if not texts:
+        return duties, [], [], 0
+    chats = {chat_team: chat_id for chat_team, chat_id in get_team_chats().items() if chat_team in texts}
+    
+    messages = []
+    skipped = 0
+    for user_id, member_team, prefers_dm in get_announcement_recipients(teams):
+        if member_team not in texts:
+            continue
+        if member_team in chats and not prefers_dm:
+            skipped += 1
+            continue
+        messages.append((user_id, texts[member_team]))
+    posts = [(chat_id, texts[chat_team]) for chat_team, chat_id in chats.items()]
+    return duties, messages, posts, skipped
+
+@timed(SCRIPT_SECONDS, 'script_6')
+def script_6(teams: Teams = None):
+    """Скрипт_6 (информирование)
+
+    Каждый активный пользователь узнает дежурного своей команды.
+    """
+    duties, messages, posts, skipped = duty_announcements(teams)
+    
+    if duties:
+        # Доставкой займется разборщик outbox после фиксации транзакции
+        queued = enqueue_announcement(messages, posts, skipped)
+        # Цикл мог откатиться - тогда объявленным никто не считается
+        db.after_commit(lambda: duty_announcer.remember(duties))
+        logger.info("✅ Скрипт_6: Уведомлений в очереди: %d", queued)
+        return queued
+
+# =========== РАССЫЛКА УВЕДОМЛЕНИЙ ===========
+# Лимиты Telegram: ~30 сообщений/с на бота и ~1 сообщение/с в один чат
+BROADCAST_WORKERS = int(os.environ.get('BROADCAST_WORKERS', '8'))
+BROADCAST_GLOBAL_RATE = float(os.environ.get('BROADCAST_GLOBAL_RATE', '25'))
+BROADCAST_CHAT_INTERVAL = 1.0
+BROADCAST_MAX_RETRIES = 3
+BROADCAST_BACKOFF = 0.5
+
+class TokenBucket:
+    """Ведро токенов: не более rate операций в секунду, всплеск до capacity"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Забронировать токен; возвращает, сколько секунд ждать до него"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+class ChatRateLimiter:
+    """Минимальный интервал между сообщениями в один и тот же чат"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._next_allowed: Dict[int, float] = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, chat_id: int) -> float:
+        """Забронировать слот чата; возвращает, сколько секунд ждать до него"""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_allowed.get(chat_id, 0.0))
+            self._next_allowed[chat_id] = slot + self.interval
+            if len(self._next_allowed) > 10000:
+                self._next_allowed = {
+                    cid: t for cid, t in self._next_allowed.items() if t > now
+                }
+        return slot - now
+
+# Итог отправки одного сообщения
+SEND_OK = 'sent'
+SEND_REJECTED = 'rejected'   # Telegram отказал окончательно: повторять бессмысленно
+SEND_GAVE_UP = 'gave_up'     # временные ошибки не прошли за max_retries повторов
+
+@dataclass
+class BroadcastReport:
+    """Итоги цикла разбора outbox: пачки подряд, пока очередь не опустеет"""
+    total: int = 0
+    sent: int = 0
+    failed: int = 0
+    retried: int = 0
+    duration: float = 0.0
+
+    def __str__(self):
+        return (f"отправлено {self.sent}/{self.total}, ошибок {self.failed}, "
+                f"повторов {self.retried}, {self.duration:.2f} с")
+
+class Broadcaster:
+    """Параллельная рассылка с ограничением скорости и повторами.
+
+    Ожидание лимитов и повторов - корутины в цикле runtime, потоки пула io
+    заняты только самими HTTP-запросами.
+    """
+
+    def __init__(self, workers: int = BROADCAST_WORKERS,
+                 global_rate: float = BROADCAST_GLOBAL_RATE,
+                 chat_interval: float = BROADCAST_CHAT_INTERVAL,
+                 max_retries: int = BROADCAST_MAX_RETRIES):
+        self.workers = workers
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_limiter = ChatRateLimiter(chat_interval)
+
+    async def send_async(self, bot, chat_id: int, text: str, **kwargs) -> Tuple[str, int, Optional[str]]:
+        """Отправить одно сообщение; возвращает (SEND_*, число повторов, текст ошибки)"""
+        status, retries, _, error = await self.call_async(
+            chat_id, functools.partial(bot.send_message, chat_id=chat_id, text=text, **kwargs)
+        )
+        return status, retries, error
+
+    async def call_async(self, chat_id: int, request: Callable) -> Tuple[str, int, object, Optional[str]]:
+        """Вызвать метод Bot API для чата с лимитами и повторами: (SEND_*, повторы, ответ, текст ошибки)"""
+        loop = asyncio.get_running_loop()
+        retries = 0
+        while True:
+            wait = self.chat_limiter.reserve(chat_id)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            wait = self.global_bucket.reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                result = await loop.run_in_executor(runtime.io, request)
+                return SEND_OK, retries, result, None
+            except RetryAfter as e:
+                delay = float(e.retry_after)
+                error = str(e)
+            except (BadRequest, Unauthorized, ChatMigrated) as e:
+                logger.warning("⚠️ Сообщение %s не доставлено: %s", chat_id, e, extra={'chat_id': chat_id})
+                return SEND_REJECTED, retries, None, str(e)
+            except NetworkError as e:
+                delay = BROADCAST_BACKOFF * (2 ** retries)
+                error = str(e)
+            except Exception as e:
+                logger.error("❌ Не удалось отправить сообщение %s: %s", chat_id, e, extra={'chat_id': chat_id})
+                return SEND_GAVE_UP, retries, None, str(e)
             
-            logger.info(f"✅ Скрипт_6: Уведомления отправлены {len(active_users)} пользователям")
+            if retries >= self.max_retries:
+                logger.error("❌ Не удалось отправить сообщение %s после %d повторов: %s", chat_id, retries,
+                             error, extra={'chat_id': chat_id})
+                return SEND_GAVE_UP, retries, None, error
+            retries += 1
+            await asyncio.sleep(delay)
+
+broadcaster = Broadcaster()
+
+# =========== ГРУППОВЫЕ ЧАТЫ КОМАНД ===========
+# Команда с привязанным групповым чатом (/teamchat) получает одно закрепленное
+# объявление в день: перевыбор дежурного правит его на месте, а не рассылает
+# всем заново. Сутки считаются в часовом поясе расписания команды.
+# Замок живет, пока его держит или ждет объявление: словарь не растет с числом чатов
+_team_chat_locks: 'weakref.WeakValueDictionary[int, asyncio.Lock]' = weakref.WeakValueDictionary()
+
+async def send_team_announcement(bot, chat_id: int, text: str) -> Tuple[str, int, Optional[str]]:
+    """Опубликовать или поправить объявление в чате команды: (SEND_*, число повторов, текст ошибки)"""
+    # Объявления одного чата по очереди, иначе оба увидят "еще не публиковали"
+    lock = _team_chat_locks.setdefault(chat_id, asyncio.Lock())
+    async with lock:
+        chat = await db_read(get_team_chat, chat_id)
+        if chat is None:
+            logger.warning("⚠️ Чат %s больше не привязан к команде, объявление пропущено", chat_id)
+            return SEND_REJECTED, 0, 'чат не привязан к команде'
+        team_id, message_id, posted_on, posted_text = chat
+        team_schedule = await db_read(get_team_schedule, team_id)
+        today = datetime.now(team_schedule.tz).date().isoformat()
+        
+        if message_id and posted_on == today:
+            if posted_text == text:
+                API_CALLS_SAVED.inc('team_chat_unchanged')
+                return SEND_OK, 0, None
+            status, retries, _, error = await broadcaster.call_async(chat_id, functools.partial(
+                bot.edit_message_text, text=text, chat_id=chat_id, message_id=message_id
+            ))
+            if status == SEND_OK:
+                await db_write(save_team_chat_post, chat_id, message_id, today, text)
+            # Отказ правки - сообщение удалили из чата: публикуем заново
+            if status != SEND_REJECTED:
+                return status, retries, error
+        
+        status, retries, message, error = await broadcaster.call_async(chat_id, functools.partial(
+            bot.send_message, chat_id=chat_id, text=text
+        ))
+        if status != SEND_OK:
+            return status, retries, error
+        await db_write(save_team_chat_post, chat_id, message.message_id, today, text)
+        
+        # Закрепление - по возможности: без прав администратора объявление просто остается в чате
+        await broadcaster.call_async(chat_id, functools.partial(
+            bot.pin_chat_message, chat_id=chat_id, message_id=message.message_id,
+            disable_notification=True
+        ))
+        if message_id and posted_on != today:
+            await broadcaster.call_async(chat_id, functools.partial(
+                bot.unpin_chat_message, chat_id=chat_id, message_id=message_id
+            ))
+        return SEND_OK, retries, None
+
+# =========== ОЧЕРЕДЬ ИСХОДЯЩИХ СООБЩЕНИЙ ===========
+# Сообщения пишутся в таблицу outbox в той же транзакции, что и изменения
+# состояния, и доставляются фоновым разборщиком: рестарт посреди рассылки
+# ничего не теряет. Доставка "хотя бы один раз": при падении между отправкой
+# и отметкой сообщение уйдет повторно.
+OUTBOX_BATCH = int(os.environ.get('OUTBOX_BATCH', '100'))
+OUTBOX_POLL_INTERVAL = float(os.environ.get('OUTBOX_POLL_INTERVAL', '5'))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '5'))
+OUTBOX_RETRY_DELAY = 30.0
+OUTBOX_RETENTION_DAYS = 7
+
+def enqueue_messages(messages: List[Tuple[int, str]], kind: str = OUTBOX_DM) -> int:
+    """Поставить сообщения [(chat_id, text), ...] в очередь (в текущей транзакции, если она есть)"""
+    if not messages:
+        return 0
+    now = time.time()
+    with db.transaction() as conn:
+        if kind == OUTBOX_TEAM:
+            # Новое объявление чата заменяет еще не доставленные старые: иначе их
+            # повтор поправил бы закрепленное сообщение обратно на прежнего дежурного
+            conn.executemany(
+                '''UPDATE outbox SET status = 'superseded'
+                   WHERE chat_id = ? AND kind = ? AND status = 'pending' ''',
+                [(chat_id, OUTBOX_TEAM) for chat_id, _ in messages]
+            )
+        conn.executemany(
+            'INSERT INTO outbox (chat_id, text, next_attempt_at, kind) VALUES (?, ?, ?, ?)',
+            [(chat_id, text, now, kind) for chat_id, text in messages]
+        )
+    # Разборщик будится после COMMIT внешней транзакции
+    db.after_transaction(outbox_drainer.wake)
+    return len(messages)
+
+def enqueue_announcement(messages: List[Tuple[int, str]], posts: List[Tuple[int, str]], skipped: int = 0) -> int:
+    """Личные сообщения и посты в чаты команд объявления - одной транзакцией"""
+    with db.transaction():
+        queued = enqueue_messages(messages) + enqueue_messages(posts, kind=OUTBOX_TEAM)
+    if skipped:
+        db.after_commit(lambda: API_CALLS_SAVED.inc('team_chat', amount=skipped))
+    return queued
+
+def outbox_due(limit: int = OUTBOX_BATCH) -> List[Tuple[int, int, str, int, str]]:
+    """Сообщения, которые пора отправить: [(id, chat_id, text, attempts, kind), ...]"""
+    return execute_query(
+        '''SELECT id, chat_id, text, attempts, kind FROM outbox
+           WHERE status = 'pending' AND next_attempt_at <= ?
+           ORDER BY id LIMIT ?''',
+        (time.time(), limit),
+        fetchall=True
+    ) or []
+
+def outbox_settle(sent: List[int], retry: List[Tuple[float, str, int]], dead: List[Tuple[str, int]]):
+    """Отметить итоги отправки; меняются только строки, еще ожидающие доставки"""
+    with db.transaction() as conn:
+        conn.executemany(
+            '''UPDATE outbox SET status = 'sent', attempts = attempts + 1, sent_at = CURRENT_TIMESTAMP
+               WHERE id = ? AND status = 'pending' ''',
+            [(row_id,) for row_id in sent]
+        )
+        conn.executemany(
+            '''UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ?, last_error = ?
+               WHERE id = ? AND status = 'pending' ''',
+            retry
+        )
+        conn.executemany(
+            '''UPDATE outbox SET status = 'dead', attempts = attempts + 1, last_error = ?
+               WHERE id = ? AND status = 'pending' ''',
+            dead
+        )
+
+def compact_outbox(retention_days: int = OUTBOX_RETENTION_DAYS):
+    """Удалить доставленные и замененные сообщения старше срока хранения (dead остаются для разбора)"""
+    execute_query(
+        '''DELETE FROM outbox
+           WHERE (status = 'sent' AND sent_at < datetime('now', ?1))
+              OR (status = 'superseded' AND created_at < datetime('now', ?1))''',
+        (f'-{retention_days} days',),
+        commit=True
+    )
+
+class OutboxDrainer:
+    """Фоновый разборщик outbox в цикле runtime.
+
+    Берет пачку созревших сообщений, отправляет их конкурентно через
+    broadcaster и одной транзакцией отмечает итоги. Временные ошибки
+    откладываются с экспоненциальной задержкой; после max_attempts попыток
+    или при окончательном отказе Telegram сообщение помечается dead.
+    """
+
+    def __init__(self, batch: int = OUTBOX_BATCH, poll_interval: float = OUTBOX_POLL_INTERVAL,
+                 max_attempts: int = OUTBOX_MAX_ATTEMPTS):
+        self.batch = batch
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[Future] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = runtime.submit(self._run())
+            logger.info("✅ Разборщик очереди сообщений запущен")
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def wake(self):
+        """Разбудить разборщик (из любого потока)"""
+        if self._wake is not None:
+            runtime.loop.call_soon_threadsafe(self._wake.set)
+
+    async def _run(self):
+        self._wake = asyncio.Event()
+        report = BroadcastReport()
+        while True:
+            try:
+                drained = await self.drain_once(report)
+            except Exception as e:
+                logger.error("❌ Ошибка разбора очереди сообщений: %s", e)
+                drained = 0
+            if drained >= self.batch:
+                continue
+            if report.total:
+                logger.info("📬 Разбор очереди сообщений: %s", report)
+                report = BroadcastReport()
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    async def drain_once(self, report: Optional[BroadcastReport] = None) -> int:
+        """Отправить одну пачку; возвращает число обработанных сообщений.
+
+        Итоги пачки добавляются в report, если он передан.
+        """
+        # Очередь общая для всех реплик - разбирает только лидер
+        if not (updater_instance and updater_instance.bot) or not leader.is_leader:
+            return 0
+        rows = await db_read(outbox_due, self.batch)
+        if not rows:
+            return 0
+        started = time.monotonic()
+        bot = updater_instance.bot
+        semaphore = asyncio.Semaphore(broadcaster.workers)
+
+        async def send_one(chat_id: int, text: str, kind: str):
+            async with semaphore:
+                if kind == OUTBOX_TEAM:
+                    return await send_team_announcement(bot, chat_id, text)
+                return await broadcaster.send_async(bot, chat_id, text)
+
+        results = await asyncio.gather(*(send_one(chat_id, text, kind) for _, chat_id, text, _, kind in rows))
+        sent, retry, dead = [], [], []
+        now = time.time()
+        for (row_id, _, _, attempts, _), (status, retries, error) in zip(rows, results):
+            if report is not None:
+                report.retried += retries
+            # В last_error - ответ Telegram, по нему разбирают dead
+            error = error or status
+            if status == SEND_OK:
+                sent.append(row_id)
+            elif status == SEND_REJECTED or attempts + 1 >= self.max_attempts:
+                dead.append((error, row_id))
+            else:
+                retry.append((now + OUTBOX_RETRY_DELAY * (2 ** attempts), error, row_id))
+        await db_write(outbox_settle, sent, retry, dead)
+        if retry or dead:
+            logger.warning("⚠️ Очередь сообщений: отправлено %d, отложено %d, в dead %d",
+                           len(sent), len(retry), len(dead))
+        if report is not None:
+            report.total += len(rows)
+            report.sent += len(sent)
+            report.failed += len(retry) + len(dead)
+            report.duration += time.monotonic() - started
+        return len(rows)
+
+outbox_drainer = OutboxDrainer()
+
+# =========== СКЛЕИВАНИЕ ОБЪЯВЛЕНИЙ ===========
+# Перевыборы одной команды за ANNOUNCE_DELAY секунд склеиваются в одно объявление,
+# но не дольше ANNOUNCE_MAX_DELAY от первого перевыбора
+ANNOUNCE_DELAY = float(os.environ.get('ANNOUNCE_DELAY', '5'))
+ANNOUNCE_MAX_DELAY = float(os.environ.get('ANNOUNCE_MAX_DELAY', '30'))
+# Повторные нажатия "не могу дежурить" одним пользователем не перевыбирают дежурного
+DECLINE_DEBOUNCE = float(os.environ.get('DECLINE_DEBOUNCE', '10'))
+
+BROADCASTS_SUPPRESSED = Counter(
+    'coffee_broadcasts_suppressed_total',
+    'Объявления о дежурном, которые не были разосланы',
+    ('reason',)
+)
+
+class DutyAnnouncer:
+    """Отложенное объявление дежурного команды.
+
+    Каждый schedule() откладывает объявление на delay секунд; срабатывает
+    одно объявление с дежурным, выбранным последним. Если он уже был объявлен,
+    рассылка не выполняется.
+    """
+
+    def __init__(self, delay: float = ANNOUNCE_DELAY, max_delay: float = ANNOUNCE_MAX_DELAY):
+        self.delay = delay
+        self.max_delay = max_delay
+        # team_id -> (таймер, момент первого перевыбора); только из потока цикла
+        self._pending: Dict[int, Tuple[asyncio.TimerHandle, float]] = {}
+        self._announced: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def remember(self, duties: Dict[int, Tuple[int, str]]):
+        """Запомнить объявленных дежурных {team_id: (user_id, name)}"""
+        with self._lock:
+            for team_id, (user_id, _) in duties.items():
+                self._announced[team_id] = user_id
+
+    def is_announced(self, team_id: int, duty: Optional[Tuple[int, str]]) -> bool:
+        with self._lock:
+            return duty is not None and self._announced.get(team_id) == duty[0]
+
+    def schedule(self, team_id: int):
+        """Запросить объявление дежурного команды (из любого потока)"""
+        loop = runtime.loop
+        loop.call_soon_threadsafe(self._reschedule, loop, team_id)
+
+    def _reschedule(self, loop: asyncio.AbstractEventLoop, team_id: int):
+        now = loop.time()
+        first_requested = now
+        pending = self._pending.pop(team_id, None)
+        if pending is not None:
+            timer, first_requested = pending
+            timer.cancel()
+            BROADCASTS_SUPPRESSED.inc('coalesced')
+        delay = max(0.0, min(self.delay, first_requested + self.max_delay - now))
+        timer = loop.call_later(delay, self._fire, team_id)
+        self._pending[team_id] = (timer, first_requested)
+
+    def _fire(self, team_id: int):
+        self._pending.pop(team_id, None)
+        asyncio.ensure_future(self._announce(team_id))
+
+    async def _announce(self, team_id: int):
+        try:
+            duties, messages, posts, skipped = await db_read(duty_announcements, team_id)
+            duty = duties.get(team_id)
+            if duty is None or self.is_announced(team_id, duty):
+                BROADCASTS_SUPPRESSED.inc('unchanged')
+                logger.info("⏭️ Дежурный команды %s не изменился, объявление пропущено", team_id)
+                return
+            queued = await db_write(enqueue_announcement, messages, posts, skipped)
+            self.remember(duties)
+            logger.info("✅ Объявление дежурного команды %s: в очереди %d", team_id, queued)
+        except Exception as e:
+            logger.error("❌ Ошибка объявления дежурного команды %s: %s", team_id, e)
+
+duty_announcer = DutyAnnouncer()
+
+class DeclineDebouncer:
+    """Не чаще одного отказа от дежурства на пользователя за interval секунд"""
+
+    def __init__(self, interval: float = DECLINE_DEBOUNCE):
+        self.interval = interval
+        self._last: Dict[int, float] = {}
+        self._lock = threading.Lock()
+
+    def allow(self, user_id: int) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last.get(user_id, float('-inf')) < self.interval:
+                return False
+            self._last[user_id] = now
+            if len(self._last) > 10000:
+                self._last = {
+                    uid: t for uid, t in self._last.items() if now - t < self.interval
+                }
+            return True
+
+decline_debouncer = DeclineDebouncer()
 
 # =========== ФУНКЦИИ ДЛЯ ЗАПУСКА СКРИПТОВ ===========
-def run_13_00_scripts():
-    """Запуск скриптов в 13:00 UTC"""
+def describe_teams(teams: Teams) -> str:
+    if teams is None:
+        return 'все'
+    return str(teams) if isinstance(teams, int) else ', '.join(map(str, teams))
+
+@timed(SCRIPT_SECONDS, 'run_13_00_scripts')
+def run_13_00_scripts(teams: Teams = None):
+    """Утренний цикл (по умолчанию 13:00 UTC); без teams - во всех командах"""
     if not SCRIPTS_ENABLED:
-        logger.info("⏸️ Скрипты отключены, пропускаем выполнение в 13:00")
+        logger.info("⏸️ Скрипты отключены, пропускаем утренний цикл")
         return
     
-    logger.info("⏰ Запуск скриптов 13:00 (UTC)")
-    script_1()  # Скрипт_1 (прирост кофе)
-    script_2()  # Скрипт_2 (поиск дежурного)
-    script_6()  # Скрипт_6 (информирование)
+    logger.info("⏰ Утренний цикл (команды: %s)", describe_teams(teams))
+    with db.transaction():
+        script_1(teams)  # Скрипт_1 (прирост кофе)
+        script_2(teams)  # Скрипт_2 (поиск дежурного)
+        script_6(teams)  # Скрипт_6 (информирование): только постановка в очередь
 
-def run_20_00_scripts():
-    """Запуск скриптов в 20:00 UTC"""
+@timed(SCRIPT_SECONDS, 'run_20_00_scripts')
+def run_20_00_scripts(teams: Teams = None):
+    """Вечерний цикл (по умолчанию 20:00 UTC); без teams - во всех командах"""
     if not SCRIPTS_ENABLED:
-        logger.info("⏸️ Скрипты отключены, пропускаем выполнение в 20:00")
+        logger.info("⏸️ Скрипты отключены, пропускаем вечерний цикл")
         return
     
-    logger.info("⏰ Запуск скриптов 20:00 (UTC)")
-    script_3()  # Скрипт_3 (обнуление Печальки)
-    script_4()  # Скрипт_4 (погашение дежурства)
-    script_5()  # Скрипт_5 (уход домой неполнозанятых)
+    logger.info("⏰ Вечерний цикл (команды: %s)", describe_teams(teams))
+    with db.transaction():
+        script_3(teams)  # Скрипт_3 (обнуление Печальки)
+        script_4(teams)  # Скрипт_4 (погашение дежурства)
+        script_5(teams)  # Скрипт_5 (уход домой неполнозанятых)
+
+def compact_storage():
+    """Сжатие журнала дежурств и outbox - раз за проход планировщика, а не на каждую команду"""
+    compact_events()
+    compact_outbox()
+
+# =========== ВЫБОР ЛИДЕРА ===========
+# Реплики на одной БД соревнуются за аренду; циклы по расписанию и разбор
+# outbox выполняет только держатель аренды
+LEASE_NAME = 'scheduler'
+LEASE_TTL = float(os.environ.get('LEASE_TTL', '15'))
+LEASE_RENEW_INTERVAL = LEASE_TTL / 3
+
+class LeaderLease:
+    """Аренда лидерства в таблице leases с продлением и токеном ограждения.
+
+    Токен растет при каждой смене держателя и при повторном захвате своей
+    истекшей аренды: запуски, пропущенные за перерыв, догоняются по смене
+    токена. Работа лидера проверяет свой токен в той же транзакции, в которой
+    пишет: пока транзакция держит блокировку записи SQLite, аренду не может
+    перехватить никто.
+    """
+
+    def __init__(self, name: str = LEASE_NAME, ttl: float = LEASE_TTL):
+        self.name = name
+        self.ttl = ttl
+        self.holder = f'{socket.gethostname()}:{os.getpid()}:{random.getrandbits(32):08x}'
+        self.token: Optional[int] = None
+        self._expires_at = 0.0
+        self._renewer: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    @property
+    def is_leader(self) -> bool:
+        # Локальный срок: лидер, не сумевший продлить аренду, сам перестает им быть
+        return self.token is not None and time.time() < self._expires_at
+
+    def heartbeat(self) -> Optional[int]:
+        """Захватить или продлить аренду; возвращает токен или None"""
+        now = time.time()
+        with db.transaction():
+            row = execute_query(
+                'SELECT holder, token, expires_at FROM leases WHERE name = ?',
+                (self.name,),
+                fetchone=True
+            )
+            if row and row[0] != self.holder and row[2] > now:
+                token = None
+            else:
+                # Продление своей действующей аренды токен сохраняет, любой захват - новый токен
+                token = row[1] if row and row[0] == self.holder and row[2] > now else (row[1] + 1 if row else 1)
+                execute_query(
+                    '''INSERT INTO leases (name, holder, token, expires_at) VALUES (?, ?, ?, ?)
+                       ON CONFLICT (name) DO UPDATE SET
+                           holder = excluded.holder, token = excluded.token,
+                           expires_at = excluded.expires_at''',
+                    (self.name, self.holder, token, now + self.ttl),
+                    commit=True
+                )
+
+        was_leader = self.is_leader
+        self.token = token
+        self._expires_at = now + self.ttl if token is not None else 0.0
+        if token is not None and not was_leader:
+            logger.info("👑 Реплика %s стала лидером (токен %s)", self.holder, token)
+            # Новый лидер догоняет слоты, пропущенные предыдущим
+            schedule_index.wake()
+        elif token is None and was_leader:
+            logger.warning("⚠️ Реплика %s потеряла лидерство (аренду держит %s)", self.holder, row[0])
+        return token
+
+    def held_elsewhere(self) -> bool:
+        """Держит ли сейчас аренду другая реплика"""
+        row = execute_query(
+            'SELECT holder, expires_at FROM leases WHERE name = ?',
+            (self.name,),
+            fetchone=True
+        )
+        return bool(row) and row[0] != self.holder and row[1] > time.time()
+
+    def check_fence(self, token: int) -> bool:
+        """Действителен ли еще token; вызывать внутри транзакции с записью"""
+        row = execute_query(
+            'SELECT holder, token, expires_at FROM leases WHERE name = ?',
+            (self.name,),
+            fetchone=True
+        )
+        return bool(row) and row[0] == self.holder and row[1] == token and row[2] > time.time()
+
+    def start(self):
+        try:
+            self.heartbeat()
+        except Exception as e:
+            logger.error("❌ Не удалось захватить аренду лидера: %s", e)
+        self._stopped.clear()
+        self._renewer = threading.Thread(target=self._renew_loop, name='lease', daemon=True)
+        self._renewer.start()
+
+    def _renew_loop(self):
+        # Свой поток и свое соединение: продление не ждет в очереди потока
+        # записи за циклами скриптов и медленными обработчиками
+        try:
+            while not self._stopped.wait(LEASE_RENEW_INTERVAL):
+                try:
+                    self.heartbeat()
+                except Exception as e:
+                    logger.error("❌ Не удалось продлить аренду лидера: %s", e)
+        finally:
+            db.release()
+
+    def release(self):
+        """Отдать аренду при остановке: другая реплика подхватит сразу"""
+        if self._renewer is not None:
+            self._stopped.set()
+            self._renewer.join(timeout=10)
+            self._renewer = None
+        if self.token is not None:
+            execute_query(
+                'UPDATE leases SET expires_at = 0 WHERE name = ? AND holder = ?',
+                (self.name, self.holder),
+                commit=True
+            )
+            self.token = None
+            logger.info("✅ Аренда лидера освобождена")
+
+leader = LeaderLease()
 
 # =========== СОБСТВЕННЫЙ ПЛАНИРОВЩИК ===========
-def schedule_checker():
-    """Функция для проверки времени и запуска скриптов"""
-    while SCHEDULER_RUNNING:
+# У каждой команды свое расписание (часовой пояс, рабочие дни, время циклов,
+# праздники). Моменты запуска всех команд заранее посчитаны в куче, и цикл
+# планировщика просыпается только ради команд, которым пора.
+WEEKDAY_CODES = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+WEEKDAY_NAMES = ('Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс')
+# Расписание команды без собственных настроек (как было до расписаний по командам)
+DEFAULT_TIMEZONE = 'UTC'
+DEFAULT_WEEKDAYS = 'mon-fri'
+DEFAULT_MORNING = '13:00'
+DEFAULT_EVENING = '20:00'
+# Задания по расписанию: имя, поле расписания со временем, функция(team_id), описание
+SCHEDULED_JOBS = (
+    ('run_13_00_scripts', 'morning', run_13_00_scripts, 'утренний цикл (скрипты 1,2,6)'),
+    ('run_20_00_scripts', 'evening', run_20_00_scripts, 'вечерний цикл (скрипты 3,4,5)'),
+)
+SCHEDULED_JOB_FUNCS = {job_name: func for job_name, _, func, _ in SCHEDULED_JOBS}
+# Догон пропущенных запусков при старте: none | latest | all
+SCHEDULER_CATCHUP = os.environ.get('SCHEDULER_CATCHUP', 'latest')
+# Насколько давние пропуски еще имеет смысл догонять
+SCHEDULER_CATCHUP_WINDOW = timedelta(hours=int(os.environ.get('SCHEDULER_CATCHUP_HOURS', '6')))
+# Максимальный сон за раз: защита от переводов системных часов
+SCHEDULER_MAX_SLEEP = 3600
+# Дальше года рабочий день не ищем: расписание без рабочих дней не срабатывает
+SCHEDULE_LOOKAHEAD_DAYS = 370
+
+def parse_weekdays(spec: str) -> FrozenSet[int]:
+    """'mon-fri', 'mon,wed,fri', 'mon-wed,sat' или '*' -> номера дней (0 = понедельник)"""
+    spec = spec.strip().lower()
+    if spec == '*':
+        return frozenset(range(7))
+    days = set()
+    for part in spec.split(','):
+        first, _, last = part.strip().partition('-')
+        if first not in WEEKDAY_CODES or (last and last not in WEEKDAY_CODES):
+            raise ValueError(f"неизвестный день недели в «{part}»")
+        start = WEEKDAY_CODES.index(first)
+        end = WEEKDAY_CODES.index(last) if last else start
+        days.update(day % 7 for day in range(start, end + 1 if end >= start else end + 8))
+    return frozenset(days)
+
+def parse_clock(text: str) -> dt_time:
+    """'ЧЧ:ММ' -> time"""
+    try:
+        hours, minutes = text.strip().split(':')
+        return dt_time(int(hours), int(minutes))
+    except ValueError:
+        raise ValueError(f"время «{text}» не в формате ЧЧ:ММ")
+
+def load_timezone(name: str):
+    """Часовой пояс IANA; UTC не требует базы часовых поясов"""
+    if name.upper() == 'UTC':
+        return timezone.utc
+    # zoneinfo нужен только командам с собственным поясом - не при запуске
+    from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"неизвестный часовой пояс «{name}»")
+
+@dataclass(frozen=True)
+class TeamSchedule:
+    """Расписание команды; все моменты запуска - наивное UTC, как datetime.utcnow()"""
+    team_id: int
+    timezone_name: str = DEFAULT_TIMEZONE
+    weekdays_spec: str = DEFAULT_WEEKDAYS
+    morning: dt_time = parse_clock(DEFAULT_MORNING)
+    evening: dt_time = parse_clock(DEFAULT_EVENING)
+    holidays: FrozenSet[date] = frozenset()
+
+    @functools.cached_property
+    def tz(self):
+        return load_timezone(self.timezone_name)
+
+    @functools.cached_property
+    def weekdays(self) -> FrozenSet[int]:
+        return parse_weekdays(self.weekdays_spec)
+
+    def is_workday(self, day: date) -> bool:
+        return day.weekday() in self.weekdays and day not in self.holidays
+
+    def next_fire(self, at: dt_time, after: datetime) -> Optional[datetime]:
+        """Ближайший запуск в at по местному времени строго после after (UTC)"""
+        day = after.replace(tzinfo=timezone.utc).astimezone(self.tz).date()
+        for _ in range(SCHEDULE_LOOKAHEAD_DAYS):
+            if self.is_workday(day):
+                candidate = datetime.combine(day, at, tzinfo=self.tz)
+                candidate = candidate.astimezone(timezone.utc).replace(tzinfo=None)
+                if candidate > after:
+                    return candidate
+            day += timedelta(days=1)
+        return None
+
+    def fire_times(self, at: dt_time, since: datetime, until: datetime) -> List[datetime]:
+        """Моменты запуска в интервале (since, until]"""
+        slots = []
+        slot = self.next_fire(at, since)
+        while slot is not None and slot <= until:
+            slots.append(slot)
+            slot = self.next_fire(at, slot)
+        return slots
+
+    def upcoming(self, after: datetime, count: int) -> List[Tuple[datetime, str]]:
+        """Ближайшие count запусков всех заданий: [(UTC, имя задания), ...]"""
+        runs = []
+        for job_name, field, _, _ in SCHEDULED_JOBS:
+            slot = after
+            for _ in range(count):
+                slot = self.next_fire(getattr(self, field), slot)
+                if slot is None:
+                    break
+                runs.append((slot, job_name))
+        return sorted(runs)[:count]
+
+    def describe(self) -> str:
+        return (f"{self.timezone_name}, {self.weekdays_spec}, "
+                f"{self.morning:%H:%M} и {self.evening:%H:%M}"
+                + (f", праздников: {len(self.holidays)}" if self.holidays else ""))
+
+def _schedule_from_row(team_id: int, row, holidays: FrozenSet[date]) -> TeamSchedule:
+    if row is None or row[0] is None:
+        return TeamSchedule(team_id, holidays=holidays)
+    timezone_name, weekdays_spec, morning, evening = row
+    # Проверить сразу: испорченная запись не должна ронять планировщик
+    load_timezone(timezone_name)
+    parse_weekdays(weekdays_spec)
+    return TeamSchedule(
+        team_id, timezone_name, weekdays_spec, parse_clock(morning), parse_clock(evening), holidays
+    )
+
+def load_team_schedules(team_id: Optional[int] = None) -> Dict[int, TeamSchedule]:
+    """Расписания команд (или одной команды) из БД: {team_id: TeamSchedule}"""
+    where, params = ('', ()) if team_id is None else (' WHERE t.team_id = ?', (team_id,))
+    rows = execute_query(
+        f'''SELECT t.team_id, s.timezone, s.weekdays, s.morning, s.evening
+            FROM teams t LEFT JOIN team_schedules s ON s.team_id = t.team_id{where}''',
+        params,
+        fetchall=True
+    ) or []
+    holidays = defaultdict(set)
+    for holiday_team, day in execute_query(
+        f"SELECT team_id, day FROM team_holidays WHERE day >= date('now', '-1 day')"
+        f"{'' if team_id is None else ' AND team_id = ?'}",
+        params,
+        fetchall=True
+    ) or []:
+        holidays[holiday_team].add(date.fromisoformat(day))
+    
+    schedules = {}
+    for row_team, *row in rows:
         try:
-            now = datetime.utcnow()
-            
-            # Проверяем день недели (0 = понедельник, 6 = воскресенье)
-            weekday = now.weekday()
-            
-            # Проверяем время
-            current_hour = now.hour
-            current_minute = now.minute
-            
-            # Понедельник-пятница в 13:00 UTC
-            if weekday < 5 and current_hour == 13 and current_minute == 0:
-                run_13_00_scripts()
-                # Ждем 2 минуты, чтобы не выполнить дважды
-                time.sleep(120)
-            
-            # Понедельник-пятница в 20:00 UTC
-            elif weekday < 5 and current_hour == 20 and current_minute == 0:
-                run_20_00_scripts()
-                # Ждем 2 минуты, чтобы не выполнить дважды
-                time.sleep(120)
-            
-            # Спим 30 секунд перед следующей проверкой
-            time.sleep(30)
-            
+            schedules[row_team] = _schedule_from_row(row_team, row, frozenset(holidays[row_team]))
+        except ValueError as e:
+            logger.error("❌ Расписание команды %s некорректно (%s), используется расписание по умолчанию", row_team, e)
+            schedules[row_team] = TeamSchedule(row_team, holidays=frozenset(holidays[row_team]))
+    return schedules
+
+def get_team_schedule(team_id: int) -> TeamSchedule:
+    return load_team_schedules(team_id).get(team_id) or TeamSchedule(team_id)
+
+def set_team_schedule(team_id: int, timezone_name: str, weekdays_spec: str, morning: str, evening: str):
+    """Сохранить расписание команды; ValueError, если что-то не разбирается"""
+    load_timezone(timezone_name)
+    parse_weekdays(weekdays_spec)
+    morning, evening = parse_clock(morning), parse_clock(evening)
+    execute_query(
+        '''INSERT INTO team_schedules (team_id, timezone, weekdays, morning, evening)
+           VALUES (?, ?, ?, ?, ?)
+           ON CONFLICT (team_id) DO UPDATE SET
+               timezone = excluded.timezone, weekdays = excluded.weekdays,
+               morning = excluded.morning, evening = excluded.evening''',
+        (team_id, timezone_name, weekdays_spec.lower(), f'{morning:%H:%M}', f'{evening:%H:%M}'),
+        commit=True
+    )
+    schedule_index.mark_dirty(team_id)
+
+def toggle_team_holiday(team_id: int, day: date) -> bool:
+    """Отметить или снять праздник команды; True - день стал праздником"""
+    params = (team_id, day.isoformat())
+    with db.transaction():
+        exists = execute_query(
+            'SELECT 1 FROM team_holidays WHERE team_id = ? AND day = ?', params, fetchone=True
+        )
+        execute_query(
+            'DELETE FROM team_holidays WHERE team_id = ? AND day = ?' if exists
+            else 'INSERT INTO team_holidays (team_id, day) VALUES (?, ?)',
+            params,
+            commit=True
+        )
+    schedule_index.mark_dirty(team_id)
+    return not exists
+
+class ScheduleIndex:
+    """Куча ближайших запусков (UTC, team_id, задание, версия расписания).
+
+    Кучей владеет цикл планировщика. Смена расписания команды повышает ее
+    версию: старые записи отбрасываются при извлечении, а не ищутся в куче.
+    """
+
+    def __init__(self):
+        self.schedules: Dict[int, TeamSchedule] = {}
+        self._heap: List[Tuple[datetime, int, str, int]] = []
+        self._versions: Dict[int, int] = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._wake: Optional[asyncio.Event] = None
+
+    def replace(self, team_id: int, schedule: Optional[TeamSchedule], now: datetime):
+        """Заменить расписание команды (None - убрать команду из индекса)"""
+        version = self._versions.get(team_id, 0) + 1
+        self._versions[team_id] = version
+        if schedule is None:
+            self.schedules.pop(team_id, None)
+            return
+        self.schedules[team_id] = schedule
+        for job_name, field, _, _ in SCHEDULED_JOBS:
+            self._push(schedule, job_name, field, now, version)
+
+    def _push(self, schedule: TeamSchedule, job_name: str, field: str, after: datetime, version: int):
+        fire_at = schedule.next_fire(getattr(schedule, field), after)
+        if fire_at is not None:
+            heapq.heappush(self._heap, (fire_at, schedule.team_id, job_name, version))
+
+    def _drop_stale(self):
+        while self._heap and self._heap[0][3] != self._versions.get(self._heap[0][1]):
+            heapq.heappop(self._heap)
+
+    def next_fire_at(self) -> Optional[datetime]:
+        self._drop_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: datetime) -> List[Tuple[datetime, int, str, int]]:
+        """Извлечь все созревшие запуски в порядке времени"""
+        due = []
+        while self.next_fire_at() is not None and self._heap[0][0] <= now:
+            due.append(heapq.heappop(self._heap))
+        return due
+
+    def retry(self, fire_at: datetime, team_id: int, job_name: str, version: int):
+        """Вернуть в кучу извлеченный, но не выполненный запуск"""
+        if self.schedules.get(team_id) is not None and self._versions.get(team_id) == version:
+            heapq.heappush(self._heap, (fire_at, team_id, job_name, version))
+
+    def advance(self, team_id: int, job_name: str, fired_at: datetime, version: int):
+        """Поставить следующий запуск задания после выполненного"""
+        schedule = self.schedules.get(team_id)
+        if schedule is None or self._versions.get(team_id) != version:
+            return
+        field = next(field for name, field, _, _ in SCHEDULED_JOBS if name == job_name)
+        self._push(schedule, job_name, field, fired_at, version)
+
+    def mark_dirty(self, team_id: int):
+        """Перечитать расписание команды при следующем пробуждении (из любого потока)"""
+        with self._lock:
+            self._dirty.add(team_id)
+        self.wake()
+
+    def wake(self):
+        """Разбудить цикл планировщика (из любого потока)"""
+        if self._wake is not None:
+            runtime.loop.call_soon_threadsafe(self._wake.set)
+
+    def take_dirty(self) -> List[int]:
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        return sorted(dirty)
+
+    async def sleep(self, delay: float):
+        """Спать до delay секунд или до mark_dirty()"""
+        if self._wake is None:
+            self._wake = asyncio.Event()
+        try:
+            await asyncio.wait_for(self._wake.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+        self._wake.clear()
+
+schedule_index = ScheduleIndex()
+
+def job_key(job_name: str, team_id: int) -> str:
+    """Ключ отметки запуска; у команды по умолчанию - прежний, без суффикса"""
+    return job_name if team_id == DEFAULT_TEAM_ID else f'{job_name}@{team_id}'
+
+def get_last_run(job_name: str, team_id: int = DEFAULT_TEAM_ID) -> Optional[datetime]:
+    """Отметка последнего запуска задания команды из settings"""
+    value = get_setting(f'last_run:{job_key(job_name, team_id)}')
+    return datetime.fromisoformat(value) if value else None
+
+def run_scheduled_job(job_name: str, teams: List[int], slot: datetime, func) -> Optional[List[int]]:
+    """Выполнить задание за слот slot сразу для всех команд teams, где он еще не выполнялся.
+
+    Выполняет только лидер. Проверка его токена, отметки слота команд и сам
+    цикл (один набор запросов на все команды) - одна транзакция: слот
+    выполняется ровно один раз на все реплики, а при падении посреди цикла
+    откатывается вместе с отметками и достается догону следующего лидера.
+    Возвращает команды, для которых задание выполнено, или None, если
+    реплика не лидер и слот не тронут.
+    """
+    if not teams:
+        return []
+    if not leader.is_leader:
+        return None
+    token = leader.token
+    keys = {team_id: f'last_run:{job_key(job_name, team_id)}' for team_id in teams}
+    global SCRIPTS_ENABLED
+    try:
+        # Глобальные скрипты не пересекаются с обработкой обновлений
+        with dispatch_gate.exclusive(), db.transaction() as conn:
+            if not leader.check_fence(token):
+                logger.warning("⚠️ %s: токен %s устарел, запуск отменен", job_name, token)
+                return None
+            marks = dict(execute_query(
+                f'SELECT key, value FROM settings WHERE key IN ({", ".join("?" * len(keys))})',
+                tuple(keys.values()),
+                fetchall=True
+            ) or [])
+            pending = [
+                team_id for team_id in teams
+                if not (marks.get(keys[team_id]) and datetime.fromisoformat(marks[keys[team_id]]) >= slot)
+            ]
+            if len(pending) < len(teams):
+                logger.info("⏭️ %s за %s уже выполнен для команд: %s", job_name, f'{slot:%Y-%m-%d %H:%M}',
+                            describe_teams(sorted(set(teams) - set(pending))))
+            if not pending:
+                return []
+            conn.executemany(
+                'INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)',
+                [(keys[team_id], slot.isoformat()) for team_id in pending]
+            )
+            # Флаг могли переключить на другой реплике, а внутри транзакции
+            # кэш не сверяется с БД - читаем саму строку settings
+            SCRIPTS_ENABLED = read_scripts_enabled()
+            func(pending)
+    except Exception as e:
+        logger.error("❌ Ошибка задания %s (команды: %s): %s", job_name, describe_teams(teams), e)
+        return []
+    logger.info("✅ %s за %s выполнен (команды: %s, токен %s)", job_name, f'{slot:%Y-%m-%d %H:%M}',
+                describe_teams(pending), token, extra={'job': job_name, 'teams': len(pending)})
+    return pending
+
+def run_due_jobs(due: List[Tuple[datetime, str, int]]) -> List[Tuple[datetime, str, int]]:
+    """Выполнить созревшие запуски [(слот, задание, team_id), ...] группами:
+    команды с общим слотом и заданием идут одним run_scheduled_job, сжатие -
+    один раз в конце.
+
+    Возвращает запуски, которые надо повторить: реплика не была лидером, а
+    аренду не держит и никто другой (например, своя аренда истекла и еще не
+    захвачена заново). Слоты, которые держит другой лидер, - его забота.
+    """
+    groups: Dict[Tuple[datetime, str], List[int]] = {}
+    for slot, job_name, team_id in sorted(due, key=lambda entry: entry[0]):
+        groups.setdefault((slot, job_name), []).append(team_id)
+    ran = False
+    deferred = []
+    for (slot, job_name), teams in groups.items():
+        done = run_scheduled_job(job_name, teams, slot, SCHEDULED_JOB_FUNCS[job_name])
+        if done is None:
+            if not leader.held_elsewhere():
+                deferred.extend((slot, job_name, team_id) for team_id in teams)
+        elif done:
+            ran = True
+    if ran:
+        compact_storage()
+    return deferred
+
+def catch_up_missed_runs(now: datetime, schedules: Dict[int, TeamSchedule]):
+    """Догнать пропущенные слоты (например, после рестарта) по политике SCHEDULER_CATCHUP"""
+    if SCHEDULER_CATCHUP == 'none':
+        return
+    window_start = now - SCHEDULER_CATCHUP_WINDOW
+    due = []
+    for team_id, schedule in schedules.items():
+        for job_name, field, _, _ in SCHEDULED_JOBS:
+            last_run = get_last_run(job_name, team_id)
+            if last_run is None:
+                # Первый запуск для команды: догонять нечего
+                continue
+            missed = schedule.fire_times(getattr(schedule, field), max(last_run, window_start), now)
+            if not missed:
+                continue
+            if SCHEDULER_CATCHUP != 'all':
+                missed = missed[-1:]
+            due.extend((slot, job_name, team_id) for slot in missed)
+    if due:
+        logger.info("⏪ Догоняем пропущенные запуски: %d", len(due))
+        run_due_jobs(due)
+
+async def scheduler_loop():
+    """Планировщик на индексе расписаний: задача asyncio спит до ближайшего запуска
+    любой команды или до смены чьего-то расписания.
+
+    Сами циклы выполняются в потоке записи runtime.writer.
+    """
+    # Полная загрузка ниже покрывает все отложенные перечитывания
+    schedule_index.take_dirty()
+    schedules = await db_read(load_team_schedules)
+    now = datetime.utcnow()
+    for team_id, schedule in schedules.items():
+        schedule_index.replace(team_id, schedule, now)
+    logger.info("⏰ Расписаний команд в индексе: %d", len(schedules))
+    caught_up_token = None
+
+    while True:
+        try:
+            # Догон - при старте и при каждом получении лидерства
+            if leader.is_leader and caught_up_token != leader.token:
+                caught_up_token = leader.token
+                try:
+                    await db_write(catch_up_missed_runs, datetime.utcnow(), dict(schedule_index.schedules))
+                except Exception as e:
+                    logger.error("❌ Ошибка догона пропущенных запусков: %s", e)
+
+            for team_id in schedule_index.take_dirty():
+                schedule = (await db_read(load_team_schedules, team_id)).get(team_id)
+                schedule_index.replace(team_id, schedule, datetime.utcnow())
+                logger.info("⏰ Расписание команды %s обновлено: %s", team_id, schedule.describe() if schedule else 'нет')
+
+            due = schedule_index.pop_due(datetime.utcnow())
+            deferred = set()
+            if due:
+                # Команды с общим временем запуска - одним циклом на все
+                deferred = set(await db_write(
+                    run_due_jobs, [(fire_at, job_name, team_id) for fire_at, team_id, job_name, _ in due]
+                ))
+                for fire_at, team_id, job_name, version in due:
+                    if (fire_at, job_name, team_id) in deferred:
+                        # Слот ничей: повторяем, пока реплика снова не станет лидером
+                        schedule_index.retry(fire_at, team_id, job_name, version)
+                    else:
+                        schedule_index.advance(team_id, job_name, fire_at, version)
+
+            next_at = schedule_index.next_fire_at()
+            delay = SCHEDULER_MAX_SLEEP if next_at is None else (next_at - datetime.utcnow()).total_seconds()
+            if deferred:
+                # Повтор - не чаще продления аренды; захват лидерства будит планировщик сразу
+                delay = LEASE_RENEW_INTERVAL
+            if delay > 0:
+                await schedule_index.sleep(min(delay, SCHEDULER_MAX_SLEEP))
+
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            logger.error(f"❌ Ошибка в планировщике: {e}")
-            time.sleep(60)
+            logger.error("❌ Ошибка в планировщике: %s", e)
+            await asyncio.sleep(60)
+
+_scheduler_task: Optional[Future] = None
+
+def start_scheduler():
+    """Запуск планировщика задачей в цикле asyncio"""
+    global SCHEDULER_RUNNING, _scheduler_task
+    SCHEDULER_RUNNING = True
+    _scheduler_task = runtime.submit(scheduler_loop())
+    logger.info("✅ Планировщик скриптов запущен")
+    logger.info(
+        "⏰ Расписание по умолчанию (%s): %s %s (скрипты 1,2,6) и %s (скрипты 3,4,5); "
+        "свое расписание команды - /schedule",
+        DEFAULT_TIMEZONE, DEFAULT_WEEKDAYS, DEFAULT_MORNING, DEFAULT_EVENING
+    )
+
+def stop_scheduler():
+    """Остановка планировщика"""
+    global SCHEDULER_RUNNING, _scheduler_task
+    SCHEDULER_RUNNING = False
+    if _scheduler_task is not None:
+        _scheduler_task.cancel()
+        _scheduler_task = None
+    logger.info("✅ Планировщик скриптов остановлен")
+
+# =========== КЛАВИАТУРЫ И ОТВЕТЫ ===========
+# Клавиатуры собираются один раз при импорте и больше не меняются
+POLL_KEYBOARD = InlineKeyboardMarkup((
+    (
+        InlineKeyboardButton(FREQ_LABELS[FREQ_DAILY], callback_data='daily'),
+        InlineKeyboardButton(FREQ_LABELS[FREQ_RARE], callback_data='rarely'),
+    ),
+    (InlineKeyboardButton("Я теперь НЕ пью кофе", callback_data='no_coffee'),),
+))
+MAIN_COFFEE_KEYBOARD = InlineKeyboardMarkup((
+    (InlineKeyboardButton("Я некоторое время не пью кофе", callback_data='temp_no_coffee'),),
+    (InlineKeyboardButton("Я дежурный, но не смогу вымыть кофемашинку", callback_data='cant_duty'),),
+    (InlineKeyboardButton("Я Вернулся", callback_data='returned'),),
+    (InlineKeyboardButton("Я теперь пью кофе по другому", callback_data='change_habit'),),
+))
+RARE_COFFEE_KEYBOARD = InlineKeyboardMarkup((
+    (InlineKeyboardButton("Я сегодня пью кофе", callback_data='today_coffee'),),
+    (InlineKeyboardButton("Я дежурный, но не смогу вымыть кофемашинку", callback_data='cant_duty_rare'),),
+    (InlineKeyboardButton("Я теперь пью кофе по другому", callback_data='change_habit_rare'),),
+))
+POLL_TEXT = "☕ Как часто вы пьете кофе?"
+
+# Сколько сообщений помнить для подавления повторных одинаковых правок
+RENDERED_CACHE_SIZE = 10000
+API_CALLS_SAVED = Counter('coffee_api_calls_saved_total', 'Сэкономленные вызовы Bot API', ('reason',))
+
+class RenderedMessages:
+    """Последний показанный текст и клавиатура каждого сообщения с меню"""
+
+    def __init__(self, max_size: int = RENDERED_CACHE_SIZE):
+        self.max_size = max_size
+        self._rendered: 'OrderedDict[Tuple, Tuple[str, int]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(query) -> Optional[Tuple]:
+        if query.message is not None:
+            return (query.message.chat_id, query.message.message_id)
+        if getattr(query, 'inline_message_id', None):
+            return (query.inline_message_id,)
+        return None
+
+    def is_current(self, key: Tuple, text: str, markup) -> bool:
+        with self._lock:
+            return self._rendered.get(key) == (text, id(markup))
 
-def start_scheduler():
-    """Запуск планировщика в отдельном потоке"""
-    global SCHEDULER_RUNNING
-    SCHEDULER_RUNNING = True
-    scheduler_thread = threading.Thread(target=schedule_checker, daemon=True)
-    scheduler_thread.start()
-    logger.info("✅ Планировщик скриптов запущен")
-    logger.info("⏰ Расписание (UTC): Пн-Пт 13:00 (скрипты 1,2,6) и 20:00 (скрипты 3,4,5)")
-    logger.info("⏰ По Москве (UTC+3): Пн-Пт 16:00 и 23:00")
+    def remember(self, key: Tuple, text: str, markup):
+        with self._lock:
+            self._rendered[key] = (text, id(markup))
+            self._rendered.move_to_end(key)
+            if len(self._rendered) > self.max_size:
+                self._rendered.popitem(last=False)
 
-def stop_scheduler():
-    """Остановка планировщика"""
-    global SCHEDULER_RUNNING
-    SCHEDULER_RUNNING = False
-    logger.info("✅ Планировщик скриптов остановлен")
+rendered_messages = RenderedMessages()
+
+def respond(query, text: str, reply_markup=None, notice: Optional[str] = None):
+    """Ответить на нажатие кнопки минимумом вызовов API.
+
+    notice показывается всплывающим уведомлением answerCallbackQuery вместо
+    отдельного сообщения в личку; правка меню пропускается, если сообщение
+    уже показывает тот же текст с той же клавиатурой.
+    """
+    query.answer(text=notice)
+    if notice:
+        API_CALLS_SAVED.inc('merged_reply')
+    
+    key = rendered_messages.key(query)
+    if key is not None and rendered_messages.is_current(key, text, reply_markup):
+        API_CALLS_SAVED.inc('noop_edit')
+        return
+    try:
+        query.edit_message_text(text, reply_markup=reply_markup)
+    except BadRequest as e:
+        # После рестарта память о показанном пуста - Telegram сообщит сам
+        if 'not modified' not in str(e).lower():
+            raise
+    if key is not None:
+        rendered_messages.remember(key, text, reply_markup)
 
 # =========== ОБРАБОТЧИКИ КОМАНД И ДИАЛОГОВ ===========
 def start(update: Update, context):
@@ -449,33 +2841,20 @@ def registration(update: Update, context):
     update_user(user_id, name=name)
     
     # Переход на экран "Опрос"
-    keyboard = [
-        [
-            InlineKeyboardButton("Каждый день", callback_data='daily'),
-            InlineKeyboardButton("Я тут не каждый день", callback_data='rarely')
-        ],
-        [InlineKeyboardButton("Я теперь НЕ пью кофе", callback_data='no_coffee')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    update.message.reply_text(
-        "☕ Как часто вы пьете кофе?",
-        reply_markup=reply_markup
-    )
+    update.message.reply_text(POLL_TEXT, reply_markup=POLL_KEYBOARD)
     return POLL
 
 def poll_handler(update: Update, context):
     """Экран 'Опрос': выбор частоты употребления кофе"""
     query = update.callback_query
-    query.answer()
-    
     user_id = update.effective_user.id
     data = query.data
     
     if data == 'no_coffee':
         # УДАЛЯЕТ ВСЕ ДАННЫЕ ИЗ ТАБЛИЦЫ
         delete_user(user_id)
-        query.edit_message_text(
+        respond(
+            query,
             "🗑️ Ваши данные удалены.\n\n"
             "Чтобы начать заново, нажмите /start"
         )
@@ -483,198 +2862,153 @@ def poll_handler(update: Update, context):
     
     if data == 'daily':
         # Сохраняем "Каждый день"
-        update_user(user_id, chastota='Каждый день')
+        update_user(user_id, freq=FREQ_DAILY)
         
         # Переход на экран "Главные кофеманы"
-        keyboard = [
-            [InlineKeyboardButton("Я некоторое время не пью кофе", callback_data='temp_no_coffee')],
-            [InlineKeyboardButton("Я дежурный, но не смогу вымыть кофемашинку", callback_data='cant_duty')],
-            [InlineKeyboardButton("Я Вернулся", callback_data='returned')],
-            [InlineKeyboardButton("Я теперь пью кофе по другому", callback_data='change_habit')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        query.edit_message_text(
+        respond(
+            query,
             "✅ Теперь вам будет приходить уведомления кто сегодня дежурный\n\n"
             "Выберите действие:",
-            reply_markup=reply_markup
+            MAIN_COFFEE_KEYBOARD
         )
         return MAIN_COFFEE
     
     elif data == 'rarely':
         # Сохраняем "Я тут не каждый день"
-        update_user(user_id, chastota='Я тут не каждый день')
+        update_user(user_id, freq=FREQ_RARE)
         
         # Переход на экран "Редкие кофеманы"
-        keyboard = [
-            [InlineKeyboardButton("Я сегодня пью кофе", callback_data='today_coffee')],
-            [InlineKeyboardButton("Я дежурный, но не смогу вымыть кофемашинку", callback_data='cant_duty_rare')],
-            [InlineKeyboardButton("Я теперь пью кофе по другому", callback_data='change_habit_rare')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        query.edit_message_text(
+        respond(
+            query,
             "⏰ Когда вы придете, отметьтесь\n\n"
             "Выберите действие:",
-            reply_markup=reply_markup
+            RARE_COFFEE_KEYBOARD
         )
         return RARE_COFFEE
+    
+    query.answer()
+
+def decline_duty(user_id: int) -> Optional[Tuple[int, bool]]:
+    """Отказ от дежурства: wait_2 = 1, count_2 = 0 и перевыбор одной транзакцией.
+
+    Перевыбор - только если отказался сам дежурный или дежурного в команде нет:
+    отказ остальных не должен отнимать дежурство у текущего.
+    Возвращает (команда, был ли перевыбор) или None, если нажатие отброшено как повторное.
+    """
+    if not decline_debouncer.allow(user_id):
+        BROADCASTS_SUPPRESSED.inc('debounced')
+        return None
+    with db.transaction():
+        row = execute_query('SELECT team_id, count_2 FROM users WHERE user_id = ?', (user_id,), fetchone=True)
+        team_id, was_duty = row if row else (DEFAULT_TEAM_ID, 0)
+        record_user_event('declined', user_id)
+        update_user(user_id, wait_2=1, count_2=0)
+        reselect = bool(was_duty) or not execute_query(
+            'SELECT 1 FROM users WHERE team_id = ? AND count_2 = 1', (team_id,), fetchone=True
+        )
+        if reselect:
+            script_2(team_id)
+    return team_id, reselect
 
 def main_coffee_handler(update: Update, context):
     """Экран 'Главные кофеманы'"""
     query = update.callback_query
-    query.answer()
-    
     user_id = update.effective_user.id
     data = query.data
     
-    # Создаем клавиатуру для главных кофеманов
-    keyboard = [
-        [InlineKeyboardButton("Я некоторое время не пью кофе", callback_data='temp_no_coffee')],
-        [InlineKeyboardButton("Я дежурный, но не смогу вымыть кофемашинку", callback_data='cant_duty')],
-        [InlineKeyboardButton("Я Вернулся", callback_data='returned')],
-        [InlineKeyboardButton("Я теперь пью кофе по другому", callback_data='change_habit')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
     if data == 'temp_no_coffee':
         # Присваивает 1 в wait_1
         update_user(user_id, wait_1=1)
-        context.bot.send_message(
-            chat_id=user_id,
-            text="⏸️ Когда вы вернетесь отметьте это"
-        )
         # Оставляем меню с обновленным текстом
-        query.edit_message_text(
+        respond(
+            query,
             "✅ Вы отметили временное отсутствие\n\n"
             "Выберите действие:",
-            reply_markup=reply_markup
+            MAIN_COFFEE_KEYBOARD,
+            notice="⏸️ Когда вы вернетесь отметьте это"
         )
         return MAIN_COFFEE
     
     elif data == 'cant_duty':
-        # Присваивает 1 в wait_2 и 0 в count_2
-        update_user(user_id, wait_2=1, count_2=0)
-        context.bot.send_message(
-            chat_id=user_id,
-            text="😔 Печалька"
-        )
-        # Запускаем Скрипт_2 и скрипт_6
-        script_2()
-        script_6()
+        declined = decline_duty(user_id)
         # Оставляем меню
-        query.edit_message_text(
+        respond(
+            query,
             "✅ Отказ от дежурства учтен\n\n"
             "Выберите действие:",
-            reply_markup=reply_markup
+            MAIN_COFFEE_KEYBOARD,
+            notice="😔 Печалька" if declined is not None else "⏳ Отказ уже учтен"
         )
+        # Скрипт_6 - отложенно и только после перевыбора: серия отказов дает одно объявление
+        if declined is not None and declined[1]:
+            duty_announcer.schedule(declined[0])
         return MAIN_COFFEE
         
     elif data == 'returned':
         # Присваивает 0 в wait_1
         update_user(user_id, wait_1=0)
-        context.bot.send_message(
-            chat_id=user_id,
-            text="🎉 Ура!"
-        )
         # Оставляем меню
-        query.edit_message_text(
+        respond(
+            query,
             "✅ Вы вернулись!\n\n"
             "Выберите действие:",
-            reply_markup=reply_markup
+            MAIN_COFFEE_KEYBOARD,
+            notice="🎉 Ура!"
         )
         return MAIN_COFFEE
         
     elif data == 'change_habit':
         # Переход на экран "Опрос"
-        poll_keyboard = [
-            [
-                InlineKeyboardButton("Каждый день", callback_data='daily'),
-                InlineKeyboardButton("Я тут не каждый день", callback_data='rarely')
-            ],
-            [InlineKeyboardButton("Я теперь НЕ пью кофе", callback_data='no_coffee')]
-        ]
-        poll_reply_markup = InlineKeyboardMarkup(poll_keyboard)
-        
-        query.edit_message_text(
-            "☕ Как часто вы пьете кофе?",
-            reply_markup=poll_reply_markup
-        )
+        respond(query, POLL_TEXT, POLL_KEYBOARD)
         return POLL
     
     # Если ничего не выбрано, оставляем меню как есть
+    query.answer()
     return MAIN_COFFEE
 
 def rare_coffee_handler(update: Update, context):
     """Экран 'Редкие кофеманы'"""
     query = update.callback_query
-    query.answer()
-    
     user_id = update.effective_user.id
     data = query.data
     
-    # Создаем клавиатуру для редких кофеманов
-    keyboard = [
-        [InlineKeyboardButton("Я сегодня пью кофе", callback_data='today_coffee')],
-        [InlineKeyboardButton("Я дежурный, но не смогу вымыть кофемашинку", callback_data='cant_duty_rare')],
-        [InlineKeyboardButton("Я теперь пью кофе по другому", callback_data='change_habit_rare')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
     if data == 'today_coffee':
         # Добавляет 1 в count_1, присваивает 0 в wait_1
-        user = get_user_data(user_id)
-        current_count = user['count_1'] if user else 0
-        update_user(user_id, count_1=current_count + 1, wait_1=0)
-        
-        context.bot.send_message(
-            chat_id=user_id,
-            text="✅ Спасибо"
-        )
+        with db.transaction():
+            record_user_event('attended', user_id)
+            update_user(user_id, count_1=Increment(1), wait_1=0)
         # Оставляем меню
-        query.edit_message_text(
+        respond(
+            query,
             "✅ Ваше присутствие отмечено\n\n"
             "Выберите действие:",
-            reply_markup=reply_markup
+            RARE_COFFEE_KEYBOARD,
+            notice="✅ Спасибо"
         )
         return RARE_COFFEE
         
     elif data == 'cant_duty_rare':
-        # Присваивает 1 в wait_2 и 0 в count_2
-        update_user(user_id, wait_2=1, count_2=0)
-        context.bot.send_message(
-            chat_id=user_id,
-            text="😔 Печалька"
-        )
-        # Запускаем Скрипт_2 и скрипт_6
-        script_2()
-        script_6()
+        declined = decline_duty(user_id)
         # Оставляем меню
-        query.edit_message_text(
+        respond(
+            query,
             "✅ Отказ от дежурства учтен\n\n"
             "Выберите действие:",
-            reply_markup=reply_markup
+            RARE_COFFEE_KEYBOARD,
+            notice="😔 Печалька" if declined is not None else "⏳ Отказ уже учтен"
         )
+        # Скрипт_6 - отложенно и только после перевыбора: серия отказов дает одно объявление
+        if declined is not None and declined[1]:
+            duty_announcer.schedule(declined[0])
         return RARE_COFFEE
         
     elif data == 'change_habit_rare':
         # Переход на экран "Опрос"
-        poll_keyboard = [
-            [
-                InlineKeyboardButton("Каждый день", callback_data='daily'),
-                InlineKeyboardButton("Я тут не каждый день", callback_data='rarely')
-            ],
-            [InlineKeyboardButton("Я теперь НЕ пью кофе", callback_data='no_coffee')]
-        ]
-        poll_reply_markup = InlineKeyboardMarkup(poll_keyboard)
-        
-        query.edit_message_text(
-            "☕ Как часто вы пьете кофе?",
-            reply_markup=poll_reply_markup
-        )
+        respond(query, POLL_TEXT, POLL_KEYBOARD)
         return POLL
     
     # Если ничего не выбрано, оставляем меню как есть
+    query.answer()
     return RARE_COFFEE
 
 def cancel(update: Update, context):
@@ -684,34 +3018,232 @@ def cancel(update: Update, context):
     )
     return ConversationHandler.END
 
+# =========== ПРОФИЛИРОВАНИЕ ===========
+def parse_admin_ids(raw: str) -> FrozenSet[int]:
+    """user_id через запятую или пробел; некорректные записи пропускаются с предупреждением"""
+    admin_ids = set()
+    for part in raw.replace(',', ' ').split():
+        try:
+            admin_ids.add(int(part))
+        except ValueError:
+            logger.warning("⚠️ ADMIN_IDS: некорректный user_id %r пропущен", part)
+    return frozenset(admin_ids)
+
+# Администраторы бота - для скрытых команд, /teamchat и /schedule set
+ADMIN_IDS: FrozenSet[int] = parse_admin_ids(os.environ.get('ADMIN_IDS', ''))
+PROFILE_DEFAULT_SECONDS = 10
+PROFILE_MAX_SECONDS = int(os.environ.get('PROFILE_MAX_SECONDS', '120'))
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SAMPLE_INTERVAL', '0.005'))
+PROFILE_TOP = int(os.environ.get('PROFILE_TOP', '30'))
+PROFILE_TRACE_FRAMES = 10
+
+# Листовые функции потоков, которые просто ждут работу (очередь, таймер, select)
+IDLE_FRAMES = frozenset({
+    ('threading.py', 'wait'),
+    ('queue.py', 'get'),
+    ('selectors.py', 'select'),
+    ('socketserver.py', 'serve_forever'),
+})
+
+def is_admin(user_id: int) -> bool:
+    return user_id in ADMIN_IDS
+
+def _frame_key(code) -> Tuple[str, int, str]:
+    return code.co_filename, code.co_firstlineno, code.co_name
+
+def _format_frame_key(key: Tuple[str, int, str]) -> str:
+    filename, line, name = key
+    return f'{name} ({os.path.basename(filename)}:{line})'
+
+class SamplingProfiler:
+    """Статистический профилировщик всех потоков процесса.
+
+    Поток-сэмплер раз в interval снимает стеки через sys._current_frames() и
+    считает собственные (верх стека) и накопительные попадания функций;
+    параллельно tracemalloc сравнивает снимки памяти до и после. Пока
+    профиль не запущен, ничего не работает и не трассируется; сам
+    профилировщик и tracemalloc загружаются при первом /profile.
+    """
+
+    def __init__(self, interval: float = PROFILE_SAMPLE_INTERVAL, top: int = PROFILE_TOP):
+        self.interval = interval
+        self.top = top
+        self._lock = threading.Lock()
+
+    def try_start(self) -> bool:
+        """Занять профилировщик; False - уже идет другой профиль"""
+        return self._lock.acquire(blocking=False)
+
+    def run(self, seconds: float) -> str:
+        """Профилировать seconds секунд и вернуть текстовый отчет (после try_start)"""
+        try:
+            return self._run(seconds)
+        finally:
+            self._lock.release()
+
+    def _run(self, seconds: float) -> str:
+        import tracemalloc
+        own_tracing = not tracemalloc.is_tracing()
+        if own_tracing:
+            tracemalloc.start(PROFILE_TRACE_FRAMES)
+        memory_before = tracemalloc.take_snapshot()
+        
+        own_thread = threading.get_ident()
+        self_counts: Dict[Tuple, int] = defaultdict(int)
+        total_counts: Dict[Tuple, int] = defaultdict(int)
+        thread_counts: Dict[int, List[int]] = {}
+        # Имена запоминаются сразу: поток может завершиться до отчета
+        thread_names: Dict[int, str] = {}
+        samples = 0
+        started = time.perf_counter()
+        deadline = started + seconds
+        while time.perf_counter() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                counts = thread_counts.get(thread_id)
+                if counts is None:
+                    counts = thread_counts[thread_id] = [0, 0]
+                    thread_names.update((thread.ident, thread.name) for thread in threading.enumerate())
+                leaf = frame.f_code
+                counts[0] += 1
+                if (os.path.basename(leaf.co_filename), leaf.co_name) in IDLE_FRAMES:
+                    continue
+                counts[1] += 1
+                self_counts[_frame_key(leaf)] += 1
+                # Рекурсивная функция учитывается в выборке один раз
+                seen = set()
+                while frame is not None:
+                    key = _frame_key(frame.f_code)
+                    if key not in seen:
+                        seen.add(key)
+                        total_counts[key] += 1
+                    frame = frame.f_back
+            samples += 1
+            time.sleep(self.interval)
+        elapsed = time.perf_counter() - started
+        
+        memory_diff = tracemalloc.take_snapshot().compare_to(memory_before, 'lineno')
+        peak = tracemalloc.get_traced_memory()[1]
+        if own_tracing:
+            tracemalloc.stop()
+        
+        return self._report(elapsed, samples, thread_counts, thread_names, self_counts,
+                            total_counts, memory_diff, peak)
+
+    def _report(self, elapsed, samples, thread_counts, thread_names, self_counts,
+                total_counts, memory_diff, peak) -> str:
+        active = sum(counts[1] for counts in thread_counts.values()) or 1
+        lines = [
+            f'Профиль процесса {os.getpid()}: {elapsed:.1f} с, {samples} выборок '
+            f'каждые {self.interval * 1000:.0f} мс',
+            '',
+            '== Потоки: выборок всего / в работе (не в ожидании) ==',
+        ]
+        for thread_id, (total, busy) in sorted(thread_counts.items(), key=lambda item: -item[1][1]):
+            lines.append(f'{busy:>8} / {total:<8} {thread_names.get(thread_id, thread_id)}')
+        
+        for title, counts in (('собственное время', self_counts), ('накопительно', total_counts)):
+            lines += ['', f'== Функции, {title} (топ {self.top}) ==']
+            ranked = sorted(counts.items(), key=lambda item: -item[1])[:self.top]
+            for key, count in ranked:
+                lines.append(f'{count:>8} {count / active * 100:6.1f}%  {_format_frame_key(key)}')
+        
+        lines += ['', f'== Память: прирост за профиль (tracemalloc, пик {peak / 1024:.0f} КиБ) ==']
+        for stat in memory_diff[:self.top]:
+            frame = stat.traceback[0]
+            lines.append(
+                f'{stat.size_diff / 1024:>+10.1f} КиБ {stat.count_diff:>+8} блоков  '
+                f'{frame.filename}:{frame.lineno}'
+            )
+        return '\n'.join(lines) + '\n'
+
+@functools.lru_cache(maxsize=None)
+def get_profiler() -> SamplingProfiler:
+    """Профилировщик создается при первом /profile"""
+    return SamplingProfiler()
+
+def send_profile(bot, chat_id: int, seconds: float):
+    """Снять профиль и отправить отчет документом (в отдельном потоке)"""
+    try:
+        report = get_profiler().run(seconds)
+        filename = f'profile-{datetime.now():%Y%m%d-%H%M%S}.txt'
+        bot.send_document(
+            chat_id,
+            document=io.BytesIO(report.encode('utf-8')),
+            filename=filename,
+            caption=f"📈 Профиль за {seconds:g} с"
+        )
+        logger.info("📈 Профиль за %g с отправлен в чат %s", seconds, chat_id)
+    except Exception as e:
+        logger.error("❌ Ошибка профилирования: %s", e, extra={'chat_id': chat_id})
+
 # =========== СКРЫТЫЕ КОМАНДЫ ===========
 def hollidaon(update: Update, context):
     """Скрытая команда: отключить работу скриптов по времени"""
+    if not is_admin(update.effective_user.id):
+        update.message.reply_text("❌ Команда доступна только администраторам")
+        return
+    
     set_scripts_enabled(False)
     update.message.reply_text("✅ Работа скриптов по времени ОТКЛЮЧЕНА")
 
 def hollidayoff(update: Update, context):
     """Скрытая команда: включить работу скриптов по времени"""
+    if not is_admin(update.effective_user.id):
+        update.message.reply_text("❌ Команда доступна только администраторам")
+        return
+    
     set_scripts_enabled(True)
     update.message.reply_text("✅ Работа скриптов по времени ВКЛЮЧЕНА")
 
+def profile(update: Update, context):
+    """Скрытая команда администратора: /profile <секунды> - профиль процесса документом"""
+    if not is_admin(update.effective_user.id):
+        update.message.reply_text("❌ Команда доступна только администраторам")
+        return
+    
+    try:
+        seconds = float(context.args[0]) if context.args else PROFILE_DEFAULT_SECONDS
+    except ValueError:
+        seconds = 0
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        update.message.reply_text(f"Использование: /profile <секунды, до {PROFILE_MAX_SECONDS}>")
+        return
+    
+    if not get_profiler().try_start():
+        update.message.reply_text("⏳ Профиль уже снимается, дождитесь отчета")
+        return
+    # Профиль снимается в своем потоке, чтобы не занимать очередь обработчиков
+    threading.Thread(
+        target=send_profile,
+        args=(context.bot, update.effective_chat.id, seconds),
+        name='profiler',
+        daemon=True
+    ).start()
+    update.message.reply_text(f"📈 Профилирую {seconds:g} с, отчет придет документом")
+
 def status(update: Update, context):
     """Показать статус пользователя"""
     user = get_user_data(update.effective_user.id)
     
     if user:
-        duty = get_duty_user()
+        duty = get_duty_user(user['team_id'])
         duty_text = duty[1] if duty else "Дежурный еще не выбран"
+        stats = get_user_stats(user['user_id'])
         
         status_msg = f"""
 📊 Ваш статус:
 👤 Имя: {user['name'] or 'Не указано'}
-📅 Режим: {user['chastota'] or 'Не указан'}
+🏢 Команда: {get_team_name(user['team_id']) or user['team_id']}
+📅 Режим: {FREQ_LABELS.get(user['freq'], 'Не указан')}
+📣 Объявления: {'в личку' if user['prefers_dm'] else 'в группе команды (если привязана)'}
 ☕ Чашек: {user['count_1']}
 🎖️ Дежурств: {user['count_2']}
 🚫 Отсутствие: {'Да' if user['wait_1'] else 'Нет'}
 😔 Не могу, Печалька: {'Да' if user['wait_2'] else 'Нет'}
 👑 Сегодняшний дежурный: {duty_text}
+🏆 За все время: назначений {stats['assigned']}, выполнено {stats['completed']}, отказов {stats['declined']}, отметок {stats['attended']}
 ⚙️ Автоскрипты: {'ВКЛЮЧЕНЫ' if SCRIPTS_ENABLED else 'ОТКЛЮЧЕНЫ'}
         """
     else:
@@ -719,8 +3251,183 @@ def status(update: Update, context):
     
     update.message.reply_text(status_msg)
 
+def team(update: Update, context):
+    """Показать или сменить команду (офис): /team <название>"""
+    user_id = update.effective_user.id
+    user = get_user_data(user_id)
+    
+    if not user:
+        update.message.reply_text("❌ Вы не зарегистрированы. Используйте /start")
+        return
+    
+    if context.args:
+        name = ' '.join(context.args).strip()
+        team_id = get_or_create_team(name)
+        set_user_team(user_id, team_id)
+        update.message.reply_text(f"✅ Вы в команде «{name}»")
+    else:
+        update.message.reply_text(
+            f"🏢 Ваша команда: {get_team_name(user['team_id']) or user['team_id']}\n"
+            "Сменить: /team <название>"
+        )
+
+def is_chat_admin(bot, chat_id: int, user_id: int) -> bool:
+    """Администратор группового чата или администратор бота (ADMIN_IDS)"""
+    if is_admin(user_id):
+        return True
+    try:
+        member = bot.get_chat_member(chat_id, user_id)
+    except TelegramError as e:
+        logger.warning("⚠️ Не удалось проверить права user_id=%s в чате %s: %s", user_id, chat_id, e)
+        return False
+    return member.status in (ChatMember.ADMINISTRATOR, ChatMember.CREATOR)
+
+def teamchat(update: Update, context):
+    """Групповой чат команды: /teamchat в группе - объявления дежурного сюда, /teamchat off - отвязать"""
+    chat = update.effective_chat
+    if chat.type not in ('group', 'supergroup'):
+        update.message.reply_text(
+            "Добавьте бота в групповой чат команды и отправьте там /teamchat - "
+            "объявление о дежурном будет одно, закрепленное, вместо личных сообщений"
+        )
+        return
+    
+    if context.args[:1] == ['off']:
+        if not is_chat_admin(context.bot, chat.id, update.effective_user.id):
+            update.message.reply_text("❌ Отвязать чат могут только его администраторы")
+        elif remove_team_chat(chat.id):
+            update.message.reply_text("✅ Чат отвязан, объявления снова приходят в личку")
+        else:
+            update.message.reply_text("❌ Этот чат не привязан к команде")
+        return
+    
+    # Вступить в любую команду может каждый, а привязка заменяет прежний чат команды
+    # и уводит ее объявления - поэтому привязывают только администраторы бота
+    if not is_admin(update.effective_user.id):
+        update.message.reply_text("❌ Привязать чат к команде могут только администраторы бота")
+        return
+    
+    user = get_user_data(update.effective_user.id)
+    if not user:
+        update.message.reply_text("❌ Сначала зарегистрируйтесь в личке с ботом: /start")
+        return
+    set_team_chat(user['team_id'], chat.id)
+    update.message.reply_text(
+        f"✅ Объявления команды «{get_team_name(user['team_id']) or user['team_id']}» "
+        "будут публиковаться и закрепляться здесь.\n"
+        "Кто хочет получать их и в личку: /notify dm"
+    )
+
+def notify(update: Update, context):
+    """Куда слать объявление о дежурном: /notify dm - в личку, /notify group - только в группе"""
+    user = get_user_data(update.effective_user.id)
+    if not user:
+        update.message.reply_text("❌ Вы не зарегистрированы. Используйте /start")
+        return
+    
+    choice = context.args[0] if context.args else ''
+    if choice in ('dm', 'group'):
+        update_user(user['user_id'], prefers_dm=int(choice == 'dm'))
+        update.message.reply_text(
+            "✅ Объявления будут приходить в личку" if choice == 'dm'
+            else "✅ Объявления - только в групповом чате команды (если он привязан)"
+        )
+    else:
+        update.message.reply_text(
+            f"📣 Сейчас: {'в личку' if user['prefers_dm'] else 'в групповом чате команды'}\n"
+            "Сменить: /notify dm или /notify group"
+        )
+
+SCHEDULE_PREVIEW_RUNS = 6
+
+def schedule(update: Update, context):
+    """Расписание команды: /schedule - ближайшие запуски,
+    /schedule set <пояс> <дни> <утро> <вечер>, /schedule holiday <ГГГГ-ММ-ДД>
+    """
+    user = get_user_data(update.effective_user.id)
+    if not user:
+        update.message.reply_text("❌ Вы не зарегистрированы. Используйте /start")
+        return
+    team_id = user['team_id']
+    args = context.args or []
+    
+    # Вступить в любую команду может каждый, поэтому менять расписание - только администраторам
+    if args[:1] in (['set'], ['holiday']) and not is_admin(update.effective_user.id):
+        update.message.reply_text("❌ Менять расписание команды могут только администраторы бота")
+        return
+    
+    try:
+        if args[:1] == ['set'] and len(args) == 5:
+            set_team_schedule(team_id, *args[1:])
+            update.message.reply_text("✅ Расписание команды сохранено")
+        elif args[:1] == ['holiday'] and len(args) == 2:
+            day = date.fromisoformat(args[1])
+            added = toggle_team_holiday(team_id, day)
+            update.message.reply_text(
+                f"✅ {day:%d.%m.%Y} - {'праздник, скрипты не запускаются' if added else 'снова рабочий день'}"
+            )
+        elif args:
+            update.message.reply_text(
+                "Использование:\n"
+                "/schedule - ближайшие запуски\n"
+                "/schedule set Europe/Moscow mon-fri 16:00 23:00\n"
+                "/schedule holiday 2026-12-31 - отметить или снять праздник"
+            )
+        else:
+            team_schedule = get_team_schedule(team_id)
+            titles = {job_name: title for job_name, _, _, title in SCHEDULED_JOBS}
+            lines = [f"⏰ Расписание: {team_schedule.describe()}"]
+            for fire_at, job_name in team_schedule.upcoming(datetime.utcnow(), SCHEDULE_PREVIEW_RUNS):
+                local = fire_at.replace(tzinfo=timezone.utc).astimezone(team_schedule.tz)
+                lines.append(f"{WEEKDAY_NAMES[local.weekday()]} {local:%d.%m %H:%M} - {titles[job_name]}")
+            if len(lines) == 1:
+                lines.append("Запусков не запланировано")
+            if not SCRIPTS_ENABLED:
+                lines.append("⏸️ Скрипты по времени сейчас отключены (/hollidayoff)")
+            update.message.reply_text('\n'.join(lines))
+    except ValueError as e:
+        update.message.reply_text(f"❌ {e}")
+
+def leaderboard(update: Update, context):
+    """Таблица лучших дежурных команды"""
+    user = get_user_data(update.effective_user.id)
+    if not user:
+        update.message.reply_text("❌ Вы не зарегистрированы. Используйте /start")
+        return
+    
+    rows = get_leaderboard(user['team_id'])
+    if not rows:
+        update.message.reply_text("🏆 Пока никто не дежурил")
+        return
+    
+    lines = ["🏆 Лучшие дежурные:"]
+    for place, (user_id, name, completed, declined, assigned) in enumerate(rows, 1):
+        lines.append(
+            f"{place}. {name or f'Пользователь {user_id}'} - выполнено {completed}, "
+            f"отказов {declined}, назначений {assigned}"
+        )
+    update.message.reply_text('\n'.join(lines))
+
+def cache_stats(update: Update, context):
+    """Скрытая команда: статистика кэша пользователей"""
+    if not is_admin(update.effective_user.id):
+        update.message.reply_text("❌ Команда доступна только администраторам")
+        return
+    
+    stats = user_cache.stats()
+    total = stats['hits'] + stats['misses']
+    hit_rate = stats['hits'] / total * 100 if total else 0.0
+    update.message.reply_text(
+        f"🗄️ Кэш: {stats['size']} записей, попаданий {stats['hits']}, "
+        f"промахов {stats['misses']} ({hit_rate:.1f}% попаданий), вытеснено {stats['evictions']}"
+    )
+
 def run_script(update: Update, context):
     """Запустить скрипт вручную (для тестирования)"""
+    if not is_admin(update.effective_user.id):
+        update.message.reply_text("❌ Команда доступна только администраторам")
+        return
+    
     if context.args:
         script_num = context.args[0]
         if script_num == '1':
@@ -754,21 +3461,557 @@ def run_script(update: Update, context):
     else:
         update.message.reply_text("Использование: /run_script <номер_скрипта>\n1-прирост кофе, 2-поиск дежурного, 3-обнуление печальки, 4-погашение дежурства, 5-уход домой, 6-информирование, all-все")
 
+# =========== ХРАНЕНИЕ СОСТОЯНИЯ ДИАЛОГОВ ===========
+# Период пакетной записи изменений в БД (секунды)
+PERSISTENCE_FLUSH_INTERVAL = float(os.environ.get('PERSISTENCE_FLUSH_INTERVAL', '2'))
+CONVERSATION_NAME = 'coffee_conversation'
+
+class SQLitePersistence(BasePersistence):
+    """Состояния ConversationHandler и user_data в SQLite.
+
+    Все читается одним запросом при старте, изменения копятся в памяти
+    и пишутся пачкой раз в PERSISTENCE_FLUSH_INTERVAL и при остановке.
+    """
+
+    def __init__(self, flush_interval: float = PERSISTENCE_FLUSH_INTERVAL):
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=False)
+        self.flush_interval = flush_interval
+        self._conversations: Dict[str, Dict[Tuple, object]] = {}
+        self._user_data: Optional[defaultdict] = None
+        self._dirty_conversations: Dict[Tuple[str, str], Optional[str]] = {}
+        self._dirty_users: Dict[int, Optional[str]] = {}
+        self._lock = threading.Lock()
+        self._flusher: Optional[Future] = None
+
+    # --- загрузка при старте ---
+    def get_conversations(self, name: str) -> Dict:
+        if name not in self._conversations:
+            rows = execute_query(
+                'SELECT key, state FROM conversations WHERE name = ?',
+                (name,),
+                fetchall=True
+            ) or []
+            self._conversations[name] = {
+                tuple(json.loads(key)): json.loads(state) for key, state in rows
+            }
+            logger.info("✅ Восстановлено диалогов «%s»: %d", name, len(rows))
+        return dict(self._conversations[name])
+
+    def get_user_data(self) -> defaultdict:
+        if self._user_data is None:
+            rows = execute_query('SELECT user_id, data FROM user_data', fetchall=True) or []
+            self._user_data = defaultdict(dict, {
+                user_id: json.loads(data) for user_id, data in rows
+            })
+        return self._user_data
+
+    def get_chat_data(self) -> defaultdict:
+        return defaultdict(dict)
+
+    def get_bot_data(self) -> Dict:
+        return {}
+
+    def get_callback_data(self):
+        return None
+
+    # --- изменения копятся до следующего сброса ---
+    def update_conversation(self, name: str, key: Tuple[int, ...], new_state: Optional[object]):
+        # Вызывается из нескольких дорожек диспетчера одновременно
+        with self._lock:
+            conversations = self._conversations.setdefault(name, {})
+            if conversations.get(key) == new_state:
+                return
+            if new_state is None:
+                conversations.pop(key, None)
+            else:
+                conversations[key] = new_state
+            self._dirty_conversations[(name, json.dumps(list(key)))] = (
+                None if new_state is None else json.dumps(new_state)
+            )
+
+    def update_user_data(self, user_id: int, data: Dict):
+        try:
+            encoded = json.dumps(data) if data else None
+        except (TypeError, ValueError) as e:
+            logger.warning("⚠️ user_data %s не сериализуется: %s", user_id, e)
+            return
+        with self._lock:
+            self._dirty_users[user_id] = encoded
+
+    def update_chat_data(self, chat_id: int, data: Dict):
+        pass
+
+    def update_bot_data(self, data: Dict):
+        pass
+
+    def update_callback_data(self, data):
+        pass
+
+    def refresh_user_data(self, user_id: int, user_data: Dict):
+        pass
+
+    def refresh_chat_data(self, chat_id: int, chat_data: Dict):
+        pass
+
+    def refresh_bot_data(self, bot_data: Dict):
+        pass
+
+    # --- пакетная запись ---
+    def flush(self):
+        """Записать накопленные изменения одной транзакцией"""
+        with self._lock:
+            conversations, self._dirty_conversations = self._dirty_conversations, {}
+            users, self._dirty_users = self._dirty_users, {}
+        if not conversations and not users:
+            return
+        
+        try:
+            with db.transaction() as conn:
+                conn.executemany(
+                    'DELETE FROM conversations WHERE name = ? AND key = ?',
+                    [key for key, state in conversations.items() if state is None]
+                )
+                conn.executemany(
+                    'INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)',
+                    [(name, key, state) for (name, key), state in conversations.items() if state is not None]
+                )
+                conn.executemany(
+                    'DELETE FROM user_data WHERE user_id = ?',
+                    [(user_id,) for user_id, data in users.items() if data is None]
+                )
+                conn.executemany(
+                    'INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)',
+                    [(user_id, data) for user_id, data in users.items() if data is not None]
+                )
+        except Exception as e:
+            logger.error("❌ Ошибка сохранения состояния диалогов: %s", e)
+            # Вернуть несохраненное, не затирая более свежие изменения
+            with self._lock:
+                self._dirty_conversations = {**conversations, **self._dirty_conversations}
+                self._dirty_users = {**users, **self._dirty_users}
+
+    def start(self):
+        """Запуск периодического сброса изменений в цикле runtime"""
+        self._flusher = runtime.every(self.flush_interval, self.flush)
+
+    def stop(self):
+        """Остановка фонового сброса с финальной записью"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        self.flush()
+
+# =========== ДИСПЕТЧЕР С ДОРОЖКАМИ ===========
+# Обновления разных пользователей обрабатываются параллельно,
+# обновления одного пользователя - строго по очереди
+DISPATCH_LANES = int(os.environ.get('DISPATCH_LANES', '2' if FAST_START else '4'))
+
+class SharedExclusiveLock:
+    """Блокировка "много читателей или один писатель"; ждущий писатель не голодает"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    @contextmanager
+    def shared(self):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+# Дорожки держат shared на время обработки обновления, планировщик - exclusive
+dispatch_gate = SharedExclusiveLock()
+
+class LaneDispatcher(Dispatcher):
+    """Dispatcher с упорядоченными дорожками.
+
+    Обновление попадает в дорожку user_id % lanes (или chat_id, если
+    пользователя нет); у каждой дорожки своя очередь и поток. Все, что не
+    Update (ошибки из очереди и т.п.), обрабатывается сразу, как в Dispatcher.
+    """
+
+    _STOP = object()
+
+    def __init__(self, *args, lanes: int = DISPATCH_LANES, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lane_queues: List[queue.Queue] = [queue.Queue() for _ in range(lanes)]
+        self._lane_threads: List[threading.Thread] = []
+
+    def lane_of(self, update: Update) -> int:
+        user = update.effective_user
+        chat = update.effective_chat
+        key = user.id if user else chat.id if chat else 0
+        return key % len(self.lane_queues)
+
+    def start(self, ready=None):
+        if not self._lane_threads:
+            for index, lane in enumerate(self.lane_queues):
+                thread = threading.Thread(
+                    target=self._lane_loop, args=(lane,), name=f'lane-{index}', daemon=True
+                )
+                thread.start()
+                self._lane_threads.append(thread)
+        super().start(ready)
+
+    def process_update(self, update):
+        if not isinstance(update, Update) or not self._lane_threads:
+            return super().process_update(update)
+        self.lane_queues[self.lane_of(update)].put(update)
+
+    def _lane_loop(self, lane: queue.Queue):
+        while True:
+            update = lane.get()
+            if update is self._STOP:
+                return
+            try:
+                with dispatch_gate.shared():
+                    Dispatcher.process_update(self, update)
+            except Exception as e:
+                logger.error("❌ Ошибка обработки обновления в дорожке: %s", e)
+
+    def stop(self):
+        """Остановить прием, дообработать очереди дорожек и завершить их потоки"""
+        super().stop()
+        for lane in self.lane_queues:
+            lane.put(self._STOP)
+        for thread in self._lane_threads:
+            thread.join(timeout=10)
+        self._lane_threads = []
+
+    def lane_depths(self) -> List[int]:
+        return [lane.qsize() for lane in self.lane_queues]
+
+# =========== ПОКАЗАТЕЛИ ДЛЯ /metrics ===========
+# Показатели из БД считаются в пуле читателей: у потоков запросов HTTP
+# своих соединений нет
+METRICS_DB_TIMEOUT = 5.0
+# /metrics открыт на том же публичном порту, что и вебхук: отдается только
+# с заголовком "Authorization: Bearer $METRICS_TOKEN", без токена выключен
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+METRICS_PATH = '/metrics'
+
+def read_in_pool(func):
+    """Колбэк показателя, выполняющий func в пуле читателей runtime"""
+    return lambda: runtime.run(db_read(func), timeout=METRICS_DB_TIMEOUT)
+
+def _user_counts() -> Dict[Tuple, int]:
+    row = execute_query(
+        '''SELECT COALESCE(SUM(wait_1 = 0 AND wait_2 = 0), 0),
+                  COALESCE(SUM(wait_1 = 1 OR wait_2 = 1), 0),
+                  COALESCE(SUM(count_2 = 1), 0)
+           FROM users''',
+        fetchone=True
+    ) or (0, 0, 0)
+    return {('active',): row[0], ('waiting',): row[1], ('duty',): row[2]}
+
+def _outbox_counts() -> Dict[Tuple, int]:
+    rows = execute_query('SELECT status, COUNT(*) FROM outbox GROUP BY status', fetchall=True)
+    return {(status,): count for status, count in rows or []}
+
+Gauge('coffee_users', 'Пользователи по состоянию', read_in_pool(_user_counts), ('state',))
+Gauge('coffee_outbox', 'Сообщения в очереди исходящих по статусу', read_in_pool(_outbox_counts), ('status',))
+Gauge('coffee_user_cache', 'Статистика кэша пользователей',
+      lambda: {(key,): value for key, value in user_cache.stats().items()}, ('stat',))
+
+Gauge('coffee_log_records_lost', 'Записи лога, не попавшие в вывод',
+      lambda: {('dropped',): log_handler.dropped, ('suppressed',): log_repeat_filter.suppressed_total},
+      ('reason',))
+
+def _lane_depths() -> Dict[Tuple, int]:
+    dispatcher = updater_instance.dispatcher if updater_instance else None
+    if not isinstance(dispatcher, LaneDispatcher):
+        return {}
+    return {(str(index),): depth for index, depth in enumerate(dispatcher.lane_depths())}
+
+Gauge('coffee_leader', 'Держит ли реплика аренду лидера (токен в метке)',
+      lambda: {(str(leader.token),): int(leader.is_leader)}, ('token',))
+Gauge('coffee_dispatch_lane_depth', 'Обновления в очереди дорожки диспетчера', _lane_depths, ('lane',))
+
+# =========== HTTP-СЕРВЕР И ВЕБХУК ===========
+def dispatcher_running() -> bool:
+    """Работает ли поток диспетчера: без него принятые обновления никто не обработает"""
+    dispatcher = updater_instance.dispatcher if updater_instance else None
+    return bool(dispatcher and dispatcher.running)
+
+def health():
+    if not dispatcher_running():
+        return 503, 'text/plain; charset=utf-8', b'Dispatcher is not running'
+    if webhook_failed:
+        return 503, 'text/plain; charset=utf-8', b'Webhook is not registered'
+    return 200, 'text/plain; charset=utf-8', b'OK'
+
+# GET-маршруты: путь -> функция без аргументов, возвращающая (код, content-type, тело)
+HTTP_ROUTES = {
+    '/': lambda: (200, 'text/plain; charset=utf-8', b'OK'),
+    '/healthz': health,
+    METRICS_PATH: lambda: (200, 'text/plain; version=0.0.4; charset=utf-8', render_metrics().encode()),
+}
+http_server = None
+
+@functools.lru_cache(maxsize=None)
+def http_handler_class():
+    """Класс обработчика HTTP; http.server импортируется только при запуске сервера"""
+    from http.server import BaseHTTPRequestHandler
+
+    class BotHTTPRequestHandler(BaseHTTPRequestHandler):
+        """Проверки здоровья платформы и прием обновлений Telegram.
+
+        Локальная проверка вебхука:
+            curl -X POST localhost:$PORT/webhook \\
+                 -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET" \\
+                 -d '{"update_id": 1, "message": {...}}'
+        Показатели:
+            curl -H "Authorization: Bearer $METRICS_TOKEN" localhost:$PORT/metrics
+        """
+        server_version = 'CoffeeBot'
+
+        def handle(self):
+            # ThreadingHTTPServer заводит поток на каждое соединение
+            try:
+                super().handle()
+            finally:
+                db.release()
+
+        def _reply(self, code: int, content_type: str = 'text/plain; charset=utf-8', body: bytes = b''):
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            # Ответ на HEAD - те же заголовки, но без тела
+            if self.command != 'HEAD':
+                self.wfile.write(body)
+
+        def do_GET(self):
+            path = self.path.split('?', 1)[0]
+            route = HTTP_ROUTES.get(path)
+            if route is None or (path == METRICS_PATH and not METRICS_TOKEN):
+                self._reply(404, body=b'Not Found')
+                return
+            if path == METRICS_PATH and not hmac.compare_digest(
+                self.headers.get('Authorization', '').encode(), f'Bearer {METRICS_TOKEN}'.encode()
+            ):
+                self._reply(403, body=b'Forbidden')
+                return
+            self._reply(*route())
+
+        def do_HEAD(self):
+            self.do_GET()
+
+        def do_POST(self):
+            if BOT_MODE != 'webhook' or self.path != WEBHOOK_PATH:
+                self._reply(404, body=b'Not Found')
+                return
+        
+            token = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+            if not hmac.compare_digest(token, WEBHOOK_SECRET):
+                self._reply(403, body=b'Forbidden')
+                return
+            
+            # Без диспетчера обновление потерялось бы; 503 - Telegram повторит доставку
+            if not dispatcher_running():
+                self._reply(503, body=b'Service Unavailable')
+                return
+        
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                data = json.loads(self.rfile.read(length))
+                update = Update.de_json(data, updater_instance.bot)
+            except Exception as e:
+                logger.warning("⚠️ Некорректное обновление вебхука: %s", e)
+                self._reply(400, body=b'Bad Request')
+                return
+        
+            # Обработка - в диспетчере, Telegram получает ответ сразу
+            updater_instance.update_queue.put(update)
+            self._reply(200)
+
+        def log_message(self, format, *args):
+            logger.debug("HTTP %s - %s", self.address_string(), format % args)
+
+    return BotHTTPRequestHandler
+
+def start_http_server():
+    """Запуск HTTP-сервера в фоновом потоке"""
+    from http.server import ThreadingHTTPServer
+    global http_server
+    http_server = ThreadingHTTPServer(('0.0.0.0', PORT), http_handler_class())
+    http_server.daemon_threads = True
+    threading.Thread(target=http_server.serve_forever, name='http', daemon=True).start()
+    logger.info("✅ HTTP-сервер слушает порт %s", PORT)
+
+def stop_http_server():
+    """Остановка HTTP-сервера"""
+    global http_server
+    if http_server:
+        http_server.shutdown()
+        http_server.server_close()
+        http_server = None
+
+def start_webhook(updater) -> threading.Thread:
+    """Режим вебхука: диспетчер читает очередь, которую наполняет HTTP-сервер"""
+    ready = threading.Event()
+
+    def run_dispatcher():
+        try:
+            updater.dispatcher.start(ready=ready)
+        except Exception:
+            logger.exception("❌ Диспетчер обновлений остановился с ошибкой")
+        finally:
+            ready.set()
+
+    dispatcher_thread = threading.Thread(target=run_dispatcher, name='dispatcher', daemon=True)
+    dispatcher_thread.start()
+    ready.wait()
+    return dispatcher_thread
+
+# Telegram отверг вебхук: обновлений не будет, /healthz сообщает об этом платформе
+webhook_failed = False
+
+def register_webhook(bot):
+    """Зарегистрировать вебхук в Telegram (в фоне: прием уже работает)"""
+    global webhook_failed
+    if not WEBHOOK_URL:
+        logger.warning("⚠️ WEBHOOK_URL не задан: вебхук не регистрируется, принимаем только локальные POST")
+        return
+    try:
+        bot.set_webhook(
+            url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            api_kwargs={'secret_token': WEBHOOK_SECRET}
+        )
+        logger.info("✅ Вебхук установлен: %s%s", WEBHOOK_URL.rstrip('/'), WEBHOOK_PATH)
+        webhook_failed = False
+    except Exception as e:
+        webhook_failed = True
+        logger.error("❌ Не удалось установить вебхук: %s", e)
+
+def wait_for_shutdown_signal():
+    """Ждать SIGINT/SIGTERM/SIGABRT"""
+    stop_event = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+        signal.signal(signum, lambda *args: stop_event.set())
+    stop_event.wait()
+
+# =========== ОТЧЕТ О ХОЛОДНОМ СТАРТЕ ===========
+class StartupTimer:
+    """Длительности фаз запуска, отсчет - от начала импорта модуля"""
+
+    def __init__(self, origin: float = _PROCESS_START):
+        self.origin = origin
+        self._last = origin
+        self.phases: List[Tuple[str, float]] = []
+
+    def mark(self, phase: str):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    def report(self):
+        total = self._last - self.origin
+        lines = [f"{phase}: {seconds * 1000:.0f} мс" for phase, seconds in self.phases]
+        try:
+            import resource
+            rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            lines.append(f"пиковая память: {rss_mb:.1f} МБ")
+        except ImportError:
+            pass
+        logger.info("🚀 Запуск за %.0f мс (%s)", total * 1000, '; '.join(lines))
+
+startup_timer = StartupTimer()
+Gauge('coffee_startup_seconds', 'Длительность фаз запуска',
+      lambda: {(phase,): seconds for phase, seconds in startup_timer.phases}, ('phase',))
+
+def warm_user_cache():
+    """Загрузить всех пользователей в кэш одним запросом"""
+    generation = user_cache.generation
+    rows = execute_query(USER_SELECT, fetchall=True) or []
+    for row in rows[:user_cache.max_size]:
+        user_cache.put_user(row[0], UserRecord(row), generation)
+    logger.info("✅ Кэш пользователей прогрет: %d записей", min(len(rows), user_cache.max_size))
+
+def finish_startup(updater):
+    """Все, что не нужно для первого ответа, - уже после начала приема обновлений"""
+    try:
+        _finish_startup(updater)
+    finally:
+        db.release()
+
+def _finish_startup(updater):
+    leader.start()
+    startup_timer.mark('выбор лидера')
+    outbox_drainer.start()
+    start_scheduler()
+    startup_timer.mark('планировщик')
+    
+    if BOT_MODE == 'webhook':
+        register_webhook(updater.bot)
+        startup_timer.mark('регистрация вебхука')
+    
+    if not FAST_START:
+        warm_user_cache()
+        startup_timer.mark('прогрев кэша')
+    
+    startup_timer.report()
+
 # =========== ОСНОВНАЯ ФУНКЦИЯ ===========
 def main():
     """Основная функция запуска бота"""
     global updater_instance
+    startup_timer.mark('импорт модулей')
     
     # Инициализация базы данных
     init_database()
+    startup_timer.mark('схема БД')
     
     # Загрузка статуса скриптов из БД
     global SCRIPTS_ENABLED
     SCRIPTS_ENABLED = get_scripts_enabled()
-    logger.info(f"✅ Статус скриптов: {'ВКЛЮЧЕНЫ' if SCRIPTS_ENABLED else 'ОТКЛЮЧЕНЫ'}")
+    logger.info("✅ Статус скриптов: %s", 'ВКЛЮЧЕНЫ' if SCRIPTS_ENABLED else 'ОТКЛЮЧЕНЫ')
     
-    # Создание Updater (старый стиль для версии 13.x)
-    updater = Updater(token=BOT_TOKEN, use_context=True)
+    # Состояния диалогов переживают рестарт
+    persistence = SQLitePersistence()
+    persistence.start()
+    
+    # Создание Updater (старый стиль для версии 13.x); бот считает вызовы API,
+    # диспетчер раскладывает обновления по дорожкам пользователей
+    request = Request(con_pool_size=RUNTIME_IO_WORKERS + DISPATCH_LANES + 8)
+    # Updater запускает job_queue вместе с приемом обновлений - создаем ее, как он сам
+    job_queue = JobQueue()
+    dispatcher = LaneDispatcher(
+        InstrumentedBot(BOT_TOKEN, request=request),
+        queue.Queue(),
+        workers=2 if FAST_START else 4,
+        job_queue=job_queue,
+        persistence=persistence,
+        use_context=True
+    )
+    job_queue.set_dispatcher(dispatcher)
+    # workers=None: потоки задает сам диспетчер, иначе PTB отвергает dispatcher
+    updater = Updater(dispatcher=dispatcher, workers=None)
     updater_instance = updater
     
     # Получаем диспетчер для регистрации обработчиков
@@ -776,48 +4019,94 @@ def main():
     
     # Настройка ConversationHandler
     conv_handler = ConversationHandler(
-        entry_points=[CommandHandler('start', start)],
+        entry_points=[CommandHandler('start', instrument_handler(start))],
         states={
             REGISTRATION: [
-                MessageHandler(Filters.text & ~Filters.command, registration)
+                MessageHandler(Filters.text & ~Filters.command, instrument_handler(registration))
             ],
             POLL: [
-                CallbackQueryHandler(poll_handler)
+                CallbackQueryHandler(instrument_handler(poll_handler))
             ],
             MAIN_COFFEE: [
-                CallbackQueryHandler(main_coffee_handler)
+                CallbackQueryHandler(instrument_handler(main_coffee_handler))
             ],
             RARE_COFFEE: [
-                CallbackQueryHandler(rare_coffee_handler)
+                CallbackQueryHandler(instrument_handler(rare_coffee_handler))
             ],
         },
-        fallbacks=[CommandHandler('cancel', cancel)],
+        fallbacks=[CommandHandler('cancel', instrument_handler(cancel))],
+        name=CONVERSATION_NAME,
+        persistent=True,
     )
     
     # Добавление обработчиков команд
     dp.add_handler(conv_handler)
-    dp.add_handler(CommandHandler('status', status))
-    dp.add_handler(CommandHandler('hollidaon', hollidaon))
-    dp.add_handler(CommandHandler('hollidayoff', hollidayoff))
-    dp.add_handler(CommandHandler('run_script', run_script))
-    
-    # Запуск собственного планировщика
-    start_scheduler()
+    dp.add_handler(CommandHandler('status', instrument_handler(status)))
+    dp.add_handler(CommandHandler('team', instrument_handler(team)))
+    dp.add_handler(CommandHandler('teamchat', instrument_handler(teamchat)))
+    dp.add_handler(CommandHandler('notify', instrument_handler(notify)))
+    dp.add_handler(CommandHandler('leaderboard', instrument_handler(leaderboard)))
+    dp.add_handler(CommandHandler('schedule', instrument_handler(schedule)))
+    dp.add_handler(CommandHandler('hollidaon', instrument_handler(hollidaon)))
+    dp.add_handler(CommandHandler('hollidayoff', instrument_handler(hollidayoff)))
+    dp.add_handler(CommandHandler('run_script', instrument_handler(run_script)))
+    dp.add_handler(CommandHandler('profile', instrument_handler(profile)))
+    dp.add_handler(CommandHandler('cache_stats', instrument_handler(cache_stats)))
+    startup_timer.mark('обработчики и состояние диалогов')
     
     # Запуск бота
     logger.info("✅ Бот запущен и готов к работе!")
     logger.info("📋 Доступные команды:")
     logger.info("  /start - начать работу")
     logger.info("  /status - показать статус")
+    logger.info("  /team <название> - выбрать команду (офис)")
+    logger.info("  /leaderboard - лучшие дежурные команды")
+    logger.info("  /schedule - расписание команды и ближайшие запуски")
     logger.info("  /hollidaon - отключить автоскрипты")
     logger.info("  /hollidayoff - включить автоскрипты")
     logger.info("  /run_script <номер> - запустить скрипт вручную")
     
-    # Запускаем поллинг
-    updater.start_polling()
+    # Токен и сеть проверяются до приема обновлений: иначе getMe упадет в потоке
+    # диспетчера, а HTTP-сервер будет принимать обновления, которые некому обработать
+    try:
+        me = updater.bot.get_me()
+    except Exception as e:
+        logger.error("❌ Не удалось получить данные бота (getMe): %s", e)
+        persistence.stop()
+        runtime.stop()
+        db.close_all()
+        sys.exit(1)
+    logger.info("✅ Бот @%s", me.username)
+    startup_timer.mark('проверка токена')
+    
+    # HTTP-порт нужен платформе для проверок здоровья в обоих режимах
+    start_http_server()
+    
+    # Сначала начинаем принимать обновления, остальное догружается в фоне
+    if BOT_MODE == 'webhook':
+        dispatcher_thread = start_webhook(updater)
+    else:
+        updater.start_polling()
+    startup_timer.mark('прием обновлений')
+    threading.Thread(target=finish_startup, args=(updater,), name='startup', daemon=True).start()
     
     # Ожидаем завершения
-    updater.idle()
+    if BOT_MODE == 'webhook':
+        wait_for_shutdown_signal()
+        logger.info("⏹️ Остановка вебхука")
+        updater.dispatcher.stop()
+        dispatcher_thread.join(timeout=10)
+    else:
+        updater.idle()
+    
+    # Закрываем соединения с БД
+    stop_http_server()
+    stop_scheduler()
+    outbox_drainer.stop()
+    leader.release()
+    persistence.stop()
+    runtime.stop()
+    db.close_all()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+👑 Проверка аренды лидера на нескольких процессах Coffee Duty Bot
+Запускает несколько реплик на одном файле SQLite. Первый лидер выполняет
+слот и падает, не отдав аренду. Проверяется, что слот выполнен ровно один
+раз, а другая реплика в пределах LEASE_TTL стала лидером со следующим
+токеном и выполнила второй слот.
+
+Пример:
+    python lease_check.py --replicas 3 --ttl 1.5
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+SLOTS = ('2026-01-05T13:00:00', '2026-01-05T20:00:00')
+RUNS_KEY = 'lease_check_runs:'
+# Файлы-сигналы рядом с БД: остановить работу, итог записан, можно отдать аренду
+STOP_FILE = 'stop'
+DONE_PREFIX = 'done-'
+RELEASE_FILE = 'release'
+
+def wait_for(predicate, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+# =========== РЕПЛИКА ===========
+def run_replica(signal_dir: str):
+    """Одна реплика: держит аренду и выполняет слоты, пока лидер.
+
+    Итог реплика сообщает до того, как кто-либо отдаст аренду: иначе
+    освобожденную аренду подхватил бы сосед со следующим токеном.
+    """
+    from datetime import datetime
+    import logging
+    logging.disable(logging.INFO)
+    import bot
+
+    bot.init_database()
+    bot.leader.start()
+
+    def job_for(slot: str):
+        def job(teams):
+            bot.execute_query(
+                '''INSERT INTO settings (key, value) VALUES (?, '1')
+                   ON CONFLICT (key) DO UPDATE SET value = value + 1''',
+                (RUNS_KEY + slot,),
+                commit=True
+            )
+        return job
+
+    stop_file = os.path.join(signal_dir, STOP_FILE)
+    took_over = False
+    while not os.path.exists(stop_file):
+        if bot.leader.is_leader:
+            token = bot.leader.token
+            if token > 1 and not took_over:
+                took_over = True
+                print(json.dumps({'event': 'lead', 'token': token, 'at': time.time()}), flush=True)
+            for slot in SLOTS[:1] if token == 1 else SLOTS:
+                bot.run_scheduled_job('lease_check', [bot.DEFAULT_TEAM_ID], datetime.fromisoformat(slot), job_for(slot))
+            if token == 1:
+                # Падение без release(): аренду придется дожидаться по TTL
+                print(json.dumps({'event': 'crash', 'token': token, 'at': time.time()}), flush=True)
+                os._exit(0)
+        time.sleep(0.05)
+
+    print(json.dumps({'event': 'exit', 'token': bot.leader.token, 'leader': bot.leader.is_leader,
+                      'at': time.time()}), flush=True)
+    open(os.path.join(signal_dir, f'{DONE_PREFIX}{os.getpid()}'), 'w').close()
+    wait_for(lambda: os.path.exists(os.path.join(signal_dir, RELEASE_FILE)), timeout=30)
+    bot.leader.release()
+    bot.runtime.stop()
+    bot.db.close_all()
+
+# =========== ПРОВЕРКА ===========
+def run_check(args) -> bool:
+    signal_dir = tempfile.mkdtemp(prefix='coffee_lease_')
+    db_file = os.path.join(signal_dir, 'lease.db')
+    env = dict(os.environ, BOT_TOKEN=os.environ.get('BOT_TOKEN', '0:lease'), DB_FILE=db_file,
+               LEASE_TTL=str(args.ttl), MULTI_REPLICA='1')
+    command = [sys.executable, __file__, '--replica', signal_dir]
+    # Схему создает первая реплика, остальные стартуют на готовой БД
+    replicas = [subprocess.Popen(command, env=env, stdout=subprocess.PIPE, text=True)]
+    time.sleep(args.ttl / 3)
+    replicas += [
+        subprocess.Popen(command, env=env, stdout=subprocess.PIPE, text=True)
+        for _ in range(args.replicas - 1)
+    ]
+
+    time.sleep(args.life)
+    open(os.path.join(signal_dir, STOP_FILE), 'w').close()
+    # Упавший лидер итог не записывает; остальные ждут, пока снимем состояние БД
+    wait_for(lambda: sum(name.startswith(DONE_PREFIX) for name in os.listdir(signal_dir))
+             >= args.replicas - 1, timeout=30)
+    with sqlite3.connect(db_file) as conn:
+        runs = dict(conn.execute('SELECT key, value FROM settings WHERE key LIKE ?', (RUNS_KEY + '%',)))
+        lease = conn.execute('SELECT token FROM leases WHERE name = ?', ('scheduler',)).fetchone()
+    open(os.path.join(signal_dir, RELEASE_FILE), 'w').close()
+
+    events = []
+    for replica in replicas:
+        out, _ = replica.communicate(timeout=30)
+        events += [json.loads(line) for line in out.splitlines() if line.startswith('{')]
+    shutil.rmtree(signal_dir, ignore_errors=True)
+    crashes = [event for event in events if event['event'] == 'crash']
+    takeovers = [event for event in events if event['event'] == 'lead']
+    leaders = [event for event in events if event['event'] == 'exit' and event['leader']]
+    # Захват - не позже TTL плюс период продления после падения
+    takeover_limit = args.ttl + args.ttl / 3 + 0.5
+
+    checks = {
+        'первый лидер упал с токеном 1': len(crashes) == 1 and crashes[0]['token'] == 1,
+        'слот 1 выполнен ровно один раз': int(runs.get(RUNS_KEY + SLOTS[0], 0)) == 1,
+        'слот 2 выполнен ровно один раз': int(runs.get(RUNS_KEY + SLOTS[1], 0)) == 1,
+        'аренду перехватили в пределах TTL': len(crashes) == 1 and len(takeovers) == 1
+            and takeovers[0]['at'] - crashes[0]['at'] <= takeover_limit,
+        'лидером стала одна реплика с токеном 2': len(leaders) == 1 and leaders[0]['token'] == 2,
+        'токен в БД равен 2': bool(lease) and lease[0] == 2,
+    }
+    for name, ok in checks.items():
+        print(f"{'✅' if ok else '❌'} {name}")
+    if crashes and takeovers:
+        print(f"⏱️ Перехват аренды через {takeovers[0]['at'] - crashes[0]['at']:.2f} с (TTL {args.ttl} с)")
+    print(f"📄 Запуски слотов: {runs}")
+    return all(checks.values())
+
+def main():
+    parser = argparse.ArgumentParser(description='Проверка аренды лидера на нескольких процессах')
+    parser.add_argument('--replicas', type=int, default=3, help='число процессов-реплик')
+    parser.add_argument('--ttl', type=float, default=1.5, help='LEASE_TTL реплик, секунды')
+    parser.add_argument('--life', type=float, default=6.0, help='сколько живет каждая реплика, секунды')
+    parser.add_argument('--replica', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.replica is not None:
+        run_replica(args.replica)
+        return
+    sys.exit(0 if run_check(args) else 1)
+
+if __name__ == '__main__':
+    main()
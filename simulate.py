@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+🎲 Офлайн-симулятор дежурств Coffee Duty Bot
+Прогоняет правила script_1..script_5 и лотерею script_2 (случайный среди
+максимального count_1) на месяцах рабочих дней без БД и Telegram. Состояние
+хранится в плоских массивах, а не в строках SQL.
+
+Пример:
+    python simulate.py --users 5000 --days 260 --mix daily=0.7,rare=0.3 --refuse 0.1 --picky 0.1:0.6
+"""
+
+import argparse
+import json
+import random
+import statistics
+import time
+from array import array
+from typing import Dict, List, Optional
+
+DAILY, RARE = 0, 1
+GROUP_NAMES = ('daily', 'rare')
+
+# =========== СОСТОЯНИЕ ===========
+class Roster:
+    """Колонки таблицы users в виде массивов, индекс - номер пользователя"""
+
+    def __init__(self, users: int, teams: int, mix: Dict[str, float], picky_share: float,
+                 rng: random.Random):
+        kinds = rng.choices((DAILY, RARE), weights=(mix.get('daily', 0.0), mix.get('rare', 0.0)), k=users)
+        self.size = users
+        self.kind = array('b', kinds)
+        self.team = array('i', (rng.randrange(teams) for _ in range(users)))
+        self.picky = array('b', (rng.random() < picky_share for _ in range(users)))
+        self.count_1 = array('i', [0]) * users
+        self.count_2 = array('b', [0]) * users
+        # Редкие приходят домой с wait_1 = 1, как после script_5
+        self.wait_1 = array('b', (kind == RARE for kind in kinds))
+        self.wait_2 = array('b', [0]) * users
+        self.members: List[List[int]] = [[] for _ in range(teams)]
+        for index, team in enumerate(self.team):
+            self.members[team].append(index)
+        self.daily = [i for i in range(users) if kinds[i] == DAILY]
+        self.rare = [i for i in range(users) if kinds[i] == RARE]
+
+# =========== ПРАВИЛА (КАК В bot.py) ===========
+def script_1(roster: Roster):
+    """Прирост кофе: count_1 += 1 у ежедневных с wait_1 = 0"""
+    count_1, wait_1 = roster.count_1, roster.wait_1
+    for i in roster.daily:
+        if not wait_1[i]:
+            count_1[i] += 1
+
+def pick_duty(roster: Roster, team: int, rng: random.Random) -> Optional[int]:
+    """script_2 для команды: случайный из активных с максимальным count_1 > 0"""
+    count_1, wait_1, wait_2, count_2 = roster.count_1, roster.wait_1, roster.wait_2, roster.count_2
+    best, candidates = 0, []
+    for i in roster.members[team]:
+        if wait_1[i] or wait_2[i]:
+            continue
+        if count_1[i] > best:
+            best, candidates = count_1[i], [i]
+        elif count_1[i] == best and best > 0:
+            candidates.append(i)
+    if not candidates:
+        return None
+    chosen = rng.choice(candidates)
+    # Прежний дежурный снимается тем же UPDATE
+    for i in roster.members[team]:
+        count_2[i] = 0
+    count_2[chosen] = 1
+    return chosen
+
+def script_3(roster: Roster):
+    """Обнуление Печальки"""
+    roster.wait_2 = array('b', [0]) * roster.size
+
+def script_4(roster: Roster, stats: 'Stats', day: int):
+    """Погашение дежурства: дежурный отработал, count_1 = 0"""
+    for i in range(roster.size):
+        if roster.count_2[i]:
+            roster.count_2[i] = 0
+            roster.count_1[i] = 0
+            stats.complete(i, day)
+
+def script_5(roster: Roster):
+    """Уход домой неполнозанятых"""
+    for i in roster.rare:
+        roster.wait_1[i] = 1
+
+# =========== СТАТИСТИКА ===========
+class Stats:
+    """Счетчики по пользователям и по дням"""
+
+    def __init__(self, users: int):
+        self.duties = array('i', [0]) * users
+        self.refusals = array('i', [0]) * users
+        self.last_duty = array('i', [-1]) * users
+        self.longest_gap = array('i', [0]) * users
+        self.cascades: List[int] = []
+        self.empty_days = 0
+
+    def complete(self, user: int, day: int):
+        self.duties[user] += 1
+        self.longest_gap[user] = max(self.longest_gap[user], day - self.last_duty[user] - 1)
+        self.last_duty[user] = day
+
+    def finish(self, days: int):
+        """Хвост после последнего дежурства - тоже промежуток"""
+        for user, last in enumerate(self.last_duty):
+            self.longest_gap[user] = max(self.longest_gap[user], days - last - 1)
+
+# =========== СИМУЛЯЦИЯ ===========
+def simulate_day(roster: Roster, stats: Stats, day: int, args, rng: random.Random):
+    # Утро: ежедневные иногда отсутствуют, редкие иногда приходят и отмечаются
+    for i in roster.daily:
+        roster.wait_1[i] = rng.random() < args.absent
+    for i in roster.rare:
+        if rng.random() < args.attend_rare:
+            roster.count_1[i] += 1
+            roster.wait_1[i] = 0
+
+    # 13:00 - script_1, script_2
+    script_1(roster)
+    for team in range(len(roster.members)):
+        duty = pick_duty(roster, team, rng)
+        refusals = 0
+        # Отказ - wait_2 = 1, count_2 = 0 и перевыбор, пока кто-то не согласится
+        while duty is not None:
+            chance = args.picky_refuse if roster.picky[duty] else args.refuse
+            if rng.random() >= chance:
+                break
+            refusals += 1
+            stats.refusals[duty] += 1
+            roster.wait_2[duty] = 1
+            roster.count_2[duty] = 0
+            duty = pick_duty(roster, team, rng)
+        stats.cascades.append(refusals)
+        if duty is None:
+            stats.empty_days += 1
+
+    # 20:00 - script_3, script_4, script_5
+    script_3(roster)
+    script_4(roster, stats, day)
+    script_5(roster)
+
+def percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))]
+
+def gini(values: List[int]) -> float:
+    """Коэффициент Джини: 0 - дежурят поровну, 1 - дежурит один"""
+    ordered = sorted(values)
+    total = sum(ordered)
+    if not total:
+        return 0.0
+    weighted = sum((index + 1) * value for index, value in enumerate(ordered))
+    return (2 * weighted) / (len(ordered) * total) - (len(ordered) + 1) / len(ordered)
+
+def summarize(values: List[int]) -> Dict[str, float]:
+    return {
+        'users': len(values),
+        'mean': statistics.fmean(values) if values else 0.0,
+        'p50': percentile(values, 50),
+        'p90': percentile(values, 90),
+        'max': max(values, default=0),
+    }
+
+def report(roster: Roster, stats: Stats, args, elapsed: float) -> Dict:
+    groups = {
+        'daily': [i for i in roster.daily if not roster.picky[i]],
+        'rare': [i for i in roster.rare if not roster.picky[i]],
+        'picky': [i for i in range(roster.size) if roster.picky[i]],
+    }
+    duties = list(stats.duties)
+    result = {
+        'params': {
+            'users': args.users, 'teams': args.teams, 'days': args.days, 'mix': args.mix,
+            'attend_rare': args.attend_rare, 'absent': args.absent, 'refuse': args.refuse,
+            'picky_share': args.picky_share, 'picky_refuse': args.picky_refuse, 'seed': args.seed,
+        },
+        'elapsed_sec': elapsed,
+        'duties': {**summarize(duties), 'gini': gini(duties),
+                   'never': sum(1 for d in duties if not d) / max(1, len(duties))},
+        'longest_gap_days': summarize(list(stats.longest_gap)),
+        'refusals': {
+            'total': sum(stats.refusals),
+            'per_team_day': statistics.fmean(stats.cascades) if stats.cascades else 0.0,
+            'longest_cascade': max(stats.cascades, default=0),
+            'days_without_duty': stats.empty_days,
+        },
+        'groups': {
+            name: {
+                **summarize([duties[i] for i in members]),
+                'refusals_mean': statistics.fmean([stats.refusals[i] for i in members]) if members else 0.0,
+                'longest_gap_p90': percentile([stats.longest_gap[i] for i in members], 90),
+            }
+            for name, members in groups.items() if members
+        },
+    }
+    return result
+
+def print_report(result: Dict):
+    d, g, r = result['duties'], result['longest_gap_days'], result['refusals']
+    print(f"🎲 {result['params']['users']} пользователей, {result['params']['teams']} команд, "
+          f"{result['params']['days']} рабочих дней - {result['elapsed_sec']:.2f} с")
+    print(f"Дежурств на человека: среднее {d['mean']:.2f}, p50 {d['p50']}, p90 {d['p90']}, "
+          f"макс {d['max']}, Джини {d['gini']:.3f}, ни разу {d['never'] * 100:.1f}%")
+    print(f"Самый длинный промежуток без дежурства (дней): p50 {g['p50']}, p90 {g['p90']}, макс {g['max']}")
+    print(f"Отказы: всего {r['total']}, на команду в день {r['per_team_day']:.2f}, "
+          f"самая длинная цепочка {r['longest_cascade']}, дней без дежурного {r['days_without_duty']}")
+    for name, group in result['groups'].items():
+        print(f"  {name:<6} {group['users']:>6} чел.: дежурств {group['mean']:.2f} (p90 {group['p90']}), "
+              f"отказов {group['refusals_mean']:.2f}, промежуток p90 {group['longest_gap_p90']}")
+
+def parse_mix(text: str) -> Dict[str, float]:
+    """daily=0.7,rare=0.3 -> нормированные доли"""
+    mix = {'daily': 0.0, 'rare': 0.0}
+    for part in text.split(','):
+        key, value = part.split('=')
+        mix[key.strip()] = float(value)
+    total = sum(mix.values()) or 1.0
+    return {key: value / total for key, value in mix.items()}
+
+def parse_picky(text: str):
+    """'доля:вероятность отказа' -> (float, float)"""
+    share, chance = text.split(':')
+    return float(share), float(chance)
+
+def main():
+    parser = argparse.ArgumentParser(description='Симуляция дежурств Coffee Duty Bot')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--teams', type=int, default=1)
+    parser.add_argument('--days', type=int, default=260, help='рабочих дней (260 - примерно год)')
+    parser.add_argument('--mix', default='daily=0.7,rare=0.3', type=parse_mix,
+                        help='состав: доли daily/rare')
+    parser.add_argument('--attend-rare', type=float, default=0.3,
+                        help='вероятность, что редкий придет и отметится до 13:00')
+    parser.add_argument('--absent', type=float, default=0.05,
+                        help='вероятность временного отсутствия ежедневного')
+    parser.add_argument('--refuse', type=float, default=0.1, help='вероятность отказа дежурного')
+    parser.add_argument('--picky', default='0:0', type=parse_picky,
+                        help='доля "часто отказывающихся" и их вероятность отказа, например 0.1:0.6')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', help='записать результаты в JSON-файл')
+    args = parser.parse_args()
+    args.picky_share, args.picky_refuse = args.picky
+
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+    roster = Roster(args.users, args.teams, args.mix, args.picky_share, rng)
+    stats = Stats(args.users)
+    for day in range(args.days):
+        simulate_day(roster, stats, day, args, rng)
+    stats.finish(args.days)
+    result = report(roster, stats, args, time.perf_counter() - started)
+
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"📄 Результаты записаны в {args.json}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+"""Общая подготовка тестов: bot.py импортируется на временной БД без сети"""
+
+import logging
+import os
+import sys
+import tempfile
+
+import pytest
+
+# bot.py читает окружение при импорте: токен-заглушка и временная БД
+_TMP_DIR = tempfile.mkdtemp(prefix='coffee_tests_')
+os.environ.setdefault('BOT_TOKEN', '0:tests')
+os.environ['DB_FILE'] = os.path.join(_TMP_DIR, 'tests.db')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+logging.disable(logging.INFO)
+
+import bot  # noqa: E402
+
+def remove_database():
+    """Закрыть соединения и удалить файлы БД вместе с WAL"""
+    bot.db.close_all()
+    for suffix in ('', '-wal', '-shm'):
+        path = bot.DB_FILE + suffix
+        if os.path.exists(path):
+            os.remove(path)
+    bot.user_cache.invalidate_all()
+
+@pytest.fixture
+def fresh_db(monkeypatch):
+    """Пустая БД последней версии схемы; реплика - лидер без аренды"""
+    remove_database()
+    bot.init_database()
+    monkeypatch.setattr(bot.leader, 'token', None)
+    monkeypatch.setattr(bot.leader, '_expires_at', 0.0)
+    monkeypatch.setattr(bot, 'decline_debouncer', bot.DeclineDebouncer())
+    yield bot
+    remove_database()
+
+@pytest.fixture
+def add_user(fresh_db):
+    """Завести пользователя с нужными полями: add_user(user_id, count_1=3, ...)"""
+    def add(user_id: int, **fields):
+        fields = dict({'name': f'User {user_id}', 'freq': bot.FREQ_DAILY}, **fields)
+        columns = ', '.join(['user_id', *fields])
+        placeholders = ', '.join('?' * (len(fields) + 1))
+        bot.execute_query(
+            f'INSERT INTO users ({columns}) VALUES ({placeholders})',
+            (user_id, *fields.values()),
+            commit=True
+        )
+        bot.user_cache.invalidate_all()
+    return add
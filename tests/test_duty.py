@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+"""Выбор дежурного и перевыбор при отказе"""
+
+def duty_of(bot, team_id):
+    duty = bot.get_duty_user(team_id)
+    return duty[0] if duty else None
+
+def test_script_2_picks_the_active_user_with_the_highest_count(fresh_db, add_user):
+    add_user(1, count_1=5)
+    add_user(2, count_1=9, wait_1=1)
+    add_user(3, count_1=7)
+
+    fresh_db.script_2(fresh_db.DEFAULT_TEAM_ID)
+
+    assert duty_of(fresh_db, fresh_db.DEFAULT_TEAM_ID) == 3
+
+def test_script_2_keeps_a_single_duty_per_team(fresh_db, add_user):
+    team = fresh_db.get_or_create_team('Офис')
+    add_user(1, count_1=5, count_2=1)
+    add_user(2, count_1=9)
+    add_user(3, count_1=4, team_id=team)
+
+    fresh_db.script_2()
+
+    duties = fresh_db.execute_query('SELECT user_id FROM users WHERE count_2 = 1 ORDER BY user_id', fetchall=True)
+    assert duties == [(2,), (3,)]
+
+def test_duty_declining_reselects(fresh_db, add_user):
+    add_user(1, count_1=9, count_2=1)
+    add_user(2, count_1=5)
+
+    assert fresh_db.decline_duty(1) == (fresh_db.DEFAULT_TEAM_ID, True)
+
+    assert duty_of(fresh_db, fresh_db.DEFAULT_TEAM_ID) == 2
+    user = fresh_db.get_user_data(1)
+    assert (user['wait_2'], user['count_2']) == (1, 0)
+
+def test_other_user_declining_keeps_the_duty(fresh_db, add_user):
+    add_user(1, count_1=3, count_2=1)
+    add_user(2, count_1=9)
+
+    assert fresh_db.decline_duty(2) == (fresh_db.DEFAULT_TEAM_ID, False)
+
+    assert duty_of(fresh_db, fresh_db.DEFAULT_TEAM_ID) == 1
+
+def test_declining_without_a_duty_selects_one(fresh_db, add_user):
+    add_user(1, count_1=3)
+    add_user(2, count_1=9)
+
+    assert fresh_db.decline_duty(2) == (fresh_db.DEFAULT_TEAM_ID, True)
+
+    assert duty_of(fresh_db, fresh_db.DEFAULT_TEAM_ID) == 1
+
+def test_repeated_decline_is_debounced(fresh_db, add_user):
+    add_user(1, count_1=9, count_2=1)
+    add_user(2, count_1=5)
+    fresh_db.decline_duty(1)
+
+    assert fresh_db.decline_duty(1) is None
+
+def test_decline_reselects_only_in_the_users_team(fresh_db, add_user):
+    team = fresh_db.get_or_create_team('Офис')
+    add_user(1, count_1=9, count_2=1)
+    add_user(2, count_1=5)
+    add_user(3, count_1=4, count_2=1, team_id=team)
+
+    assert fresh_db.decline_duty(1) == (fresh_db.DEFAULT_TEAM_ID, True)
+
+    assert duty_of(fresh_db, fresh_db.DEFAULT_TEAM_ID) == 2
+    assert duty_of(fresh_db, team) == 3
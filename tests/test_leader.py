@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+"""Аренда лидера и токен ограждения запусков по расписанию"""
+
+import time
+from datetime import datetime
+
+SLOT = datetime(2026, 1, 5, 13, 0)
+
+def lease_row(bot):
+    return bot.execute_query('SELECT holder, token, expires_at FROM leases', fetchone=True)
+
+def take_over(bot, holder='other'):
+    """Аренду перехватила другая реплика, а эта еще считает себя лидером"""
+    bot.execute_query(
+        'UPDATE leases SET holder = ?, token = token + 1, expires_at = ?',
+        (holder, time.time() + 60),
+        commit=True
+    )
+
+def expire(bot):
+    """Своя аренда истекла: продлить ее вовремя не удалось"""
+    bot.execute_query('UPDATE leases SET expires_at = 0', commit=True)
+    bot.leader._expires_at = 0.0
+
+def never_called(teams):
+    raise AssertionError('задание не должно выполняться')
+
+def test_renewal_keeps_the_token_and_extends_the_lease(fresh_db):
+    assert fresh_db.leader.heartbeat() == 1
+    expires_at = lease_row(fresh_db)[2]
+    time.sleep(0.01)
+
+    assert fresh_db.leader.heartbeat() == 1
+    assert lease_row(fresh_db)[2] > expires_at
+    assert fresh_db.leader.is_leader
+
+def test_live_lease_of_another_replica_is_not_taken(fresh_db):
+    fresh_db.leader.heartbeat()
+    take_over(fresh_db)
+
+    assert fresh_db.leader.heartbeat() is None
+    assert not fresh_db.leader.is_leader
+    assert fresh_db.leader.held_elsewhere()
+
+def test_reacquiring_an_expired_own_lease_issues_a_new_token(fresh_db):
+    fresh_db.leader.heartbeat()
+    expire(fresh_db)
+
+    assert fresh_db.leader.heartbeat() == 2
+
+def test_follower_does_not_run_the_slot(fresh_db):
+    assert fresh_db.run_scheduled_job('job', [fresh_db.DEFAULT_TEAM_ID], SLOT, never_called) is None
+    assert fresh_db.get_last_run('job') is None
+
+def test_stale_token_aborts_the_slot(fresh_db):
+    fresh_db.leader.heartbeat()
+    take_over(fresh_db)
+
+    assert fresh_db.leader.is_leader
+    assert fresh_db.run_scheduled_job('job', [fresh_db.DEFAULT_TEAM_ID], SLOT, never_called) is None
+    assert fresh_db.get_last_run('job') is None
+
+def test_unowned_slots_are_deferred(fresh_db, monkeypatch):
+    monkeypatch.setitem(fresh_db.SCHEDULED_JOB_FUNCS, 'job', never_called)
+    fresh_db.leader.heartbeat()
+    expire(fresh_db)
+
+    due = [(SLOT, 'job', fresh_db.DEFAULT_TEAM_ID)]
+    assert fresh_db.run_due_jobs(due) == due
+
+def test_slots_owned_by_another_leader_are_not_deferred(fresh_db, monkeypatch):
+    monkeypatch.setitem(fresh_db.SCHEDULED_JOB_FUNCS, 'job', never_called)
+    fresh_db.leader.heartbeat()
+    take_over(fresh_db)
+    fresh_db.leader._expires_at = 0.0
+
+    assert fresh_db.run_due_jobs([(SLOT, 'job', fresh_db.DEFAULT_TEAM_ID)]) == []
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+"""Миграции схемы с базы, созданной версией бота до миграций"""
+
+import sqlite3
+
+import pytest
+
+import bot
+from conftest import remove_database
+
+# Схема и данные в том виде, в каком их оставлял init_database до миграций
+BASELINE_USERS = [
+    # user_id, name, chastota, count_1, count_2, wait_1, wait_2
+    (1, 'Daily', 'Каждый день', 4, 1, 0, 0),
+    (2, 'Rare', 'Я тут не каждый день', 2, 0, 1, 0),
+    (3, 'Unset', None, None, None, None, None),
+    (4, 'Odd flags', 'Каждый день', -3, 2, 5, 1),
+]
+
+@pytest.fixture
+def baseline_db():
+    """Файл БД без settings.schema_version с таблицами users и settings"""
+    remove_database()
+    conn = sqlite3.connect(bot.DB_FILE)
+    conn.executescript('''
+        CREATE TABLE users (
+            user_id INTEGER PRIMARY KEY,
+            name TEXT,
+            chastota TEXT,
+            count_1 INTEGER DEFAULT 0,
+            count_2 INTEGER DEFAULT 0,
+            wait_1 INTEGER DEFAULT 0,
+            wait_2 INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE TABLE settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        INSERT INTO settings (key, value) VALUES ('scripts_enabled', '0');
+    ''')
+    conn.executemany(
+        'INSERT INTO users (user_id, name, chastota, count_1, count_2, wait_1, wait_2) VALUES (?, ?, ?, ?, ?, ?, ?)',
+        BASELINE_USERS
+    )
+    conn.commit()
+    conn.close()
+    yield bot
+    remove_database()
+
+def columns(table: str) -> set:
+    return {row[1] for row in bot.db.get().execute(f'PRAGMA table_info({table})')}
+
+def test_baseline_database_reaches_the_current_schema(baseline_db):
+    assert bot.get_schema_version(bot.db.get()) == 0
+
+    bot.init_database()
+
+    assert bot.get_schema_version(bot.db.get()) == bot.SCHEMA_VERSION
+    assert 'freq' in columns('users') and 'chastota' not in columns('users')
+    assert {'team_id', 'prefers_dm'} <= columns('users')
+    assert 'kind' in columns('outbox')
+    assert {'team_id', 'chat_id', 'message_id'} <= columns('team_chats')
+
+def test_users_are_carried_over_with_normalized_values(baseline_db):
+    bot.init_database()
+
+    rows = bot.execute_query(
+        'SELECT user_id, name, freq, count_1, count_2, wait_1, wait_2, team_id, prefers_dm '
+        'FROM users ORDER BY user_id',
+        fetchall=True
+    )
+    assert rows == [
+        (1, 'Daily', bot.FREQ_DAILY, 4, 1, 0, 0, bot.DEFAULT_TEAM_ID, 0),
+        (2, 'Rare', bot.FREQ_RARE, 2, 0, 1, 0, bot.DEFAULT_TEAM_ID, 0),
+        (3, 'Unset', bot.FREQ_UNSET, 0, 0, 0, 0, bot.DEFAULT_TEAM_ID, 0),
+        (4, 'Odd flags', bot.FREQ_DAILY, 0, 1, 1, 1, bot.DEFAULT_TEAM_ID, 0),
+    ]
+
+def test_existing_settings_survive_the_migration(baseline_db):
+    bot.init_database()
+
+    assert bot.read_scripts_enabled() is False
+    assert bot.execute_query('SELECT name FROM teams WHERE team_id = ?', (bot.DEFAULT_TEAM_ID,), fetchone=True)
+
+def test_migrated_flags_are_constrained(baseline_db):
+    bot.init_database()
+
+    with pytest.raises(sqlite3.IntegrityError):
+        bot.db.get().execute('UPDATE users SET wait_1 = 2 WHERE user_id = 1')
+
+def test_rerunning_init_is_a_no_op(baseline_db):
+    bot.init_database()
+    bot.execute_query("UPDATE users SET name = 'Renamed' WHERE user_id = 1", commit=True)
+
+    bot.init_database()
+
+    assert bot.get_schema_version(bot.db.get()) == bot.SCHEMA_VERSION
+    assert bot.execute_query('SELECT name FROM users WHERE user_id = 1', fetchone=True) == ('Renamed',)
+    assert bot.execute_query('SELECT COUNT(*) FROM users', fetchone=True) == (len(BASELINE_USERS),)
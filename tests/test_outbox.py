@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+"""Очередь исходящих: постановка, итоги отправки и замена постов в чатах команд"""
+
+def rows(bot):
+    return bot.execute_query(
+        'SELECT id, chat_id, text, status, attempts, last_error FROM outbox ORDER BY id',
+        fetchall=True
+    )
+
+def test_enqueued_messages_are_due(fresh_db):
+    fresh_db.enqueue_messages([(1, 'a'), (2, 'b')])
+
+    due = fresh_db.outbox_due()
+
+    assert [(chat_id, text, attempts, kind) for _, chat_id, text, attempts, kind in due] == [
+        (1, 'a', 0, fresh_db.OUTBOX_DM), (2, 'b', 0, fresh_db.OUTBOX_DM)
+    ]
+
+def test_settle_marks_sent_retry_and_dead(fresh_db):
+    fresh_db.enqueue_messages([(1, 'a'), (2, 'b'), (3, 'c')])
+    sent, retry, dead = (row[0] for row in rows(fresh_db))
+
+    fresh_db.outbox_settle([sent], [(2e9, 'Timed out', retry)], [('Forbidden: bot was blocked', dead)])
+
+    assert [row[3:] for row in rows(fresh_db)] == [
+        ('sent', 1, None),
+        ('pending', 1, 'Timed out'),
+        ('dead', 1, 'Forbidden: bot was blocked'),
+    ]
+    # Отложенное сообщение еще не созрело
+    assert fresh_db.outbox_due() == []
+
+def test_settle_leaves_rows_that_are_no_longer_pending(fresh_db):
+    fresh_db.enqueue_messages([(1, 'a')])
+    row_id = rows(fresh_db)[0][0]
+    fresh_db.outbox_settle([row_id], [], [])
+
+    fresh_db.outbox_settle([], [(0, 'Timed out', row_id)], [('Forbidden', row_id)])
+
+    assert rows(fresh_db)[0][3:] == ('sent', 1, None)
+
+def test_new_team_post_supersedes_pending_ones_for_the_chat(fresh_db):
+    fresh_db.enqueue_messages([(-100, 'Дежурный: A'), (-200, 'Дежурный: X')], kind=fresh_db.OUTBOX_TEAM)
+    fresh_db.enqueue_messages([(-100, 'личное')])
+
+    fresh_db.enqueue_messages([(-100, 'Дежурный: B')], kind=fresh_db.OUTBOX_TEAM)
+
+    assert [(chat_id, text, status) for _, chat_id, text, status, _, _ in rows(fresh_db)] == [
+        (-100, 'Дежурный: A', 'superseded'),
+        (-200, 'Дежурный: X', 'pending'),
+        (-100, 'личное', 'pending'),
+        (-100, 'Дежурный: B', 'pending'),
+    ]
+
+def test_superseded_row_in_flight_is_not_settled(fresh_db):
+    fresh_db.enqueue_messages([(-100, 'Дежурный: A')], kind=fresh_db.OUTBOX_TEAM)
+    in_flight = fresh_db.outbox_due()[0][0]
+    fresh_db.enqueue_messages([(-100, 'Дежурный: B')], kind=fresh_db.OUTBOX_TEAM)
+
+    # Повтор старого поста после неудачи не возвращает его в очередь
+    fresh_db.outbox_settle([], [(0, 'Timed out', in_flight)], [])
+
+    assert [text for _, _, text, _, _ in fresh_db.outbox_due()] == ['Дежурный: B']
+
+def test_compact_removes_old_sent_and_superseded_rows(fresh_db):
+    fresh_db.enqueue_messages([(1, 'a'), (2, 'b'), (3, 'c'), (4, 'd')])
+    sent, superseded, dead, pending = (row[0] for row in rows(fresh_db))
+    fresh_db.outbox_settle([sent], [], [('Forbidden', dead)])
+    fresh_db.execute_query("UPDATE outbox SET status = 'superseded' WHERE id = ?", (superseded,), commit=True)
+    fresh_db.execute_query(
+        "UPDATE outbox SET sent_at = datetime('now', '-8 days'), created_at = datetime('now', '-8 days')",
+        commit=True
+    )
+
+    fresh_db.compact_outbox(retention_days=7)
+
+    assert [row[0] for row in rows(fresh_db)] == [dead, pending]
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+"""Расписания команд: разбор настроек и моменты запуска с переходами на летнее время"""
+
+from datetime import date, datetime, time
+
+import pytest
+
+import bot
+
+def berlin(**kwargs) -> 'bot.TeamSchedule':
+    return bot.TeamSchedule(1, 'Europe/Berlin', kwargs.pop('weekdays', '*'), **kwargs)
+
+@pytest.mark.parametrize('spec, days', [
+    ('mon-fri', {0, 1, 2, 3, 4}),
+    ('mon,wed,fri', {0, 2, 4}),
+    ('mon-wed,sat', {0, 1, 2, 5}),
+    ('fri-mon', {4, 5, 6, 0}),
+    (' SUN ', {6}),
+    ('*', set(range(7))),
+])
+def test_parse_weekdays(spec, days):
+    assert bot.parse_weekdays(spec) == frozenset(days)
+
+@pytest.mark.parametrize('spec', ['', 'monday', 'mon-xyz', 'mon;fri'])
+def test_parse_weekdays_rejects_unknown_days(spec):
+    with pytest.raises(ValueError):
+        bot.parse_weekdays(spec)
+
+def test_parse_clock():
+    assert bot.parse_clock(' 9:05 ') == time(9, 5)
+
+@pytest.mark.parametrize('text', ['', '13', '13:00:00', 'ab:cd', '24:00', '12:60'])
+def test_parse_clock_rejects_invalid_times(text):
+    with pytest.raises(ValueError):
+        bot.parse_clock(text)
+
+def test_load_timezone_rejects_unknown_names():
+    with pytest.raises(ValueError):
+        bot.load_timezone('Europe/Atlantis')
+
+def test_next_fire_follows_the_local_offset():
+    schedule = berlin(morning=time(13, 0))
+
+    # Зимой UTC+1, летом UTC+2
+    assert schedule.next_fire(schedule.morning, datetime(2026, 1, 5, 0, 0)) == datetime(2026, 1, 5, 12, 0)
+    assert schedule.next_fire(schedule.morning, datetime(2026, 7, 6, 0, 0)) == datetime(2026, 7, 6, 11, 0)
+
+def test_next_fire_is_strictly_after():
+    schedule = berlin(morning=time(13, 0))
+
+    assert schedule.next_fire(schedule.morning, datetime(2026, 1, 5, 12, 0)) == datetime(2026, 1, 6, 12, 0)
+
+def test_next_fire_in_the_spring_gap_fires_once_after_it():
+    # 29.03.2026 в Берлине 02:00-03:00 не существует: 02:30 наступает как 03:30 CEST
+    schedule = berlin(morning=time(2, 30))
+
+    slots = schedule.fire_times(schedule.morning, datetime(2026, 3, 28, 12, 0), datetime(2026, 3, 30, 12, 0))
+
+    assert slots == [datetime(2026, 3, 29, 1, 30), datetime(2026, 3, 30, 0, 30)]
+
+def test_next_fire_in_the_autumn_fold_fires_once():
+    # 25.10.2026 в Берлине 02:00-03:00 проходит дважды: запуск - в первый раз (CEST)
+    schedule = berlin(morning=time(2, 30))
+
+    slots = schedule.fire_times(schedule.morning, datetime(2026, 10, 24, 12, 0), datetime(2026, 10, 26, 12, 0))
+
+    assert slots == [datetime(2026, 10, 25, 0, 30), datetime(2026, 10, 26, 1, 30)]
+
+def test_next_fire_uses_the_local_date_across_midnight_utc():
+    # 08:00 в Токио - 23:00 UTC предыдущего дня; рабочий день считается по Токио
+    schedule = bot.TeamSchedule(1, 'Asia/Tokyo', 'mon', morning=time(8, 0))
+
+    assert schedule.next_fire(schedule.morning, datetime(2026, 1, 4, 12, 0)) == datetime(2026, 1, 4, 23, 0)
+
+def test_next_fire_skips_weekends_and_holidays():
+    schedule = bot.TeamSchedule(1, holidays=frozenset({date(2026, 1, 5)}))
+
+    # Пятница -> (выходные, праздничный понедельник) -> вторник
+    assert schedule.next_fire(schedule.morning, datetime(2026, 1, 2, 14, 0)) == datetime(2026, 1, 6, 13, 0)
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+"""Запуски по расписанию: слот выполняется один раз, пропуски догоняются"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+SLOT = datetime(2026, 1, 5, 13, 0)  # понедельник, 13:00 UTC
+
+@pytest.fixture
+def leader(fresh_db):
+    fresh_db.leader.heartbeat()
+    return fresh_db.leader
+
+def counting_job():
+    calls = []
+
+    def job(teams):
+        calls.append(list(teams))
+    return job, calls
+
+def test_slot_runs_once_per_team(fresh_db, leader):
+    job, calls = counting_job()
+    team = fresh_db.get_or_create_team('Офис')
+    teams = [fresh_db.DEFAULT_TEAM_ID, team]
+
+    assert fresh_db.run_scheduled_job('job', teams, SLOT, job) == teams
+    assert fresh_db.run_scheduled_job('job', teams, SLOT, job) == []
+    assert calls == [teams]
+    assert fresh_db.get_last_run('job', team) == SLOT
+
+def test_only_teams_without_the_slot_run(fresh_db, leader):
+    job, calls = counting_job()
+    team = fresh_db.get_or_create_team('Офис')
+    fresh_db.run_scheduled_job('job', [fresh_db.DEFAULT_TEAM_ID], SLOT, job)
+
+    done = fresh_db.run_scheduled_job('job', [fresh_db.DEFAULT_TEAM_ID, team], SLOT, job)
+
+    assert done == [team]
+    assert calls == [[fresh_db.DEFAULT_TEAM_ID], [team]]
+
+def test_failed_job_rolls_back_the_slot_marks(fresh_db, leader):
+    def broken(teams):
+        raise RuntimeError('сбой посреди цикла')
+
+    assert fresh_db.run_scheduled_job('job', [fresh_db.DEFAULT_TEAM_ID], SLOT, broken) == []
+    assert fresh_db.get_last_run('job') is None
+
+def test_catch_up_runs_only_the_latest_missed_slot(fresh_db, leader, monkeypatch):
+    job, calls = counting_job()
+    monkeypatch.setitem(fresh_db.SCHEDULED_JOB_FUNCS, 'run_13_00_scripts', job)
+    monkeypatch.setattr(fresh_db, 'SCHEDULER_CATCHUP', 'latest')
+    monkeypatch.setattr(fresh_db, 'SCHEDULER_CATCHUP_WINDOW', timedelta(days=7))
+    schedule = fresh_db.TeamSchedule(fresh_db.DEFAULT_TEAM_ID)
+    fresh_db.run_scheduled_job('run_13_00_scripts', [fresh_db.DEFAULT_TEAM_ID], SLOT, job)
+
+    # Пропущены вторник и среда: догоняется только среда
+    now = SLOT + timedelta(days=2, hours=1)
+    fresh_db.catch_up_missed_runs(now, {fresh_db.DEFAULT_TEAM_ID: schedule})
+
+    assert calls == [[fresh_db.DEFAULT_TEAM_ID]] * 2
+    assert fresh_db.get_last_run('run_13_00_scripts') == SLOT + timedelta(days=2)
+
+def test_catch_up_all_runs_every_missed_slot_in_the_window(fresh_db, leader, monkeypatch):
+    job, calls = counting_job()
+    monkeypatch.setitem(fresh_db.SCHEDULED_JOB_FUNCS, 'run_13_00_scripts', job)
+    monkeypatch.setattr(fresh_db, 'SCHEDULER_CATCHUP', 'all')
+    monkeypatch.setattr(fresh_db, 'SCHEDULER_CATCHUP_WINDOW', timedelta(days=7))
+    schedule = fresh_db.TeamSchedule(fresh_db.DEFAULT_TEAM_ID)
+    fresh_db.run_scheduled_job('run_13_00_scripts', [fresh_db.DEFAULT_TEAM_ID], SLOT, job)
+
+    fresh_db.catch_up_missed_runs(SLOT + timedelta(days=2, hours=1), {fresh_db.DEFAULT_TEAM_ID: schedule})
+
+    assert len(calls) == 3